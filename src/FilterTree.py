@@ -1,5 +1,5 @@
 from PyQt4 import QtCore, QtGui
-from datastore import PhotoDatabase
+from datastore import PhotoDatabase, DatabaseChange
 import pdb
 
 
@@ -29,13 +29,19 @@ class TagTreeView(QtGui.QTreeView):
         self.setModel(proxy)
         model.sigNewTag.connect(self.on_newTag)
 
+        # Coalesce tree updates from a burst of database changes
+        self._updateTimer = QtCore.QTimer(self)
+        self._updateTimer.setSingleShot(True)
+        self._updateTimer.setInterval(0)
+        self._updateTimer.timeout.connect(self.on_updateTimer)
+
         # Set Mode
         self._mode = mode
 
     def __del__(self):
-        """ Re-implemented to ensure the database connection is closed """
-        if self.con:
-            self.con.close()
+        """ Re-implemented to return the database connection to the pool """
+        if self.db is not None:
+            self.db.releaseConnection(self.con)
 
     def addEmptyTag(self, cat):
         """ Add an editable empty tag for new tags creation
@@ -89,11 +95,7 @@ class TagTreeView(QtGui.QTreeView):
             parent = self.sourceModel.catItemById(cat)
 
         # Create the new tag item and append parent
-        if cnt is not None and self.mode == self.EditMode:
-            val = '%s (%d)' % (tagValue, cnt)
-        else:
-            val = tagValue
-        child = QtGui.QStandardItem(val)
+        child = QtGui.QStandardItem(self.tagText(tagValue, cnt))
         child.id = tagId
         child.tag = tagValue
         flags = child.flags()
@@ -164,6 +166,11 @@ class TagTreeView(QtGui.QTreeView):
             out = {k: [c.lower() for c in v] for k, v in out.iteritems()}
         return out
 
+    def getCheckedTagIds(self):
+        """ Return the database id of each checked tag """
+        return [k.id for k in self.sourceModel.getCheckedItems()
+                if k.id is not None]
+
     def getCheckedTagNames(self, lower=False):
         """ Return the tag name for each checked tag
 
@@ -190,9 +197,56 @@ class TagTreeView(QtGui.QTreeView):
             db (PhotoDatabase)
         """
         self.db = db
-        self.db.databaseChanged.connect(self.updateTree)
+        self.db.databaseChanged.connect(self.on_databaseChanged)
         self.newConnection()
 
+    @QtCore.pyqtSlot(object)
+    def on_databaseChanged(self, change):
+        """ Update the tree if the change affects the tags
+
+        Slot for the database's databaseChanged signal
+
+        Arguments:
+            change (DatabaseChange)
+        """
+        if not change.has(DatabaseChange.TagChanges |
+                          DatabaseChange.FilesRemoved):
+            return
+        # The filtered tags depend only on which files have which tags
+        if change.has(DatabaseChange.TagsMapped |
+                      DatabaseChange.TagsRemoved |
+                      DatabaseChange.FieldsChanged |
+                      DatabaseChange.FilesRemoved):
+            self.sourceModel.clearFilterCache()
+        self.scheduleUpdate()
+
+    def scheduleUpdate(self):
+        """ Update the tree when control returns to the event loop
+
+        Any number of changes before then result in a single update.
+        """
+        self._updateTimer.start()
+
+    @QtCore.pyqtSlot()
+    def on_updateTimer(self):
+        """ Run the scheduled update
+
+        Slot for the update timer's timeout signal
+        """
+        if self.con:
+            self.updateTree()
+
+    def tagText(self, tagValue, cnt=None):
+        """ Return the text of a tag item
+
+        Arguments:
+            tagValue (str): The tag value
+            cnt (int): (None) The number of photos with the tag
+        """
+        if cnt is not None and self.mode == self.EditMode:
+            return '%s (%d)' % (tagValue, cnt)
+        return tagValue
+
     def uncheckAll(self):
         """ Uncheck all items """
         model = self.sourceModel
@@ -206,68 +260,94 @@ class TagTreeView(QtGui.QTreeView):
     def updateTree(self):
         """ Query the database for fields and update the tree"""
         con = self.con
-        # Get the fields and tags
-        catQ = 'SELECT FieldId, Name FROM TagFields'
-        cats = con.execute(catQ).fetchall()
-        cd = {c[1]: c[0] for c in cats}
-
-        tagQ = ('SELECT t.TagId, Value, COUNT(tm.FilId) from Tags as t '
-                'LEFT OUTER JOIN TagMap as tm '
-                'ON t.TagId == tm.TagId WHERE FieldId == ? '
-                'GROUP BY t.TagId')
-        tags = {cat[1]: [k for k in con.execute(tagQ, (cat[0],))]
-                for cat in cats}
-
-        # Get the fields already in the tree
-        model = self.sourceModel
-        alreadyFields = [str(model.item(r).text()).lower() for r in range(model.rowCount())]
+        # Get the fields, their tags and the number of files with each tag
+        q = ('SELECT f.FieldId, f.Name, t.TagId, t.Value, COUNT(tm.FilId) '
+             'FROM TagFields as f '
+             'LEFT OUTER JOIN Tags as t ON t.FieldId == f.FieldId '
+             'LEFT OUTER JOIN TagMap as tm ON tm.TagId == t.TagId '
+             'GROUP BY f.FieldId, t.TagId')
+        fields = {}
+        for fieldId, name, tagId, value, cnt in con.execute(q):
+            tags = fields.setdefault(fieldId, (name, {}))[1]
+            if tagId is not None:
+                tags[tagId] = (value, cnt)
 
         # Remove deleted fields
-        currentFields = [c[1].lower() for c in cats]
-        for k in range(len(alreadyFields)-1, -1, -1):
-            oldTag = alreadyFields[k]
-            if oldTag not in currentFields:
-                model.removeRow(k)
-
-        # Create the items and add to model
-        for cat in tags.keys():
-            if cat.lower() in alreadyFields:
-                parent = model.findItems(cat, QtCore.Qt.MatchFixedString)
-                if len(parent) != 1:
-                    msg = '{} tag fields names {} found'
-                    raise ValueError(msg.format(len(parent), cat))
-                parent = parent[0]
-                alreadyTags = [str(parent.child(r).tag).lower()
-                               for r in range(parent.rowCount())]
-
-                # Remove deleted tags
-                currentTags = [k[1].lower() for k in tags[cat]]
-                for k in range(len(alreadyTags)-1, -1, -1):
-                    oldTag = alreadyTags[k]
-                    if oldTag not in currentTags:
-                        parent.removeRow(k)
+        model = self.sourceModel
+        for r in range(model.rowCount()-1, -1, -1):
+            if model.item(r).id not in fields:
+                model.removeRow(r)
+
+        # Add new fields and update the existing ones
+        changed = False
+        existing = {model.item(r).id: model.item(r)
+                    for r in range(model.rowCount())}
+        for fieldId, (name, tags) in fields.iteritems():
+            parent = existing.get(fieldId)
+            if parent is None:
+                parent = self.addField(fieldId, name)
+                changed = True
+            elif parent.text() != name:
+                parent.setText(name)
+                changed = True
+            changed = self.updateTags(parent, tags) or changed
+
+        if changed:
+            self.model().sort(0)
+
+    def updateTags(self, parent, tags):
+        """ Update the tag items of a field to match the given tags
+
+        Only items that have changed are touched. Return whether any item was
+        added or renamed.
+
+        Arguments:
+            parent (QStandardItem): The field item
+            tags (dict): (value, count) tuples by tag id
+        """
+        changed = False
+        empty = None
+        items = {}
+        for r in range(parent.rowCount()-1, -1, -1):
+            child = parent.child(r)
+            if child.id is None and empty is None:
+                empty = child
+            elif child.id is None or child.id not in tags:
+                parent.removeRow(r)
             else:
-                # Add the new field
-                parent = self.addField(cd[cat], cat)
-                alreadyTags = []
-
-            # Add new tags
-            for tag in tags[cat]:
-                if tag[1].lower() not in alreadyTags:
-                    self.addTag(parent, *tag)
+                items[child.id] = child
+
+        for tagId, (value, cnt) in tags.iteritems():
+            child = items.get(tagId)
+            if child is None:
+                self.addTag(parent, tagId, value, cnt)
+                changed = True
+                continue
+            text = self.tagText(value, cnt)
+            if child.tag != value or child.text() != text:
+                child.tag = value
+                child.setText(text)
+                changed = True
+
+        # Keep the empty tag used to create new tags
+        emptyText = '<New {}>'.format(parent.text())
+        if empty is None:
             self.addEmptyTag(parent)
-
-        self.model().sort(0)
+        elif empty.text() != emptyText:
+            empty.setText(emptyText)
+        return changed
 
     @QtCore.pyqtSlot()
     def newConnection(self):
-        """ Create and store a new database connection
+        """ Acquire and store a read connection from the database's pool
 
-        Slot for the database object's newConnection signal
+        Slot for the database object's sigNewDatabase signal
         """
-        self.con = self.db.connect()
+        self.db.releaseConnection(self.con)
+        self.con = self.db.readConnection()
         if self.con:
             self.sourceModel.con = self.con
+            self.sourceModel.clearFilterCache()
             self.updateTree()
 
     @QtCore.pyqtSlot(int, str)
@@ -301,13 +381,27 @@ class TagTreeView(QtGui.QTreeView):
 
 
 class TagItemModel(QtGui.QStandardItemModel):
-    """ A Standard Item Model for Photo Tags """
+    """ A Standard Item Model for Photo Tags
+
+    The filtered tags for a set of checked tags are queried once for all
+    categories and cached. The cache is keyed by the checked tag ids, which
+    are found again only after the model's data changes. Call clearFilterCache
+    when the tag mappings in the database change.
+    """
 
     sigNewTag = QtCore.pyqtSignal(int, str)
 
+    # The number of check states to keep filtered tags for
+    filterCacheSize = 32
+
     def __init__(self, con=None, parent=None):
         super(TagItemModel, self).__init__(parent)
         self.con = con
+        self._filterCache = {}
+        self._checkedKey = None
+        # Connected before any view so the key is stale before views ask
+        self.dataChanged.connect(self._checkStateChanged)
+        self.rowsRemoved.connect(self._checkStateChanged)
 
     def catIds(self):
         """ Return a list of category ids """
@@ -375,6 +469,11 @@ class TagItemModel(QtGui.QStandardItemModel):
         """ Return the tag name for each checked tag """
         return [str(k.tag) for k in self.getCheckedItems()]
 
+    def clearFilterCache(self):
+        """ Discard the cached filtered tags """
+        self._filterCache = {}
+        self._checkedKey = None
+
     def getFilteredTags(self, catId):
         """ Return the filtered tag ids for any tags in the given category
 
@@ -383,26 +482,50 @@ class TagItemModel(QtGui.QStandardItemModel):
 
         Return None if there are no checked tags
         """
-        con = self.con
-        # Get the checked tag IDs
-        checkedTags = self.getCheckedTagIds()
-        if checkedTags:
-            # Query for filtered tags
-            tagstr = ','.join(['?']*len(checkedTags))
-            # This query finds how many of the given tags are associated with
-            # each file that has any of the tags. Those file ids are then used
-            # to narrow the search for tag ids for a given field
-            # I'm not sure I'm explaining that well
-            sel = ('SELECT TagId, count(*) as cnt FROM AllTags '+
-                   'WHERE FieldId == ? '+
-                   'AND FilId in (SELECT FilId FROM '+
-                   '(SELECT FilId, count(FilId) as cnt FROM TagMap '+
-                   'WHERE TagId in ({}) '+
-                   'GROUP BY FilId) '+
-                   'WHERE cnt == ?) GROUP BY TagId')
-            params = [catId] + checkedTags + [len(checkedTags)]
-            res = con.execute(sel.format(tagstr), params).fetchall()
-            return map(int, checkedTags) + map(lambda x: x[0], res)
+        if self._checkedKey is None:
+            self._checkedKey = frozenset(int(k) for k in
+                                         self.getCheckedTagIds())
+        checkedTags = self._checkedKey
+        if not checkedTags:
+            return
+
+        filtered = self._filterCache.get(checkedTags)
+        if filtered is None:
+            filtered = self._queryFilteredTags(checkedTags)
+            if len(self._filterCache) >= self.filterCacheSize:
+                self._filterCache = {}
+            self._filterCache[checkedTags] = filtered
+        return filtered.get(catId, checkedTags)
+
+    def _queryFilteredTags(self, checkedTags):
+        """ Query the filtered tags of every category
+
+        Return a dictionary of sets of tag ids by category id. Each set
+        includes the checked tags.
+
+        Arguments:
+            checkedTags (frozenset): The checked tag ids
+        """
+        tagstr = ','.join(['?']*len(checkedTags))
+        # This query finds the files that have all of the given tags. The tags
+        # of those files, in every field, are the ones left in the filter.
+        sel = ('SELECT FieldId, TagId FROM AllTags '
+               'WHERE FilId in (SELECT FilId FROM TagMap '
+               'WHERE TagId in ({}) '
+               'GROUP BY FilId HAVING count(FilId) == ?) '
+               'GROUP BY TagId')
+        params = list(checkedTags) + [len(checkedTags)]
+        out = {}
+        for fieldId, tagId in self.con.execute(sel.format(tagstr), params):
+            out.setdefault(fieldId, set(checkedTags)).add(tagId)
+        return out
+
+    def _checkStateChanged(self, *args):
+        """ Mark the checked tags as unknown
+
+        Slot for the dataChanged and rowsRemoved signals
+        """
+        self._checkedKey = None
 
     def setData(self, index, value, role=QtCore.Qt.EditRole):
         """ Reimplemented to handle the empty tag used to create new tags """
@@ -1,11 +1,150 @@
 from PyQt4 import QtGui
+from datetime import datetime
+import imagehash
 from PIL import Image, ImageOps
 from io import BytesIO
+from orientation import (readOrientation, writeOrientation,
+                         insertOrientation, rotateOrientation)
+import os
+
+# The PIL transpose that shows an image in each EXIF orientation
+TRANSPOSES = {2: Image.FLIP_LEFT_RIGHT,
+              3: Image.ROTATE_180,
+              4: Image.FLIP_TOP_BOTTOM,
+              5: Image.TRANSPOSE,
+              6: Image.ROTATE_270,
+              7: Image.TRANSVERSE,
+              8: Image.ROTATE_90}
+
+
+def openReduced(path, size=200):
+    """ Open an image decoded at no more resolution than is needed for size
+
+    JPEG files are scaled by the decoder (by 1/2, 1/4 or 1/8) to the smallest
+    image that is still at least size pixels on each side, which is much
+    faster than decoding the full image and uses a fraction of the memory.
+    Other formats are decoded at full resolution. The image is loaded before
+    returning so that it can be used for both thumbnails and hashes.
+
+    Arguments:
+        path (str): The full path to the image file
+        size (int): (200) The smallest side length needed
+    """
+    im = Image.open(path)
+    if im.format == 'JPEG':
+        im.draft(im.mode, (size, size))
+    im.load()
+    return im
+
+
+def applyOrientation(im, orientation):
+    """ Return an image transposed as its EXIF orientation says it should be
+    shown
+
+    Arguments:
+        im (Image): The image as stored
+        orientation (int): The EXIF orientation (1-8)
+    """
+    if orientation in TRANSPOSES:
+        return im.transpose(TRANSPOSES[orientation])
+    return im
+
+
+def rotationSinceHash(path, hsh):
+    """ Return the angle (0, 90, 180 or 270) by which an image file's
+    pixels have been turned clockwise since it was hashed
+
+    The image is compared, at each angle, with the given average hash, eg.
+    the one stored when it was imported.
+
+    Arguments:
+        path (str): The full path to the image file
+        hsh (str): The hash, as hex
+    """
+    stored = imagehash.hex_to_hash(hsh)
+    im = openReduced(path)
+    distances = []
+    for angle in (0, 90, 180, 270):
+        rotated = im.rotate(-angle, expand=True) if angle else im
+        distances.append((imagehash.average_hash(rotated) - stored, angle))
+    return min(distances)[1]
+
+
+def rotateFile(path, angle):
+    """ Rotate an image file by a multiple of 90 degrees
+
+    JPEG files are rotated losslessly by changing their EXIF orientation tag,
+    which writes only two bytes, or by adding the tag if they have none.
+    Raises IOError if a JPEG file's tag can't be added, rather than
+    re-encoding it. Other files are decoded, rotated and re-encoded. Returns
+    whether the rotation was lossless.
+
+    Arguments:
+        path (str): The full path to the image file
+        angle (int): The counter-clockwise rotation, in degrees
+    """
+    orientation = rotateOrientation(readOrientation(path), angle)
+    if writeOrientation(path, orientation):
+        return True
+    with open(path, 'rb') as fid:
+        isJpeg = fid.read(2) == b'\xff\xd8'
+    if isJpeg:
+        if not insertOrientation(path, orientation):
+            msg = "Can't add an orientation tag to {}"
+            raise IOError(msg.format(path))
+        return True
+    im = Image.open(path)
+    kwargs = {}
+    if 'exif' in im.info:
+        kwargs['exif'] = im.info['exif']
+    im = im.rotate(angle, expand=True)
+    im.save(path, **kwargs)
+    return False
+
+
+def rotateIcon(icon, angle):
+    """ Return a copy of an icon rotated by a multiple of 90 degrees
+
+    Arguments:
+        icon (QIcon)
+        angle (int): The counter-clockwise rotation, in degrees
+    """
+    sizes = icon.availableSizes()
+    if not sizes:
+        return icon
+    size = max(sizes, key=lambda s: s.width() * s.height())
+    transform = QtGui.QTransform().rotate(-angle)
+    return QtGui.QIcon(icon.pixmap(size).transformed(transform))
+
+
+def encodeThumbnail(im, fmt='JPEG', quality=85):
+    """ Return a thumbnail image encoded for storage in the database
+
+    If PIL can't write the requested format (eg. it was built without WebP),
+    the thumbnail is encoded as JPEG instead.
+
+    Arguments:
+        im (Image): The thumbnail image
+        fmt (str): ('JPEG') The format: 'JPEG', 'WEBP' or 'PNG'
+        quality (int): (85) The quality of lossy formats, 1-100
+    """
+    fmt = fmt.upper()
+    if fmt in ('JPEG', 'WEBP') and im.mode not in ('RGB', 'L'):
+        im = im.convert('RGB')
+    fp = BytesIO()
+    try:
+        im.save(fp, fmt, quality=quality)
+    except (IOError, KeyError, ValueError):
+        if fmt == 'JPEG':
+            raise
+        return encodeThumbnail(im, 'JPEG', quality)
+    return fp.getvalue()
 
 
 def getThumbnailIcon(filePath, size=200):
     if isinstance(filePath, basestring):
-        im = Image.open(filePath)
+        im = applyOrientation(openReduced(filePath, size),
+                              readOrientation(filePath))
         thumb = ImageOps.fit(im, (size, size), Image.ANTIALIAS)
     elif isinstance(filePath, Image.Image):
         thumb = filePath.copy()
@@ -18,6 +157,73 @@ def getThumbnailIcon(filePath, size=200):
     pix.loadFromData(fp.getvalue())
     return QtGui.QIcon(pix)
 
+
+def loadImageData(path, size=200, fmt='JPEG', quality=85):
+    """ Decode an image file and return the data needed to import it
+
+    This is run in the import worker processes, so the output contains only
+    plain python objects. The thumbnail is returned encoded in the given
+    format, ready to be stored in the database as is. The image is decoded
+    once, at reduced resolution when possible, and used for both the
+    thumbnail and the hash.
+
+    Arguments:
+        path (str): The full path to the image file
+        size (int): (200) The size of the square thumbnail
+        fmt (str): ('JPEG') The thumbnail format (see encodeThumbnail)
+        quality (int): (85) The thumbnail quality
+
+    Returns a dictionary with the keys path, directory, fileName, date, hash
+    and thumbnail. If the file can't be read, the dictionary contains only
+    path and error.
+    """
+    try:
+        im = openReduced(path, size)
+        try:
+            exif = im._getexif()
+        except Exception:
+            exif = None
+        hsh = str(imagehash.average_hash(im))
+
+        # Try to get date from exif
+        date = None
+        if exif and 36867 in exif:
+            ds = exif[36867]
+            try:
+                dt = datetime.strptime(ds, '%Y:%m:%d %H:%M:%S')
+                date = dt.strftime('%Y-%m-%d %H:%M:%S')
+            except ValueError:
+                pass
+
+        if date is None:
+            # Use modified time (not as reliable)
+            timestamp = os.path.getmtime(path)
+            dt = datetime.fromtimestamp(timestamp)
+            date = dt.strftime('%Y-%m-%d %H:%M:%S')
+
+        # The hash is of the image as stored, the thumbnail as shown
+        orientation = exif.get(274, 1) if exif else 1
+        thumb = ImageOps.fit(applyOrientation(im, orientation), (size, size),
+                             Image.ANTIALIAS)
+        data = encodeThumbnail(thumb, fmt, quality)
+    except Exception as err:
+        return {'path': path, 'error': str(err)}
+
+    directory, fname = os.path.split(path)
+    return {'path': path, 'directory': directory, 'fileName': fname,
+            'date': date, 'hash': hsh, 'thumbnail': data}
+
+
+def iconFromData(data):
+    """ Return a QIcon from encoded image bytes
+
+    Arguments:
+        data (str): The encoded image (eg. PNG)
+    """
+    pix = QtGui.QPixmap()
+    pix.loadFromData(data)
+    return QtGui.QIcon(pix)
+
 if __name__ == "__main__":
     filePath = r"C:\Users\Luke\Desktop\Pictures\Screenshot.jpg"
     image = Image.open(filePath)
@@ -12,18 +12,18 @@ from PyQt4 import QtCore, QtGui
 from UIFiles import Ui_PicOrganizer as uiclassf
 from BatchDialog import BatchTag
 from datastore import (AlbumModel, Photo, AlbumDelegate,
-                       AlbumSortFilterModel, PhotoDatabase)
+                       AlbumSortFilterModel, PhotoDatabase,
+                       ThumbnailReencoder, OrientationChecker)
 from datetime import datetime
 from Dialogs import WarningDialog, warning_box, UndoDialog
 from genericdialogs import skipFileDialog, ProgressDialog
 from glob import glob
-import imagehash
-from ImageMan import getThumbnailIcon
+from importer import Importer, ImportIndex
 from Log import LogWindow
 from moveCopy import Mover
 import os
 from PhotoViewer import ImageViewer
-from PIL import Image
+import multiprocessing
 import platform
 from send2trash import send2trash
 from shared import (resource_path, __release__, organization, application,
@@ -65,7 +65,10 @@ class PhotoOrganizer(QtGui.QMainWindow, uiclassf):
         app.setApplicationName(application)
 
         # Default settings
-        self.options = {'importFolder': os.path.expanduser("~")}
+        self.options = {'importFolder': os.path.expanduser("~"),
+                        'thumbnailCacheMB': 64,
+                        'thumbnailFormat': 'JPEG',
+                        'thumbnailQuality': 85}
 
         # Set up the widgets
         self.slider.setRange(20, 200)
@@ -74,6 +77,14 @@ class PhotoOrganizer(QtGui.QMainWindow, uiclassf):
 
         # Set up menus
         self.menuOrganize.addAction(self.view.actionBatchTag)
+        self.actionCompactThumbnails = QtGui.QAction('Compact Thumbnails',
+                                                     self.menuOrganize)
+        self.actionCompactThumbnails.setEnabled(False)
+        self.menuOrganize.addAction(self.actionCompactThumbnails)
+        self.actionCheckOrientations = QtGui.QAction('Check Orientations',
+                                                     self.menuOrganize)
+        self.actionCheckOrientations.setEnabled(False)
+        self.menuOrganize.addAction(self.actionCheckOrientations)
 
         # Add icons
         actionicons = [(self.actionNewDatabase, r'icons\New.ico'),
@@ -109,9 +120,10 @@ class PhotoOrganizer(QtGui.QMainWindow, uiclassf):
         # Instantiate an empty dataset and model
         self.model = AlbumModel(self.db)
         self.model.undoStack = self.undoStack
-        # This connection is needed because when renaming tags, dataChanged
-        # wouldn't result in updating the view.
-        self.model.dataChanged.connect(self.view.viewport().repaint)
+        # Schedule a repaint of the view when data changes. Changes made
+        # through a proxy are not always repainted otherwise. update is
+        # coalesced by the event loop, unlike repaint.
+        self.model.dataChanged.connect(self.view.viewport().update)
 
         self.proxy = AlbumSortFilterModel(self)
         self.proxy.setSourceModel(self.model)
@@ -177,6 +189,8 @@ class PhotoOrganizer(QtGui.QMainWindow, uiclassf):
         self.actionCopyPhotos.triggered.connect(self.on_copyPhotos)
 #         self.actionCopyPhotos.triggered.connect(self.on_movePhotos)
         self.actionEditTags.triggered.connect(self.on_editTags)
+        self.actionCompactThumbnails.triggered.connect(self.on_compactThumbnails)
+        self.actionCheckOrientations.triggered.connect(self.on_checkOrientations)
 
         # Set the horizontal header for a context menu
         self.horizontalHeader = self.view.horizontalHeader()
@@ -203,6 +217,17 @@ class PhotoOrganizer(QtGui.QMainWindow, uiclassf):
                     if isinstance(v, QtCore.QString):
                         v = str(v)
                     self.options[str(k)] = v
+        cacheBytes = int(self.options['thumbnailCacheMB']) * 2**20
+        self.db.thumbCache.setMaxBytes(cacheBytes)
+        fmt = self.options['thumbnailFormat'].upper()
+        writable = [str(k).upper() for k in
+                    QtGui.QImageWriter.supportedImageFormats()]
+        if fmt not in writable:
+            msg = 'Thumbnail format {} is not supported. Using JPEG.'
+            warning_box(msg.format(fmt), self)
+            fmt = 'JPEG'
+        self.db.thumbnailFormat = fmt
+        self.db.thumbnailQuality = int(self.options['thumbnailQuality'])
         self.restoreGeometry(settings.value("MainWindow/Geometry").toByteArray())
         # Restore the toolbar settings
         tb = settings.value('toolbarShowing')
@@ -222,6 +247,9 @@ class PhotoOrganizer(QtGui.QMainWindow, uiclassf):
 
     def closeEvent(self, event):
         """ Re-implemented to save settings """
+        # Finish any rotations still being written
+        undo.fileWorker.wait()
+
         # Handle trashed files
         trashfiles = os.listdir(trashDir)
         if trashfiles:
@@ -273,11 +301,9 @@ class PhotoOrganizer(QtGui.QMainWindow, uiclassf):
 
         # Save database-specific settings
         self.saveAppData()
-        # Close database connections
-        self.treeView.con.close() #Need to figure out a way to have this in PhotoDatabase
-        self.imageViewer.treeView.con.close()
 
-        # Close the current album and database
+        # Close the current album and database. This also closes all database
+        # connections, including those held by the tree views.
         self.model.changeDatabase(None)
 
         # Clear the undo stack
@@ -314,69 +340,63 @@ class PhotoOrganizer(QtGui.QMainWindow, uiclassf):
         Arguments:
             images ([str]): A list of full paths to image files
         """
-        exHash = {(k['File Name'], k['Hash']): k.fileId for k in self.album}
-        exFiles = [os.path.join(k['Directory'], k['File Name'])
-                   for k in self.album]
+        # Files already in the album are skipped without being opened
+        index = ImportIndex(self.album)
 
-        # Loop over all images and add to the table
+        # The images are decoded in worker processes. Their results are posted
+        # in chunks by the import thread and inserted here, on the GUI thread.
+        importer = Importer(images, index, thumbFormat=self.db.thumbnailFormat,
+                            thumbQuality=self.db.thumbnailQuality)
         changeDir = []
-        for k, path in enumerate(images):
-            # See if this file is already in the database
-            if path in exFiles:
-                continue
-
-            # Split off the filename
-            directory, fname = os.path.split(path)
+        imported = []
+        cols = [self.fields.index(name) for name in
+                ('Directory', 'File Name', 'Date', 'Hash', 'Tagged')]
 
-            # Read the scaled image into a byte array
-            im = Image.open(path)
+        def insertResults(results):
+            if importer.cancelEvent.isSet():
+                return
             try:
-                exif = im._getexif()
-            except Exception:
-                exif = None
-            hsh = imagehash.average_hash(im)
-            exHashKey = (fname, str(hsh))
-            if exHashKey in exHash:
-                changeDir.append((path, exHash[exHashKey]))
-                continue
-            # Try to get date from exif
-            date = None
-            if exif and 36867 in exif:
-                ds = exif[36867]
-                try:
-                    dt = datetime.strptime(ds, '%Y:%m:%d %H:%M:%S')
-                    date = dt.strftime('%Y-%m-%d %H:%M:%S')
-                except ValueError:
-                    pass
-
-            if date is None:
-                # Use modified time (not as reliable)
-                timestamp = os.path.getmtime(path)
-                dt = datetime.fromtimestamp(timestamp)
-                date = dt.strftime('%Y-%m-%d %H:%M:%S')
-
-            thumb = getThumbnailIcon(path)
-
-            # Create the values list based on the order of fields
-            def updateValues(values, name, val):
-                values[self.fields.index(name)] = val
-
-            values = ['' for _ in self.fields]
-            updateValues(values, 'Directory', directory)
-            updateValues(values, 'File Name', fname)
-            updateValues(values, 'Date', date)
-            updateValues(values, 'Hash', str(hsh))
-            updateValues(values, 'Tagged', False)
-
-            self.model.insertRows(Photo(self.fields, values, thumb))
-
-            msg = 'Importing Photo %d of %d' % (k+1, len(images))
-            self.statusbar.showMessage(msg)
-
-            # Allow the application to stay responsive and show the progress
-            QtGui.QApplication.processEvents()
-
-        self.statusbar.showMessage('Finished Import', 5000)
+                photos = []
+                for res in results:
+                    if 'error' in res:
+                        print('Could not import {}: {}'.format(res['path'],
+                                                               res['error']))
+                        continue
+                    fileId = index.match(res['fileName'], res['hash'])
+                    if fileId is not None:
+                        changeDir.append((res['path'], fileId))
+                        continue
+
+                    # Create the values list based on the order of fields
+                    values = ['' for _ in self.fields]
+                    fileValues = (res['directory'], res['fileName'],
+                                  res['date'], res['hash'], False)
+                    for col, val in zip(cols, fileValues):
+                        values[col] = val
+                    # The encoded thumbnail is stored as is
+                    photos.append(Photo(self.fields, values,
+                                        res['thumbnail']))
+                # One insert notification per chunk
+                self.model.insertFiles(photos)
+                imported.append(len(photos))
+            finally:
+                # Always make room for more, or the import never finishes
+                importer.release(len(results))
+
+        # Don't re-sort the table for every chunk. It is sorted once, when
+        # dynamic sorting is restored.
+        self.proxy.setDynamicSortFilter(False)
+        importer.sigResults.connect(insertResults, QtCore.Qt.QueuedConnection)
+        try:
+            dlg = ProgressDialog(importer, 'Importing Photos', 0, parent=self)
+            dlg.exec_()
+        finally:
+            importer.sigResults.disconnect(insertResults)
+            self.proxy.setDynamicSortFilter(True)
+
+        msg = 'Finished Import: {} new, {} moved, {} unchanged'
+        self.statusbar.showMessage(msg.format(sum(imported), len(changeDir),
+                                              importer.excluded), 5000)
 
         if changeDir:
             dlg = WarningDialog('Matching Files Found', self)
@@ -395,9 +415,10 @@ class PhotoOrganizer(QtGui.QMainWindow, uiclassf):
 
             if dlg.clickedButton() == yesbut:
                 col, rowrange = self.db.relocateFiles(changeDir)
-                sidex = self.model.index(col, rowrange[0])
-                eidex = self.model.index(col, rowrange[1])
-                self.model.dataChanged.emit(sidex, eidex)
+                if rowrange:
+                    sidex = self.model.index(rowrange[0], col)
+                    eidex = self.model.index(rowrange[1], col)
+                    self.model.dataChanged.emit(sidex, eidex)
 
         self.setWidthHeight()
         self.clearFilters()
@@ -443,6 +464,8 @@ class PhotoOrganizer(QtGui.QMainWindow, uiclassf):
         self.setWidthHeight()
         self.actionImportFolder.setEnabled(True)
         self.actionImportFiles.setEnabled(True)
+        self.actionCompactThumbnails.setEnabled(True)
+        self.actionCheckOrientations.setEnabled(True)
         self.setDateRange()
         self.saveAppData()
         self.setWidgetVisibility()
@@ -588,6 +611,74 @@ class PhotoOrganizer(QtGui.QMainWindow, uiclassf):
         self.dateFrom.setDisplayFormat(displayFormats[filt])
         self.dateTo.setDisplayFormat(displayFormats[filt])
 
+    @QtCore.pyqtSlot()
+    def on_checkOrientations(self):
+        """ Make the photos imported by earlier versions agree with their
+        EXIF orientation, after asking the user
+
+        Slot for actionCheckOrientations
+        """
+        if self.db.dbfile is None:
+            return
+        count = self.db.pendingOrientationChecks()
+        if count == 0:
+            QtGui.QMessageBox.information(self, 'Check Orientations',
+                                          'There are no photos to check.')
+            return
+        dlg = WarningDialog('Check Orientations', self)
+        dlg.setText('{} photo(s) were imported by an earlier version, which '
+                    'ignored the EXIF orientation.\n'
+                    'Photos that it rotated still have their original '
+                    'orientation and would be shown turned twice. Their '
+                    'orientation will be set to normal, a two byte change to '
+                    'the image file. The other photos will get new '
+                    'thumbnails.'.format(count))
+        dlg.setQuestionText('Do you want to continue?')
+        yes = dlg.addButton(QtGui.QDialogButtonBox.Yes)
+        dlg.addButton(QtGui.QDialogButtonBox.No)
+        dlg.exec_()
+        if dlg.clickedButton() != yes:
+            return
+
+        checker = OrientationChecker(self.db)
+        dlg = ProgressDialog(checker, 'Check Orientations', 0, parent=self)
+        dlg.exec_()
+
+        # Show the files and thumbnails as they are now
+        self.db.thumbCache.clear()
+        self.imageViewer.imageCache.clear()
+        self.view.viewport().update()
+        if checker.results is not None:
+            reset, remade = checker.results
+            msg = 'Orientation set to normal: {}, new thumbnails: {}'
+            self.statusbar.showMessage(msg.format(len(reset), len(remade)),
+                                       5000)
+
+    @QtCore.pyqtSlot()
+    def on_compactThumbnails(self):
+        """ Re-encode the stored thumbnails in the thumbnail format and
+        report the space saved
+
+        Slot for actionCompactThumbnails
+        """
+        if self.db.dbfile is None:
+            return
+        reencoder = ThumbnailReencoder(self.db)
+        dlg = ProgressDialog(reencoder, 'Compact Thumbnails', 0, parent=self)
+        dlg.exec_()
+        if reencoder.results is None:
+            # Failed, or closed before it finished
+            return
+        thumbs, files = reencoder.results
+
+        MB = float(2**20)
+        msg = ('Thumbnails: {:.1f} MB to {:.1f} MB\n'
+               'Database file: {:.1f} MB to {:.1f} MB\n\n'
+               'Saved {:.1f} MB').format(thumbs[0]/MB, thumbs[1]/MB,
+                                         files[0]/MB, files[1]/MB,
+                                         (files[0] - files[1])/MB)
+        QtGui.QMessageBox.information(self, 'Compact Thumbnails', msg)
+
     @QtCore.pyqtSlot()
     def on_copyPhotos(self):
         """ Prompt the user to chose a directory and copy all files in current
@@ -805,6 +896,8 @@ class PhotoOrganizer(QtGui.QMainWindow, uiclassf):
         self.mainWidget.setHidden(False)
         self.actionImportFolder.setEnabled(True)
         self.actionImportFiles.setEnabled(True)
+        self.actionCompactThumbnails.setEnabled(True)
+        self.actionCheckOrientations.setEnabled(True)
         self.view.rehideColumns()
         self.updateWindowTitle()
 
@@ -889,6 +982,8 @@ class PhotoOrganizer(QtGui.QMainWindow, uiclassf):
 
 if __name__ == "__main__":
     import sys
+    # Needed for the import worker processes in the frozen executable
+    multiprocessing.freeze_support()
 
     app = QtGui.QApplication(sys.argv)
 #     main = PhotoOrganizer()
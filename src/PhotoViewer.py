@@ -1,13 +1,38 @@
 #http://doc.qt.io/qt-5/qtwidgets-widgets-imageviewer-example.html
 from PyQt4 import QtCore, QtGui
 from UIFiles import Ui_ImageViewer
+from collections import OrderedDict
 from datastore import Album
+from imagecache import ImageCache
 from shared import resource_path
+from tiledview import TiledImageView
 import undo
 
 
 class ImageViewer(QtGui.QMainWindow, Ui_ImageViewer):
-    """ An image viewer """
+    """ An image viewer
+
+    Images are decoded at screen resolution and cached. The prefetchCount
+    photos on either side of the one showing are decoded in the background so
+    that moving to the next or previous photo is usually immediate.
+
+    The screen-sized image is scaled to fit the window. The scaled pixmaps
+    of the last few window sizes are kept, and rescaling while the window is
+    being resized waits until the resizing pauses. The full resolution image
+    is only decoded if the window is larger than the screen-sized one.
+
+    Images with more than tiledPixels pixels are too large to decode whole.
+    They are shown in a TiledImageView instead, which decodes only the
+    visible tiles of an on-disk tile pyramid and can be zoomed and panned.
+
+    Rotating a photo turns the decoded image in memory, so the viewer updates
+    immediately while the file is changed in the background.
+    """
+
+    prefetchCount = 2
+    scaledCacheSize = 4
+    resizeDelay = 50  # ms
+    tiledPixels = 50 * 10**6
 
     def __init__(self, imagefile=None, albumModel=None, main=None, parent=None):
         super(ImageViewer, self).__init__(parent)
@@ -23,6 +48,21 @@ class ImageViewer(QtGui.QMainWindow, Ui_ImageViewer):
         # Resize the window
         self.resize(QtGui.qApp.desktop().screenGeometry().size()*3/5)
 
+        # Decoded images
+        self.imageCache = ImageCache(maxPixels=self.tiledPixels, parent=self)
+
+        # The view for very large images shares the image label's place
+        self.tiledView = TiledImageView(parent=self.scrollAreaWidgetContents)
+        self.horizontalLayout.addWidget(self.tiledView, 1)
+        self.tiledView.setHidden(True)
+        self.scaledPix = OrderedDict()
+        self.imagePath = None
+        self.fullResolution = False
+        self._fitTimer = QtCore.QTimer(self)
+        self._fitTimer.setSingleShot(True)
+        self._fitTimer.setInterval(self.resizeDelay)
+        self._fitTimer.timeout.connect(self.fitImage)
+
         # Connect signals
         self.treeView.sourceModel.dataChanged.connect(self.on_filterChanged)
 
@@ -113,7 +153,21 @@ class ImageViewer(QtGui.QMainWindow, Ui_ImageViewer):
             self.actionBack.setEnabled(True)
             self.actionNext.setEnabled(True)
 
-        self.originalPix = QtGui.QPixmap(photo.filePath)
+        path = photo.filePath
+        self.imagePath = path
+        self.fullResolution = False
+        self.scaledPix.clear()
+        if self.isLarge(path):
+            # Too large to decode whole. fitImage ignores the null pixmap.
+            self.originalPix = QtGui.QPixmap()
+            self.tiledView.setImage(path)
+            self.tiledView.setHidden(False)
+        else:
+            image = self.imageCache.load(path)
+            self.originalPix = QtGui.QPixmap.fromImage(image)
+            self.tiledView.clear()
+            self.tiledView.setHidden(True)
+        self.prefetch()
         self.imageLabel.setHidden(True)
         self.imageLabel.setPixmap(self.originalPix)
         self.setWindowTitle(photo.filePath)
@@ -136,16 +190,106 @@ class ImageViewer(QtGui.QMainWindow, Ui_ImageViewer):
         """ Fit the image to the window while keeping aspect ratio """
         if self.originalPix.isNull():
             return
-        pix = self.originalPix.copy()
-        w = self.imageLabel.width()
-        h = self.imageLabel.height()
-        self.imageLabel.setPixmap(pix.scaled(w, h, QtCore.Qt.KeepAspectRatio))
+        size = self.imageLabel.size()
+        key = (size.width(), size.height())
+        pix = self.scaledPix.pop(key, None)
+        if pix is None:
+            self.loadFullResolution(size)
+            pix = self.originalPix.scaled(size, QtCore.Qt.KeepAspectRatio)
+            if len(self.scaledPix) >= self.scaledCacheSize:
+                self.scaledPix.popitem(last=False)
+        # Re-insert to mark as most recently used
+        self.scaledPix[key] = pix
+        self.imageLabel.setPixmap(pix)
         self.imageLabel.setHidden(False)
 
+    def isLarge(self, path):
+        """ Return whether an image file should be shown tiled
+
+        Arguments:
+            path (str): The full path to the image file
+        """
+        size = QtGui.QImageReader(path).size()
+        return size.width() * size.height() > self.tiledPixels
+
+    def loadFullResolution(self, size):
+        """ Replace the screen-sized image with the full resolution one if
+        it would be enlarged to fit the given size and the file is larger
+
+        Arguments:
+            size (QSize): The size the image will be scaled to fit
+        """
+        pix = self.originalPix
+        if self.fullResolution or self.imagePath is None:
+            return
+        if size.width() <= pix.width() or size.height() <= pix.height():
+            # Not enlarged
+            return
+        self.fullResolution = True
+        fullSize = QtGui.QImageReader(self.imagePath).size()
+        if max(fullSize.width(), fullSize.height()) > max(pix.width(),
+                                                           pix.height()):
+            # Make sure any rotation has been written to the file
+            undo.fileWorker.wait()
+            image = ImageCache.decode(self.imagePath, fullSize)
+            self.originalPix = QtGui.QPixmap.fromImage(image)
+            self.scaledPix.clear()
+
+    def rotateImage(self, photo, angle):
+        """ Rotate the decoded image of a photo and show the photo
+
+        Only the image showing is rotated. The file is left unchanged. The
+        caller should invalidate the photo's cached image once the file has
+        been rotated.
+
+        Arguments:
+            photo (Photo): The photo to rotate
+            angle (int): The counter-clockwise rotation, in degrees
+        """
+        path = photo.filePath
+        transform = QtGui.QTransform().rotate(-angle)
+        if path != self.imagePath:
+            # Showing another photo, eg. on undo. It may need reading.
+            undo.fileWorker.wait()
+            self.setImage(photo)
+        elif self.tiledView.isHidden():
+            self.originalPix = self.originalPix.transformed(transform)
+            self.scaledPix.clear()
+            self.fitImage()
+        else:
+            # The tiles are kept through a lossless rotation and shown as
+            # the file's new orientation says
+            undo.fileWorker.wait()
+            self.tiledView.setImage(path)
+
+    def prefetch(self):
+        """ Start decoding the photos around the one showing
+
+        The nearest photos are decoded first. Prefetches for photos that are
+        no longer near are cancelled.
+        """
+        if self.imageShowing is None or not self.imageList:
+            self.imageCache.prefetch([])
+            return
+        photos = self.imageList
+        count = len(photos)
+        current = self.imageShowing
+        paths = []
+        for k in range(1, min(self.prefetchCount, count // 2) + 1):
+            paths.append(photos[(current + k) % count].filePath)
+            paths.append(photos[(current - k) % count].filePath)
+        self.imageCache.prefetch(paths)
+
+    def closeEvent(self, event):
+        """ Re-implemented to free the decoded images """
+        super(ImageViewer, self).closeEvent(event)
+        self.imageCache.clear()
+        self.tiledView.clear()
+
     def resizeEvent(self, event):
         """ Re-implemented to resize the image """
         super(ImageViewer, self).resizeEvent(event)
-        self.fitImage()
+        self._fitTimer.start()
 
     @QtCore.pyqtSlot()
     def on_back(self):
@@ -0,0 +1,70 @@
+""" Time of finding the album rows of photos by their file ids
+
+The old PhotoDatabase methods built a list of every file id and searched
+it. The new ones use Album.rowByFileId, which keeps a file id to row index.
+
+    python benchmarks/album_rows.py [--photos 100000] [--lookups 5000]
+"""
+from __future__ import print_function
+import argparse
+import common
+from photo_objects import Album, Photo
+import random
+
+
+def makeAlbum(photos):
+    album = Album(['int', 'str', 'bool'])
+    fileIdCol = album.field_names.index(Album.fileIdField)
+    for k in range(photos):
+        values = ['' for _ in album.fields]
+        values[fileIdCol] = k
+        album.append(Photo(album.fields, values))
+    return album
+
+
+def oldBatch(album, fileIds):
+    """ As updateDatabase: one list of the file ids, searched per photo """
+    allFiles = [k.fileId for k in album]
+    return [allFiles.index(k) for k in fileIds]
+
+
+def newBatch(album, fileIds):
+    return [album.rowByFileId(k) for k in fileIds]
+
+
+def oldDeletes(album, fileIds):
+    """ As deleteFile: the list is built for every photo deleted """
+    for fileId in fileIds:
+        album.pop([k.fileId for k in album].index(fileId))
+
+
+def newDeletes(album, fileIds):
+    for fileId in fileIds:
+        album.pop(album.rowByFileId(fileId))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--photos', type=int, default=100000,
+                        help='the number of photos in the album')
+    parser.add_argument('--lookups', type=int, default=5000,
+                        help='the number of file ids looked up')
+    args = parser.parse_args()
+    photos, lookups = args.photos, args.lookups
+    rand = random.Random(0)
+    fileIds = rand.sample(range(photos), lookups)
+    deletes = fileIds[:50]
+    album = makeAlbum(photos)
+    album.rowByFileId(0)  # Build the index, as any earlier lookup would
+    assert oldBatch(album, fileIds) == newBatch(album, fileIds)
+    rows = [('{} lookups in one batch'.format(lookups),
+             common.best(oldBatch, album, fileIds),
+             common.best(newBatch, album, fileIds), 's')]
+    times = []
+    for deleteFun in (oldDeletes, newDeletes):
+        album = makeAlbum(photos)
+        album.rowByFileId(0)
+        times.append(common.best(deleteFun, album, deletes, repeat=1))
+    rows.append(('{} single deletes'.format(len(deletes)),) + tuple(times) +
+                ('s',))
+    common.report('Album of {} photos'.format(photos), rows)
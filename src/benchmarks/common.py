@@ -0,0 +1,144 @@
+""" Helpers shared by the benchmark scripts
+
+Each script in this directory times the code in the tree ("new") against a
+copy of the code it replaced ("old"), on synthetic data that it generates.
+Run them from the src directory, eg.
+
+    python benchmarks/tile_pyramid.py
+"""
+from __future__ import print_function
+import multiprocessing
+import os
+import sqlite3
+import sys
+import time
+try:
+    import resource
+except ImportError:
+    # Windows. Peak memory is not reported.
+    resource = None
+
+# Make the application's modules importable
+srcDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for d in (srcDir, os.path.join(srcDir, 'datastore', 'database'),
+          os.path.join(srcDir, 'datastore', 'objects')):
+    if d not in sys.path:
+        sys.path.insert(0, d)
+
+
+def peakRSS():
+    """ Return the peak resident memory of this process in MB, or None if it
+    can't be measured on this platform """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return peak / 2.**20 if sys.platform == 'darwin' else peak / 1024.
+
+
+def _run(queue, function, args):
+    start = time.time()
+    function(*args)
+    queue.put((time.time() - start, peakRSS()))
+
+
+def _idle():
+    pass
+
+
+def isolated(function, *args):
+    """ Run function(*args) in a new process and return its (seconds, peak
+    memory in MB). The memory is above that of an idle process, so a run
+    isn't charged for what an earlier one left behind.
+
+    Arguments:
+        function (callable): A module level function
+    """
+    def run(function, args):
+        queue = multiprocessing.Queue()
+        p = multiprocessing.Process(target=_run, args=(queue, function, args))
+        p.start()
+        result = queue.get()
+        p.join()
+        return result
+    seconds, peak = run(function, args)
+    if peak is not None:
+        peak -= run(_idle, ())[1]
+    return seconds, peak
+
+
+def best(function, *args, **kwargs):
+    """ Return the shortest time of several calls of function(*args)
+
+    Arguments:
+        repeat (int): (3) The number of calls
+    """
+    times = []
+    for _ in range(kwargs.get('repeat', 3)):
+        start = time.time()
+        function(*args)
+        times.append(time.time() - start)
+    return min(times)
+
+
+class _TracedCursor(sqlite3.Cursor):
+    """ A cursor that reports its statements to its connection's trace """
+
+    def execute(self, sql, *args):
+        self.connection.trace(sql)
+        return super(_TracedCursor, self).execute(sql, *args)
+
+    def executemany(self, sql, params):
+        params = list(params)
+        for _ in params:
+            self.connection.trace(sql)
+        return super(_TracedCursor, self).executemany(sql, params)
+
+
+class _TracedConnection(sqlite3.Connection):
+    """ A connection whose cursors, including those of execute, are traced
+    """
+
+    def cursor(self, factory=_TracedCursor):
+        return super(_TracedConnection, self).cursor(factory)
+
+
+def tracedConnect(dbfile, callback):
+    """ Return a connection that calls callback with each statement it runs
+
+    The connection's set_trace_callback is used where sqlite3 has it (Python
+    3.3 and later). Elsewhere the statements passed to the connection's
+    execute methods are reported, which misses those run by executescript.
+
+    Arguments:
+        dbfile (str): The path to the database file
+        callback (callable): Called with the SQL of each statement
+    """
+    if hasattr(sqlite3.Connection, 'set_trace_callback'):
+        con = sqlite3.connect(dbfile)
+        con.set_trace_callback(callback)
+    else:
+        con = sqlite3.connect(dbfile, factory=_TracedConnection)
+        con.trace = callback
+    return con
+
+
+def report(title, rows):
+    """ Print a table of old and new results
+
+    Arguments:
+        title (str)
+        rows ([(str, float, float, str)]): The measurement, its old and new
+            values and their unit. The values may be ints for counts.
+    """
+    print(title)
+    print('  {:<36} {:>10} {:>10} {:>7}'.format('', 'old', 'new', 'old/new'))
+    for name, old, new, unit in rows:
+        if old is None or new is None:
+            print('  {:<36} {:>10} {:>10}'.format(name, 'n/a', 'n/a'))
+            continue
+        ratio = float(old) / new if new else float('inf')
+        # Counts are shown without decimals
+        value = '{:>8d}' if isinstance(old, int) else '{:>8.3f}'
+        line = '  {:<36} ' + value + '{:<2} ' + value + '{:<2} {:>6.1f}x'
+        print(line.format(name, old, unit, new, unit, ratio))
@@ -0,0 +1,76 @@
+""" Time and peak memory of decoding imported photos for their thumbnails
+and hashes
+
+The old import decoded each JPEG at full resolution. The new one
+(ImageMan.loadImageData) has the decoder scale it down with draft() to the
+smallest size that covers the thumbnail.
+
+    python benchmarks/decode_thumbnails.py [--count 20] [--size 4000 3000]
+"""
+from __future__ import print_function
+import argparse
+import common
+from datetime import datetime
+import imagehash
+from ImageMan import loadImageData
+import os
+from PIL import Image, ImageOps
+import shutil
+import tempfile
+
+
+def makeImages(directory, count, width, height):
+    """ Write count noisy JPEGs """
+    for k in range(count):
+        tile = Image.frombytes('RGB', (256, 256), os.urandom(256*256*3))
+        im = Image.new('RGB', (width, height))
+        for x in range(0, width, 256):
+            for y in range(0, height, 256):
+                im.paste(tile, (x, y))
+        im.save(os.path.join(directory, '{}.jpg'.format(k)), 'JPEG',
+                quality=90)
+
+
+def oldLoad(path, size=200):
+    """ The import decode before openReduced """
+    im = Image.open(path)
+    try:
+        exif = im._getexif()
+    except Exception:
+        exif = None
+    hsh = str(imagehash.average_hash(im))
+    date = None
+    if exif and 36867 in exif:
+        date = datetime.strptime(exif[36867], '%Y:%m:%d %H:%M:%S')
+    thumb = ImageOps.fit(im, (size, size), Image.ANTIALIAS)
+    return hsh, date, thumb
+
+
+def loadAll(function, paths):
+    for path in paths:
+        function(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=20,
+                        help='the number of photos')
+    parser.add_argument('--size', type=int, nargs=2, default=[4000, 3000],
+                        metavar=('WIDTH', 'HEIGHT'),
+                        help='the size of the photos in pixels')
+    args = parser.parse_args()
+    count = args.count
+    width, height = args.size
+    tmp = tempfile.mkdtemp()
+    try:
+        common.isolated(makeImages, tmp, count, width, height)
+        paths = [os.path.join(tmp, k) for k in sorted(os.listdir(tmp))]
+        oldTime, oldPeak = common.isolated(loadAll, oldLoad, paths)
+        newTime, newPeak = common.isolated(loadAll, loadImageData, paths)
+        title = '{} JPEGs of {}x{} ({:.0f} MP)'
+        common.report(title.format(count, width, height, width*height/1e6),
+                      [('time per photo', oldTime/count*1000,
+                        newTime/count*1000, 'ms'),
+                       ('peak memory', oldPeak, newPeak, 'MB')])
+    finally:
+        shutil.rmtree(tmp)
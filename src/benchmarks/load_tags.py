@@ -0,0 +1,165 @@
+""" Time and statement count of loading an album with PhotoDatabase.load
+
+The old load ran one AllTags query per photo and tag field. The new one
+reads all the mappings with one query, ordered by file id, and merges them
+with the files in a single pass. The new load is the one in the tree. The
+old one is copied here as it was, except that it doesn't decode the
+thumbnails, which the new load no longer does either.
+
+The statements each load runs are counted through the trace of its
+connection (see common.tracedConnect).
+
+    python benchmarks/load_tags.py [--sizes 10000 100000 500000]
+"""
+from __future__ import print_function
+import argparse
+import common
+from contextlib import closing
+from database import PhotoDatabase
+from datastore import Album, FieldObject, FieldObjectContainer, Photo
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+tagFieldCount = 6
+tagsPerFile = 12
+
+
+def makeDatabase(dbfile, files):
+    """ Create a database of files tagged at random """
+    db = PhotoDatabase(dbfile)
+    for k in range(tagFieldCount):
+        db.insertField(name=FieldObject('Field {}'.format(k), tags=True))
+    # As the main window does when it saves
+    db.updateAppData(AppFileVersion='0.6.0')
+    db.closeDatabase()
+    rand = random.Random(0)
+    with closing(sqlite3.connect(dbfile)) as con, con:
+        fieldIds = [k[0] for k in con.execute('SELECT FieldId FROM TagFields')]
+        con.executemany('INSERT INTO Tags (FieldId, Value) VALUES (?, ?)',
+                        [(f, 'Tag {}'.format(k))
+                         for f in fieldIds for k in range(200)])
+        con.executemany('INSERT INTO File (directory, filename) VALUES (?, ?)',
+                        [('C:\\Photos', '{}.jpg'.format(k))
+                         for k in range(files)])
+        tagCount = 200 * tagFieldCount
+        con.executemany('INSERT OR IGNORE INTO TagMap VALUES (?, ?)',
+                        [(f + 1, rand.randint(1, tagCount))
+                         for f in range(files) for _ in range(tagsPerFile)])
+
+
+class CountingDatabase(PhotoDatabase):
+    """ A PhotoDatabase that counts the statements run on the connections it
+    opens """
+
+    statements = 0
+
+    def connect(self, dbfile=None):
+        if dbfile is None:
+            return super(CountingDatabase, self).connect()
+        con = common.tracedConnect(dbfile, self.count)
+        con.execute('pragma foreign_keys = 1')
+        return con
+
+    def count(self, sql):
+        self.statements += 1
+
+
+class OldDatabase(CountingDatabase):
+    """ The load before the tags were read in one pass """
+
+    def load(self, dbfile):
+        qry = 'SELECT directory, filename, filedate, hash, FilId, '+\
+              'tagged, datetime(importTimeUTC, "localtime") FROM File'
+
+        with closing(self.connect(dbfile)) as con:
+            # Get the fields and create the new Album instance
+            cur = con.execute('SELECT Name, Required, Editor, Editable, '+
+                              'Name_Editable, Hidden, Filt , Tags FROM Fields')
+            param_values = [list(k) for k in cur]
+            params = [k[0].lower() for k in cur.description]
+            vals = map(list, zip(*param_values))
+            param_dicts = dict(zip(params, vals))
+            album = Album(FieldObjectContainer(**param_dicts))
+            fields = album.fields
+
+            # Define the tag query string
+            tqry = 'SELECT Value FROM AllTags '+\
+                   'WHERE FilId == ? and Field == ?'
+
+            # Get the tag field names and their fields
+            tfq = 'SELECT Name from TagFields'
+            tagFields = [k[0] for k in con.execute(tfq)]
+
+            # Get the Photos and populate the Album
+            cur2 = con.cursor()
+            fileCur = con.execute(qry)
+            for row in fileCur:
+                directory = row[0]
+                fname = row[1]
+                date = row[2]
+                hsh = row[3]
+                fileId = row[4]
+                tagged = bool(row[5])
+                insertDate = row[6]
+
+                # Create the values list based on the order of fields
+                def updateValues(values, name, val):
+                    values[fields.index(name)] = val
+
+                values = ['' for _ in fields]
+                updateValues(values, 'Directory', directory)
+                updateValues(values, 'File Name', fname)
+                updateValues(values, 'Date', date)
+                updateValues(values, 'Hash', str(hsh))
+                updateValues(values, 'FileId', fileId)
+                updateValues(values, 'Tagged', tagged)
+                updateValues(values, 'Import Date', insertDate)
+
+                # Get the tags
+                for field in tagFields:
+                    cur2.execute(tqry, [fileId, field])
+                    tags = cur2.fetchall()
+                    if tags:
+                        tagStr = '; '.join([t[0] for t in tags])
+                        updateValues(values, field, tagStr)
+
+                album.append(Photo(fields, values))
+
+        return True, album
+
+
+def timeLoad(dbClass, dbfile):
+    """ Return the time, statement count and photo values of one load """
+    db = dbClass()
+    start = time.time()
+    st, album = db.load(dbfile)
+    seconds = time.time() - start
+    assert st, album
+    values = sorted((k.fileId, list(k.values())) for k in album)
+    return seconds, db.statements, values
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10000, 100000, 500000],
+                        help='the numbers of files in the albums')
+    args = parser.parse_args()
+    for files in args.sizes:
+        tmp = tempfile.mkdtemp()
+        try:
+            dbfile = os.path.join(tmp, 'album.pdb')
+            makeDatabase(dbfile, files)
+            oldTime, oldCount, oldValues = timeLoad(OldDatabase, dbfile)
+            newTime, newCount, newValues = timeLoad(CountingDatabase, dbfile)
+            assert oldValues == newValues
+            title = '{} files, {} tag fields, {} tags per file'
+            common.report(title.format(files, tagFieldCount, tagsPerFile),
+                          [('load', oldTime, newTime, 's'),
+                           ('statements', oldCount, newCount, '')])
+        finally:
+            shutil.rmtree(tmp)
@@ -0,0 +1,109 @@
+""" Memory and time of holding and reading the values of many photos
+
+The old Photo was a dict keyed by FieldObject, which searched the list of
+field names for each lookup by name. The new one keeps its values in a
+list, with field positions shared through the album's FieldObjectContainer.
+
+    python benchmarks/photo_values.py [--photos 100000]
+"""
+from __future__ import print_function
+import argparse
+import common
+from fieldobjects import FieldObject
+import os
+from photo_objects import Album, Photo
+
+fieldNames = ['Event', 'People', 'Place', 'Camera']
+
+
+class OldPhoto(dict):
+    """ The Photo class before the values were slotted (only the parts used
+    here) """
+
+    def __init__(self, fields=None, values=None, thumb=None):
+        fields = fields or []
+        assert all([isinstance(k, FieldObject) for k in fields])
+        values = ['' for _ in fields] if values is None else values
+        self.thumb = thumb
+        assert len(fields) == len(values)
+        super(OldPhoto, self).__init__(zip(fields, values))
+
+    def __getitem__(self, key):
+        if isinstance(key, FieldObject):
+            return super(OldPhoto, self).__getitem__(key)
+        else:
+            return super(OldPhoto, self).__getitem__(self.field_by_name(key))
+
+    def field_by_name(self, name):
+        field_names = [k.name for k in self.keys()]
+        if name not in field_names:
+            raise ValueError('%s is not a valid field name' % name)
+        dex = [i for i, x in enumerate(field_names) if x == name]
+        if len(dex) != 1:
+            raise ValueError('%s is the name of more than one field' % name)
+        return list(self.keys())[dex[0]]
+
+    @property
+    def directory(self):
+        return self[Album.directoryField]
+
+    @property
+    def fileId(self):
+        if Album.fileIdField in [k.name for k in self]:
+            return self[Album.fileIdField]
+
+    @property
+    def fileName(self):
+        return self[Album.fileNameField]
+
+    @property
+    def filePath(self):
+        return os.path.join(self.directory, self.fileName)
+
+
+def makePhotos(photoClass, count):
+    fields = Album(fieldNames).fields
+    photos = []
+    for k in range(count):
+        values = ['C:\\Photos' if f.name == Album.directoryField else
+                  k if f.name == Album.fileIdField else
+                  '{} {}'.format(f.name, k) for f in fields]
+        photos.append(photoClass(fields, values))
+    return fields, photos
+
+
+def build(photoClass, count):
+    makePhotos(photoClass, count)
+
+
+def readByName(photos):
+    for photo in photos:
+        photo['Directory'], photo.fileId, photo.filePath
+
+
+def readByField(photos, field):
+    for photo in photos:
+        photo[field]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--photos', type=int, default=100000,
+                        help='the number of photos')
+    count = parser.parse_args().photos
+    oldTime, oldPeak = common.isolated(build, OldPhoto, count)
+    newTime, newPeak = common.isolated(build, Photo, count)
+    rows = [('build', oldTime, newTime, 's'),
+            ('peak memory', oldPeak, newPeak, 'MB')]
+    results = []
+    for photoClass in (OldPhoto, Photo):
+        fields, photos = makePhotos(photoClass, count)
+        field = fields['Event']
+        results.append((common.best(readByName, photos[:count // 5]),
+                        common.best(readByField, photos, field)))
+    rows.append(('{} x name, fileId, filePath'.format(count // 5),
+                 results[0][0], results[1][0], 's'))
+    rows.append(('{} x photo[field]'.format(count),
+                 results[0][1], results[1][1], 's'))
+    title = '{} photos of {} fields'
+    common.report(title.format(count, len(fields)), rows)
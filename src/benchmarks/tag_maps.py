@@ -0,0 +1,164 @@
+""" Time of writing batch tag edits to the database
+
+The old updateDatabase read all the tags of the fields back after inserting
+the new ones, inserted every wanted mapping and ran one delete query per
+photo and field. The new PhotoDatabase._updateTagMaps compares the wanted
+and current mappings as sets and writes only the differences. The new one
+is the one in the tree and also updates the tag index. The old one is
+copied here with only the statements it ran before. The tagged status,
+which both leave to updateTagged, is left out.
+
+Every photo in the album is edited: one tag is removed, and one new and
+one existing tag are added.
+
+    python benchmarks/tag_maps.py [--photos 10000] [--tags 200]
+"""
+from __future__ import print_function
+import argparse
+import common
+from database import PhotoDatabase
+from datastore import FieldObject
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+fieldNames = ['Event', 'People', 'Place']
+
+
+def makeDatabase(dbfile, photos, tags):
+    """ Create a database where each photo has 3 tags in each field. Return
+    the photos' tags after the edit, as {fileId: {field: tags}}. """
+    db = PhotoDatabase(dbfile)
+    for name in fieldNames:
+        db.insertField(name=FieldObject(name, tags=True))
+    # As the main window does when it saves
+    db.updateAppData(AppFileVersion='0.6.0')
+    db.closeDatabase()
+    rand = random.Random(0)
+    edited = {}
+    with sqlite3.connect(dbfile) as con:
+        fieldIds = [con.execute('SELECT FieldId FROM Fields WHERE Name == ?',
+                                (k,)).fetchone()[0] for k in fieldNames]
+        con.executemany('INSERT INTO Tags (FieldId, Value) VALUES (?, ?)',
+                        [(fieldId, '{} {}'.format(name, k))
+                         for fieldId, name in zip(fieldIds, fieldNames)
+                         for k in range(tags)])
+        tagIds = dict(((k[0], k[1]), k[2]) for k in
+                      con.execute('SELECT FieldId, Value, TagId FROM Tags'))
+        con.executemany('INSERT INTO File (filename) VALUES (?)',
+                        [('{}.jpg'.format(k),) for k in range(photos)])
+        for fileId in range(1, photos + 1):
+            edited[fileId] = {}
+            for fieldId, name in zip(fieldIds, fieldNames):
+                values = ['{} {}'.format(name, k)
+                          for k in rand.sample(range(tags), 4)]
+                con.executemany('INSERT INTO TagMap VALUES (?, ?)',
+                                [(fileId, tagIds[(fieldId, k)])
+                                 for k in values[:3]])
+                if name == 'People':
+                    values = values[1:] + ['New {}'.format(fileId % 50)]
+                else:
+                    values = values[:3]
+                edited[fileId][name] = '; '.join(values)
+    return edited
+
+
+class OldDatabase(PhotoDatabase):
+    """ The tag mapping part of updateDatabase before the set differences """
+
+    def _updateTagMaps(self, fileIds, fieldnames):
+        album = self.album
+        tags2insert = []
+        mapParams1 = []
+        delMapQ = "DELETE From TagMap WHERE FilId == ? AND "+\
+                  "(SELECT FieldId FROM Tags as t "+\
+                  "WHERE t.TagId == TagMap.TagId) == ? AND "+\
+                  "(SELECT lower(Value) FROM Tags as t WHERE "+\
+                  "t.TagId == TagMap.TagId) "+\
+                  "NOT IN ({})"
+        delMaps = []
+        with self.connect() as con:
+            fieldstr = ','.join([str('\''+k+'\'') for k in fieldnames])
+            catQ = 'SELECT Name, FieldId from TagFields WHERE Name in (%s)' % fieldstr
+            allCatDict = dict(con.execute(catQ).fetchall())
+            catstr = ','.join([str(k) for k in allCatDict.values()])
+            tagQ = 'SELECT FieldId, TagId, Value FROM Tags WHERE FieldId IN (%s)' % catstr
+            alltags_before = con.execute(tagQ).fetchall()
+        for fileId in fileIds:
+            for field in fieldnames:
+                photo = album[album.rowByFileId(fileId)]
+                catId = allCatDict[field]
+                cur_tags = photo.tags(field)
+                existing = {k[2].lower(): k[1] for k in alltags_before
+                            if k[0] == catId}
+                for tag in cur_tags:
+                    if tag.strip() == '':
+                        continue
+                    cat_tag = (catId, tag)
+                    if (tag.lower() not in existing and
+                            cat_tag not in tags2insert):
+                        tags2insert.append(cat_tag)
+                    mapParams1.append((fileId, (catId, tag.lower())))
+                params = ','.join(['?'] * len(cur_tags))
+                delMaps.append((delMapQ.format(params),
+                                [fileId, catId] + [k.lower() for k in cur_tags]))
+        # insertTags
+        with self.connect() as con:
+            for param in tags2insert:
+                try:
+                    con.execute('INSERT INTO Tags (FieldId, Value) '
+                                'VALUES (?,?)', param)
+                except sqlite3.IntegrityError:
+                    pass
+        with self.connect() as con:
+            alltags_added = con.execute(tagQ).fetchall()
+            tagIds = {(k[0], k[2].lower()): k[1] for k in alltags_added}
+            mapParams = [(k[0], tagIds[k[1]]) for k in mapParams1]
+            tagMapQ = 'INSERT OR IGNORE INTO TagMap (FilId, TagId) VALUES (?,?)'
+            con.executemany(tagMapQ, mapParams)
+            for q, params in delMaps:
+                con.execute(q, params)
+
+
+def timeUpdate(dbClass, base, dbfile, edited):
+    """ Return the time of one update of a fresh copy of the database, and
+    the mappings after it as a set of (FilId, Field, Value) """
+    shutil.copy(base, dbfile)
+    db = dbClass(dbfile)
+    for fileId, tags in edited.items():
+        photo = db.album[db.album.rowByFileId(fileId)]
+        for name, value in tags.items():
+            photo[name] = value
+    start = time.time()
+    db._updateTagMaps(list(edited), fieldNames)
+    seconds = time.time() - start
+    db.closeDatabase()
+    with sqlite3.connect(dbfile) as con:
+        q = 'SELECT FilId, Field, Value FROM AllTags'
+        return seconds, set(con.execute(q))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--photos', type=int, default=10000,
+                        help='the number of photos in the album')
+    parser.add_argument('--tags', type=int, default=200,
+                        help='the number of tags in each field')
+    args = parser.parse_args()
+    tmp = tempfile.mkdtemp()
+    try:
+        base = os.path.join(tmp, 'base.pdb')
+        edited = makeDatabase(base, args.photos, args.tags)
+        results = []
+        for dbClass in (OldDatabase, PhotoDatabase):
+            dbfile = os.path.join(tmp, dbClass.__name__ + '.pdb')
+            results.append(timeUpdate(dbClass, base, dbfile, edited))
+        assert results[0][1] == results[1][1]
+        title = '{} photos, {} tags per field'
+        common.report(title.format(args.photos, args.tags),
+                      [('batch tag edit', results[0][0], results[1][0], 's')])
+    finally:
+        shutil.rmtree(tmp)
@@ -0,0 +1,82 @@
+""" Time and peak memory of building the tile pyramid of a large JPEG
+
+The old build converted and turned the whole image before cutting the
+tiles, and halved every level from it. The new one cuts level 0 from the
+decoded image as it is stored and decodes level 1 at half scale.
+
+    python benchmarks/tile_pyramid.py [--size 8000 6000]
+"""
+from __future__ import print_function
+import argparse
+import common
+from ImageMan import applyOrientation
+from orientation import ORIENTATION_TAG
+import os
+from PIL import Image
+import shutil
+import struct
+import tempfile
+from tiledview import TilePyramid
+
+
+def makeImage(path, width, height, orientation=6):
+    """ Write a noisy JPEG with an EXIF orientation """
+    ifd = (struct.pack('<H', 1) +
+           struct.pack('<HHIH', ORIENTATION_TAG, 3, 1, orientation) +
+           b'\x00\x00' + struct.pack('<I', 0))
+    exif = b'Exif\x00\x00' + b'II' + struct.pack('<HI', 42, 8) + ifd
+    tile = Image.frombytes('RGB', (256, 256), os.urandom(256*256*3))
+    im = Image.new('RGB', (width, height))
+    for x in range(0, width, 256):
+        for y in range(0, height, 256):
+            im.paste(tile, (x, y))
+    im.save(path, 'JPEG', quality=90, exif=exif)
+
+
+def oldBuild(path, cacheDir):
+    """ The build before the tiles were kept as stored """
+    pyramid = TilePyramid(path, cacheDir)
+    im = Image.open(path)
+    if im.mode not in ('RGB', 'L'):
+        im = im.convert('RGB')
+    im = applyOrientation(im, pyramid.orientation)
+    ts = pyramid.tileSize
+    for level in range(pyramid.levels):
+        levelDir = os.path.join(pyramid.directory, str(level))
+        if not os.path.exists(levelDir):
+            os.makedirs(levelDir)
+        w, h = im.size
+        for row in range(pyramid.tileCount(h)):
+            for col in range(pyramid.tileCount(w)):
+                box = (col*ts, row*ts, min(w, (col+1)*ts), min(h, (row+1)*ts))
+                im.crop(box).save(pyramid.tilePath(level, col, row), 'JPEG',
+                                  quality=90)
+        if level < pyramid.levels - 1:
+            im = im.resize(((w + 1) // 2, (h + 1) // 2), Image.BILINEAR)
+    open(os.path.join(pyramid.directory, 'done'), 'w').close()
+
+
+def newBuild(path, cacheDir):
+    TilePyramid(path, cacheDir).build()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, nargs=2, default=[8000, 6000],
+                        metavar=('WIDTH', 'HEIGHT'),
+                        help='the size of the image in pixels')
+    width, height = parser.parse_args().size
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'large.jpg')
+        common.isolated(makeImage, path, width, height)
+        oldTime, oldPeak = common.isolated(oldBuild, path,
+                                           os.path.join(tmp, 'old'))
+        newTime, newPeak = common.isolated(newBuild, path,
+                                           os.path.join(tmp, 'new'))
+        title = 'Tile pyramid of a {}x{} JPEG ({:.0f} MP, rotated 90)'
+        common.report(title.format(width, height, width*height/1e6),
+                      [('build time', oldTime, newTime, 's'),
+                       ('peak memory', oldPeak, newPeak, 'MB')])
+    finally:
+        shutil.rmtree(tmp)
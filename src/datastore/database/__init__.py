@@ -1,3 +1,5 @@
 from database import PhotoDatabase
 from create_database import create_database
 from versions import convertCheck, convertVersion
+from changes import DatabaseChange
+from thumbnails import ThumbnailReencoder, OrientationChecker
@@ -0,0 +1,78 @@
+""" Descriptions of changes made to the photo database """
+
+
+class DatabaseChange(object):
+    """ A description of a change to the database
+
+    Emitted with PhotoDatabase.databaseChanged so that listeners can update
+    only what was affected. kind is a combination of the flags below. Changes
+    made within PhotoDatabase.batch are merged into one.
+
+    Arguments:
+        kind (int): The kinds of change, combined with |
+        fileIds (iterable): (()) The database ids of the files affected
+        tagIds (iterable): (()) The database ids of the tags affected
+        fieldIds (iterable): (()) The database ids of the fields affected
+    """
+
+    # Change kinds
+    FilesInserted = 0x01
+    FilesRemoved = 0x02
+    FilesChanged = 0x04     # File values, other than tags
+    TagsInserted = 0x08
+    TagsRemoved = 0x10
+    TagsRenamed = 0x20
+    TagsMapped = 0x40       # Tags added to or removed from files
+    FieldsChanged = 0x80    # Fields inserted, removed or changed
+
+    # Changes that affect the list of tags or their counts
+    TagChanges = (TagsInserted | TagsRemoved | TagsRenamed | TagsMapped |
+                  FieldsChanged)
+
+    def __init__(self, kind, fileIds=(), tagIds=(), fieldIds=()):
+        self.kind = kind
+        self.fileIds = set(fileIds)
+        self.tagIds = set(tagIds)
+        self.fieldIds = set(fieldIds)
+
+    def __repr__(self):
+        return ('<DatabaseChange: kind=0x%02x, %d file(s), %d tag(s), '
+                '%d field(s)>' % (self.kind, len(self.fileIds),
+                                  len(self.tagIds), len(self.fieldIds)))
+
+    def has(self, kind):
+        """ Return whether the change includes any of the given kinds
+
+        Arguments:
+            kind (int): One or more change kinds combined with |
+        """
+        return bool(self.kind & kind)
+
+    def merge(self, other):
+        """ Add another change to this one
+
+        Arguments:
+            other (DatabaseChange)
+        """
+        self.kind |= other.kind
+        self.fileIds |= other.fileIds
+        self.tagIds |= other.tagIds
+        self.fieldIds |= other.fieldIds
+
+
+if __name__ == "__main__":
+    import unittest
+
+    class DatabaseChangeTests(unittest.TestCase):
+
+        def test_merge(self):
+            change = DatabaseChange(DatabaseChange.TagsInserted, tagIds=[3])
+            change.merge(DatabaseChange(DatabaseChange.TagsMapped, [1, 2],
+                                        [3, 4]))
+            self.assertTrue(change.has(DatabaseChange.TagsMapped))
+            self.assertTrue(change.has(DatabaseChange.TagChanges))
+            self.assertFalse(change.has(DatabaseChange.FilesRemoved))
+            self.assertEqual(change.fileIds, set([1, 2]))
+            self.assertEqual(change.tagIds, set([3, 4]))
+
+    unittest.main()
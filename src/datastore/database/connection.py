@@ -0,0 +1,103 @@
+""" Connection management for the photo database file """
+import sqlite3
+import threading
+
+
+class ConnectionManager(object):
+    """ Owns the connections to a single database file
+
+    One long-lived connection is used for all writes. It puts the database in
+    WAL mode so that readers don't block it and commits don't wait on a full
+    journal sync. Read-only connections for views and background work are
+    handed out from a small pool with acquire() and returned with release().
+
+    Arguments:
+        dbfile (str): The path to the database file
+        poolSize (int): (None) The number of idle read connections to keep.
+            Defaults to ConnectionManager.poolSize
+    """
+
+    poolSize = 4
+
+    # Pragmas applied to every connection
+    pragmas = [('foreign_keys', 1),
+               ('cache_size', -16000),      # 16 MB page cache
+               ('mmap_size', 268435456)]    # 256 MB memory map
+    # Pragmas applied only to the writer
+    writerPragmas = [('journal_mode', 'WAL'),
+                     ('synchronous', 'NORMAL')]
+    # Pragmas applied only to the readers
+    readerPragmas = [('query_only', 1)]
+    # Statements run on the writer when it is opened. Python 2's sqlite3
+    # commits any open transaction before DDL, so temporary tables used
+    # within write transactions are created here rather than where they're
+    # used.
+    writerSetup = ['CREATE TEMP TABLE IF NOT EXISTS UpdateFiles '
+                   '(FilId INTEGER PRIMARY KEY)']
+
+    def __init__(self, dbfile, poolSize=None):
+        self.dbfile = dbfile
+        if poolSize is not None:
+            self.poolSize = poolSize
+        self._writer = None
+        self._idle = []
+        self._inUse = set()
+        self._lock = threading.Lock()
+
+    def _open(self, pragmas, **kwargs):
+        """ Open a new connection and apply the given pragmas """
+        con = sqlite3.connect(self.dbfile, **kwargs)
+        for name, value in self.pragmas + pragmas:
+            con.execute('PRAGMA {} = {}'.format(name, value))
+        return con
+
+    @property
+    def writer(self):
+        """ The shared connection used for writing """
+        if self._writer is None:
+            self._writer = self._open(self.writerPragmas)
+            for statement in self.writerSetup:
+                self._writer.execute(statement)
+        return self._writer
+
+    def acquire(self):
+        """ Return a read-only connection from the pool
+
+        The connection may be used from any thread, but only by one thread at
+        a time. Return it with release() when finished.
+        """
+        with self._lock:
+            if self._idle:
+                con = self._idle.pop()
+            else:
+                con = self._open(self.readerPragmas, check_same_thread=False)
+            self._inUse.add(con)
+        return con
+
+    def release(self, con):
+        """ Return a connection obtained with acquire() to the pool
+
+        Arguments:
+            con (sqlite3.Connection)
+        """
+        with self._lock:
+            if con not in self._inUse:
+                # Not ours, or the manager has been closed
+                return
+            self._inUse.remove(con)
+            if len(self._idle) < self.poolSize:
+                self._idle.append(con)
+                return
+        con.close()
+
+    def close(self):
+        """ Close all connections, including any that are still acquired """
+        with self._lock:
+            cons = self._idle + list(self._inUse)
+            self._idle = []
+            self._inUse = set()
+        for con in cons:
+            con.close()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
@@ -1,3 +1,4 @@
+from create_database import create_indexes, ORIENTATION_CHECK
 import sqlite3
 import shutil
 import os
@@ -55,3 +56,40 @@ def _convert03to05(dbfile):
 
     return (True, "Converted {} to {}".format(ov, __release__))
 
+
+def _convert05to06(dbfile):
+    """ Convert 0.5.x files to 0.6.x
+
+    0.6 adds indexes for looking up tag mappings by tag and files by path or
+    hash, and runs ANALYZE so the query planner uses them. It also shows
+    photos as their EXIF orientation says. The photos already in the file
+    are listed in OrientationCheck, for PhotoDatabase.checkOrientations.
+    Their image files are not touched here.
+    """
+    # Create a backup copy
+    p, f = os.path.split(dbfile)
+    n, e = os.path.splitext(f)
+    bu = os.path.join(p, n + '_backup0.5' + e)
+    shutil.copyfile(dbfile, bu)
+
+    try:
+        with sqlite3.connect(dbfile) as con:
+            ov = con.execute('SELECT AppFileVersion FROM AppData').fetchone()[0]
+            create_indexes(con)
+            con.execute(ORIENTATION_CHECK)
+            q = 'INSERT OR IGNORE INTO OrientationCheck SELECT FilId FROM File'
+            if con.execute(q).rowcount > 0:
+                print('Photos imported by earlier versions may be shown '
+                      'turned. Use Organize > Check Orientations to fix them.')
+
+            # Update the AppFileVersion
+            u = 'UPDATE AppData SET AppFileVersion = ?'
+            con.execute(u, (__release__,))
+
+    except Exception as err:
+        print('There was an error converting {} to 0.6'.format(n+e))
+        traceback.print_exc()
+        shutil.copyfile(bu, dbfile)
+        return False, str(err)
+
+    return (True, "Converted {} to {}".format(ov, __release__))
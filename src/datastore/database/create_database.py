@@ -1,6 +1,21 @@
 import sqlite3
 import os
 
+# Indexes for the lookups that aren't covered by the UNIQUE constraints.
+# These are shared with the converters so that upgraded files match new ones.
+INDEXES = ['CREATE INDEX IF NOT EXISTS TagMapTagIndex ON TagMap (TagId, FilId)',
+           'CREATE INDEX IF NOT EXISTS FilePathIndex '
+           'ON File (directory, filename)',
+           'CREATE INDEX IF NOT EXISTS FileHashIndex ON File (hash)']
+
+# Photos imported before 0.6, whose files and thumbnails may not agree with
+# the EXIF orientation (see PhotoDatabase.checkOrientations). The 0.6
+# converter fills it.
+ORIENTATION_CHECK = ('CREATE TABLE IF NOT EXISTS OrientationCheck '
+                     '(FilId INTEGER PRIMARY KEY, '
+                     'FOREIGN KEY(FilId) REFERENCES File(FilId) '
+                     'ON DELETE CASCADE)')
+
 
 def create_database(dbfile):
     if os.path.exists(dbfile):
@@ -13,10 +28,74 @@ def create_database(dbfile):
         with open(script, 'r') as fid:
             script = fid.read()
         cur.executescript(script)
+        cur.execute(ORIENTATION_CHECK)
+        create_indexes(con)
         cur.execute('UPDATE Database SET Name = ?', (dbfile,))
 
+
+def create_indexes(con):
+    """ Create any missing indexes and update the planner statistics
+
+    Arguments:
+        con (sqlite3.Connection)
+    """
+    for q in INDEXES:
+        con.execute(q)
+    con.execute('ANALYZE')
+
+
 if __name__ == "__main__":
-    dbfile = 'TestDb2.db'
-    if os.path.exists(dbfile):
-        os.remove(dbfile)
-    create_database(dbfile)
+    import re
+    import shutil
+    import tempfile
+    import unittest
+
+    class QueryPlanTests(unittest.TestCase):
+        """ Make sure the common lookups use an index rather than a scan """
+
+        SCAN = re.compile(r'\bSCAN (TABLE )?(TagMap|File|tm)\b')
+
+        def setUp(self):
+            self.dir = tempfile.mkdtemp()
+            self.dbfile = os.path.join(self.dir, 'test.pdb')
+            create_database(self.dbfile)
+            self.con = sqlite3.connect(self.dbfile)
+
+        def tearDown(self):
+            self.con.close()
+            shutil.rmtree(self.dir)
+
+        def plan(self, q, params):
+            rows = self.con.execute('EXPLAIN QUERY PLAN ' + q, params)
+            return ' | '.join(k[-1] for k in rows)
+
+        def assertNoScan(self, q, params=()):
+            plan = self.plan(q, params)
+            self.assertIsNone(self.SCAN.search(plan), plan)
+
+        def test_tagMapByTag(self):
+            self.assertNoScan('SELECT FilId FROM TagMap WHERE TagId == ?', (1,))
+            self.assertNoScan('DELETE FROM TagMap WHERE TagId == ?', (1,))
+
+        def test_tagMapByFile(self):
+            self.assertNoScan('SELECT TagId FROM TagMap WHERE FilId == ?', (1,))
+
+        def test_tagCounts(self):
+            q = ('SELECT t.TagId, Value, COUNT(tm.FilId) from Tags as t '
+                 'LEFT OUTER JOIN TagMap as tm '
+                 'ON t.TagId == tm.TagId WHERE FieldId == ? '
+                 'GROUP BY t.TagId')
+            self.assertNoScan(q, (1,))
+
+        def test_fileByPath(self):
+            q = 'SELECT FilId FROM File WHERE directory == ? AND filename == ?'
+            self.assertNoScan(q, ('C:\\', 'a.jpg'))
+
+        def test_fileByHash(self):
+            self.assertNoScan('SELECT FilId FROM File WHERE hash == ?', ('0',))
+
+        def test_analyzed(self):
+            q = 'SELECT count(*) FROM sqlite_master WHERE name == "sqlite_stat1"'
+            self.assertEqual(self.con.execute(q).fetchone()[0], 1)
+
+    unittest.main()
@@ -1,12 +1,19 @@
 """ A module for interacting with the photo database file """
 from PyQt4 import QtGui, QtCore
+from changes import DatabaseChange
+from connection import ConnectionManager
+from contextlib import closing, contextmanager
 from create_database import create_database
 from datastore import FieldObjectContainer, FieldObject, Album, Photo
 from Dialogs import WarningDialog, warning_box
+from ImageMan import loadImageData, rotationSinceHash
 from io import BytesIO
+from orientation import readOrientation, writeOrientation
 import os.path
 import re
+from search import TagIndex, TokenIndex
 import sqlite3
+from thumbnails import ThumbnailCache
 from versions import convertCheck, convertVersion
 
 
@@ -18,11 +25,22 @@ class PhotoDatabase(QtCore.QObject):
     """
 
     sigNewDatabase = QtCore.pyqtSignal()
-    databaseChanged = QtCore.pyqtSignal()
+    databaseChanged = QtCore.pyqtSignal(object)  # DatabaseChange
+
+    # The format and quality thumbnails are stored in. Thumbnails of any
+    # format Qt can read may be mixed in one database.
+    thumbnailFormat = 'JPEG'
+    thumbnailQuality = 85
 
     def __init__(self, dbfile=None, parent=None):
         super(PhotoDatabase, self).__init__(parent)
         self._dbfile = None
+        self._connections = None
+        self.thumbCache = ThumbnailCache()
+        self.tokenIndex = TokenIndex()
+        self.tagIndex = TagIndex()
+        self._batchDepth = 0
+        self._pendingChange = None
         if dbfile and os.path.exists(dbfile):
             # Open an existing database
             st, album = self.load(dbfile) #Note look into combining album field initialization with ours
@@ -43,19 +61,89 @@ class PhotoDatabase(QtCore.QObject):
                 self.setDatabaseFile(dbfile)
                 self.setFields(self.album.fields)
 
+    @contextmanager
+    def batch(self):
+        """ Collect the changes made within a with block into one
+
+        databaseChanged is emitted once, with the merged changes, when the
+        outermost batch ends. Batches may be nested.
+        """
+        self._batchDepth += 1
+        try:
+            yield self
+        finally:
+            self._batchDepth -= 1
+            if self._batchDepth == 0 and self._pendingChange is not None:
+                change, self._pendingChange = self._pendingChange, None
+                self.databaseChanged.emit(change)
+
+    def _notify(self, kind, fileIds=(), tagIds=(), fieldIds=()):
+        """ Emit databaseChanged, or hold the change until the batch ends
+
+        Arguments:
+            kind (int): The DatabaseChange kind(s)
+            fileIds ([int]): (()) The database ids of the files affected
+            tagIds ([int]): (()) The database ids of the tags affected
+            fieldIds ([int]): (()) The database ids of the fields affected
+        """
+        change = DatabaseChange(kind, fileIds, tagIds, fieldIds)
+        if self._batchDepth == 0:
+            self.databaseChanged.emit(change)
+        elif self._pendingChange is None:
+            self._pendingChange = change
+        else:
+            self._pendingChange.merge(change)
+
     def closeDatabase(self):
         """ Close the existing database """
+        self._closeConnections()
         self._dbfile = None
         self.album = Album()
+        self.thumbCache.clear()
+        self.tagIndex.clear()
 
     def connect(self, dbfile=None):
-        """ Create a database connection """
-        dbfile = dbfile or self.dbfile
-        if dbfile is None:
+        """ Return a database connection
+
+        Without arguments, the shared writer connection of the open database
+        is returned. It must not be closed by the caller.
+
+        Arguments:
+            dbfile (str): (None) If given, a new connection to this file is
+                created and returned. The caller is responsible for closing it.
+        """
+        if dbfile is not None:
+            con = sqlite3.connect(dbfile)
+            con.execute('pragma foreign_keys = 1')
+            return con
+        if self._connections is None:
             return
-        con = sqlite3.connect(dbfile)
-        con.execute('pragma foreign_keys = 1')
-        return con
+        return self._connections.writer
+
+    def readConnection(self):
+        """ Return a read-only connection from the connection pool
+
+        Return it with releaseConnection when it is no longer needed. All
+        pooled connections are closed when the database is closed.
+        """
+        if self._connections is None:
+            return
+        return self._connections.acquire()
+
+    def releaseConnection(self, con):
+        """ Return a connection obtained with readConnection to the pool
+
+        Arguments:
+            con (sqlite3.Connection)
+        """
+        if self._connections is not None and con is not None:
+            self._connections.release(con)
+
+    def _closeConnections(self):
+        """ Close all connections to the current database file """
+        if self._connections is not None:
+            self._connections.close()
+            self._connections = None
 
     def newDatabase(self, dbfile):
         """ Create new database """
@@ -72,20 +160,95 @@ class PhotoDatabase(QtCore.QObject):
         Arguments:
             dbfile (str): The path to the database file
         """
+        self._closeConnections()
         self._dbfile = dbfile
         if dbfile:
+            self._connections = ConnectionManager(dbfile)
+            self.buildTagIndex()
             self.sigNewDatabase.emit()
+        else:
+            self.tagIndex.clear()
 
     ###################
     #  Query Methods  #
     ###################
 
+    def checkOrientations(self, progress=None, con=None):
+        """ Make the photos imported before 0.6 agree with the EXIF
+        orientation
+
+        Before 0.6, the orientation was ignored when showing photos, and
+        rotating a photo re-encoded its pixels but kept its orientation,
+        which is now stale. For each photo listed in OrientationCheck whose
+        file has an orientation other than 1:
+
+        - If its pixels have been turned since import, it was rotated that
+          way. Its orientation is set to 1, a two byte change to the file,
+          so it shows as before.
+        - Otherwise its thumbnail is made again, as the file is now shown.
+
+        Checked photos are taken off the list. Missing and unreadable files
+        stay on it, to be checked another time.
+
+        Like reencodeThumbnails, the work is done on a connection of its own
+        so it may be run in a thread (see OrientationChecker).
+
+        Arguments:
+            progress (callable): (None) Called with (done, total) after each
+                photo. If it returns False, checking stops.
+            con (sqlite3.Connection): (None) The connection to use. Defaults
+                to a new connection to the open database.
+
+        Returns:
+            reset ([int]): The file ids of the photos whose orientation was
+                set to 1
+            remade ([int]): The file ids of the photos given new thumbnails
+        """
+        if con is None:
+            with closing(self.connect(self.dbfile)) as con:
+                return self.checkOrientations(progress, con)
+
+        q = ('SELECT f.FilId, f.directory, f.filename, f.hash '
+             'FROM OrientationCheck AS c JOIN File AS f ON f.FilId == c.FilId')
+        u = 'UPDATE File SET thumbnail = ? WHERE FilId == ?'
+        d = 'DELETE FROM OrientationCheck WHERE FilId == ?'
+        rows = con.execute(q).fetchall()
+        reset = []
+        remade = []
+        for k, (fileId, directory, fileName, hsh) in enumerate(rows):
+            path = os.path.join(directory, fileName)
+            thumb = None
+            try:
+                if readOrientation(path) != 1:
+                    if hsh and rotationSinceHash(path, hsh) != 0:
+                        writeOrientation(path, 1)
+                        reset.append(fileId)
+                    else:
+                        data = loadImageData(path, fmt=self.thumbnailFormat,
+                                             quality=self.thumbnailQuality)
+                        thumb = data['thumbnail']
+            except Exception:
+                # Missing or unreadable. Leave it on the list.
+                pass
+            else:
+                with con:
+                    if thumb is not None:
+                        con.execute(u, (sqlite3.Binary(thumb), fileId))
+                        remade.append(fileId)
+                    con.execute(d, (fileId,))
+            if progress is not None and progress(k + 1, len(rows)) is False:
+                break
+        return reset, remade
+
     def deleteFile(self, filId):
         """ Delete the file with the given id and its associated tag mappings
 
         Arguments:
             filId (int): The database file id to be deleted
         """
+        # Keep the thumbnail so the photo can be re-inserted (undo)
+        thumb = self.thumbnail(filId)
+
         with self.connect() as con:
             q1 = 'DELETE FROM TagMap WHERE FilId == ?'
             cur = con.execute(q1, (filId,))
@@ -93,14 +256,23 @@ class PhotoDatabase(QtCore.QObject):
             q2 = 'DELETE FROM File WHERE FilId == ?'
             cur.execute(q2, (filId,))
 
-        dex = [k.fileId for k in self.album].index(filId)
-        self.album.pop(dex)
+        photo = self.album.pop(self.album.rowByFileId(filId))
+        photo.thumb = thumb
+        self.thumbCache.remove(filId)
+        self.tokenIndex.remove(filId)
+        tagIds = self.tagIndex.tags(filId)
+        self.tagIndex.removeFile(filId)
+        self._notify(DatabaseChange.FilesRemoved | DatabaseChange.TagsMapped,
+                     [filId], tagIds)
 
     def deleteTag(self, tagId):
         """ Delete a tag and all references to it
 
         Arguments:
             tagId (int): The db id of the tag to delete
+
+        Returns:
+            fileIDs ([int]): The ids of the files that had the tag
         """
         fq = 'SELECT FilId FROM TagMap WHERE TagId == ?'
         fieldq = 'SELECT Field, Value FROM TagList WHERE TagId == ?'
@@ -112,16 +284,16 @@ class PhotoDatabase(QtCore.QObject):
 
             con.execute(dq1, (tagId,))
             con.execute(dq2, (tagId,))
-        self.databaseChanged.emit()
+        self.tagIndex.removeTag(tagId)
 
-        # Update the table view
-        for photo in self.album:
-            tags = photo.tags(field)
-            ltags = [k.lower() for k in tags]
-            if tag.lower() in ltags:
-                dex = ltags.index(tag.lower())
-                tags.pop(dex)
-                photo[field] = '; '.join(tags)
+        # Update the photo objects that had the tag
+        album = self.album
+        for fileId in fileIDs:
+            photo = album[album.rowByFileId(fileId)]
+            if photo.replaceTag(field, tag):
+                self.tokenIndex.update(photo)
+        self._notify(DatabaseChange.TagsRemoved | DatabaseChange.TagsMapped,
+                     fileIDs, [tagId])
 
         return fileIDs
 
@@ -143,6 +315,8 @@ class PhotoDatabase(QtCore.QObject):
             CatId = con.execute(idq, (field.name,)).fetchone()
             if CatId is None:
                 return
+            tq = 'SELECT TagId FROM Tags WHERE FieldId == ?'
+            tagIds = [k[0] for k in con.execute(tq, CatId)]
             dmq = ('DELETE FROM TagMap WHERE TagId IN '
                    '(SELECT TagId FROM Tags WHERE FieldId == ?)')
             con.execute(dmq, CatId)
@@ -150,10 +324,34 @@ class PhotoDatabase(QtCore.QObject):
             con.execute(dtq, CatId)
             dfq = 'DELETE FROM Fields WHERE Name == ?'
             con.execute(dfq, (field.name,))
-        self.databaseChanged.emit()
 
         # Remove the field from the album
         self.album.removeField(idx)
+        self.tokenIndex.build(self.album)
+        self.buildTagIndex()
+        self._notify(DatabaseChange.FieldsChanged |
+                     DatabaseChange.TagsRemoved | DatabaseChange.TagsMapped,
+                     tagIds=tagIds, fieldIds=CatId)
+
+    def encodeImage(self, image, fmt=None, quality=None):
+        """ Return an image encoded for storage as a thumbnail
+
+        If Qt can't write the format, the image is encoded as PNG.
+
+        Arguments:
+            image (QImage, QPixmap)
+            fmt (str): (None) The format. Defaults to thumbnailFormat
+            quality (int): (None) The quality. Defaults to thumbnailQuality
+        """
+        fmt = fmt or self.thumbnailFormat
+        quality = self.thumbnailQuality if quality is None else quality
+        buff = QtCore.QBuffer()
+        buff.open(QtCore.QIODevice.ReadWrite)
+        if not image.save(buff, fmt, quality):
+            buff = QtCore.QBuffer()
+            buff.open(QtCore.QIODevice.ReadWrite)
+            image.save(buff, 'png')
+        return buff.data().data()
 
     def getTableAsDict(self, table, con=None, onePer=True, dbfile=None):
         """ Get the values of a table as a list of dictionaries
@@ -164,7 +362,8 @@ class PhotoDatabase(QtCore.QObject):
                 Otherwise it is a list of dictionaries with column/value pairs
         """
         q = 'SELECT * FROM {}'.format(table)
-        close = False if con else True
+        # Only close connections created here for another file
+        close = con is None and dbfile is not None
         con = con or self.connect(dbfile)
         try:
             cur = con.execute(q)
@@ -195,14 +394,14 @@ class PhotoDatabase(QtCore.QObject):
         """ Convert the thumbnail Icon to an Sqlite3 blob for insertion into DB
 
         Arguments:
-            icon (QIcon)
+            icon (QIcon, str): The thumbnail icon, or the already encoded
+                thumbnail (eg. from the import workers), which is stored as is
         """
+        if isinstance(icon, basestring):
+            return sqlite3.Binary(icon)
         if icon:
             pixmap = icon.pixmap(icon.availableSizes()[0])
-            buff = QtCore.QBuffer()
-            buff.open(QtCore.QIODevice.ReadWrite)
-            pixmap.save(buff, 'png')
-            return sqlite3.Binary(buff.data())
+            return sqlite3.Binary(self.encodeImage(pixmap))
 
     def insertField(self, index=None, name=None):
         """ Insert a new field. Return the id of the new category
@@ -245,13 +444,11 @@ class PhotoDatabase(QtCore.QObject):
         with self.connect() as con:
             # Add the field
             newId = con.execute(i, values).lastrowid
-        self.databaseChanged.emit()
 
         # Insert the field into the album
         # This is after the database insertion in the event of an error
-        self.fields.insert(index, new_field)
-        for entry in self.album._entries:
-            entry[self.fields[index]] = ''
+        self.album.insertField(index, new_field)
+        self._notify(DatabaseChange.FieldsChanged, fieldIds=[newId])
 
         return newId
 
@@ -260,65 +457,111 @@ class PhotoDatabase(QtCore.QObject):
 
         Arguments:
             photo (Photo): The photo object to be inserted
+            idx (int): (None) The album index at which to insert the photo.
+                Defaults to the end.
         """
-        # Create the thumbnail blob
-        thumb = self.icon2Blob(photo.thumb)
+        self.insertFiles([photo], idx)
 
+    def insertFiles(self, photos, idx=None):
+        """ Insert several photos into the database in one transaction
+
+        Photos without a file id are given one, along with their import time,
+        by the database. Photos that already have a file id (eg. re-inserted
+        by undo) keep it.
+
+        Arguments:
+            photos ([Photo]): The photo objects to be inserted
+            idx (int): (None) The album index at which to insert the first
+                photo. Defaults to the end.
+        """
         # Get the default columns and values
         #much like the field properties, need to find something cleaner
         fields = ['tagged', 'filename', 'directory', 'filedate', 'hash',
                   'thumbnail']
-        date = photo.datetime or photo.date
-        values = [photo.tagged, photo.fileName, photo.directory, date,
-                  photo.hash, thumb]
-
-        with self.connect() as con:
+        newValues = []
+        oldValues = []
+        for photo in photos:
+            date = photo.datetime or photo.date
+            values = [photo.tagged, photo.fileName, photo.directory, date,
+                      photo.hash, self.icon2Blob(photo.thumb)]
             if photo.fileId in (None, ''):
-                # Let the database fill in the FileID and Import Time
-                fieldStr = ','.join(fields)
-                parStr = ','.join(['?']*len(fields))
-                iqry = 'INSERT INTO File ({}) VALUES ({})'.format(fieldStr, parStr)
-                cur = con.execute(iqry, values)
-                filId = cur.lastrowid
-
-                # Set the photo's file id and import time
-                photo[self.fields[Album.fileIdField]] = filId
-                impQry = 'SELECT importTimeUTC FROM File WHERE FilId == ?'
-                cur = cur.execute(impQry, (filId,))
-                photo[self.fields[Album.importDateField]] = cur.fetchone()[0]
+                newValues.append(values)
             else:
                 # The photo already has a file id and import time
-                fields += ['FilId', 'importTimeUTC']
-                values += [int(photo.fileId), photo.importDate]
+                oldValues.append(values + [int(photo.fileId),
+                                           photo.importDate])
+        newPhotos = [k for k in photos if k.fileId in (None, '')]
 
+        with self.connect() as con:
+            if newValues:
+                # Let the database fill in the FileIDs and Import Times. The
+                # ids are assigned in order, above the current sequence value.
+                seqQ = 'SELECT seq FROM sqlite_sequence WHERE name == "File"'
+                seq = con.execute(seqQ).fetchone()
+                seq = seq[0] if seq else 0
                 fieldStr = ','.join(fields)
                 parStr = ','.join(['?']*len(fields))
                 iqry = 'INSERT INTO File ({}) VALUES ({})'.format(fieldStr, parStr)
-                cur = con.execute(iqry, values)
+                con.executemany(iqry, newValues)
+
+                # Set the photos' file ids and import times
+                impQry = ('SELECT FilId, importTimeUTC FROM File '
+                          'WHERE FilId > ? ORDER BY FilId')
+                idField = self.fields[Album.fileIdField]
+                impField = self.fields[Album.importDateField]
+                for photo, row in zip(newPhotos, con.execute(impQry, (seq,))):
+                    photo[idField] = row[0]
+                    photo[impField] = row[1]
+
+            if oldValues:
+                oldFields = fields + ['FilId', 'importTimeUTC']
+                fieldStr = ','.join(oldFields)
+                parStr = ','.join(['?']*len(oldFields))
+                iqry = 'INSERT INTO File ({}) VALUES ({})'.format(fieldStr, parStr)
+                con.executemany(iqry, oldValues)
 
             # Add the tag mappings
-            pTagFields = [k for k in photo if k.tags]
-            if pTagFields:
-                tfq = 'SELECT FieldId from Fields WHERE Name == ?'
-                tq = 'SELECT TagId FROM Tags WHERE FieldId == ? AND Value == ?'
+            # Look up the field and tag ids once for the whole batch. Tag
+            # values are unique without regard to case within a field.
+            tmps = []
+            if any(k.tags for k in self.fields):
+                tfq = 'SELECT Name, FieldId from TagFields'
+                fieldIds = dict(con.execute(tfq).fetchall())
+                # SQLite's lower() only folds ASCII, so the values are
+                # folded here, as they are when looked up
+                tq = 'SELECT FieldId, Value, TagId FROM Tags'
+                tagIds = {(k[0], k[1].lower()): k[2] for k in con.execute(tq)}
+                for photo in photos:
+                    for field in [k for k in photo if k.tags]:
+                        fieldId = fieldIds[field.name]
+                        for tag in photo.tags(field):
+                            tagId = tagIds[(fieldId, tag.lower())]
+                            tmps.append((photo.fileId, tagId))
+            if tmps:
                 tmq = 'INSERT INTO TagMap (FilId, TagId) VALUES (?,?)'
-                tmps = []
-                for field in pTagFields:
-                    # Get the field id
-                    fieldId = con.execute(tfq, (field.name,)).fetchone()[0]
-
-                    tags = photo.tags(field)
-                    for tag in tags:
-                        # Get the tag id
-                        tagId = con.execute(tq, (fieldId, tag)).fetchone()[0]
-                        # INSERT the tag map
-                        tmps.append((photo.fileId, tagId))
                 con.executemany(tmq, tmps)
+                for fileId, tagId in tmps:
+                    self.tagIndex.add(tagId, [fileId])
 
         # Put this here in case queries fail
         if idx is None:
             idx = len(self.album)
-        self.album.insert(idx, photo)
+        for k, photo in enumerate(photos):
+            self.album.insert(idx + k, photo)
+
+            # The thumbnail now lives in the database. Seed the cache with a
+            # decoded one since a newly inserted photo is likely to be shown.
+            # Encoded thumbnails are decoded when first shown.
+            if isinstance(photo.thumb, QtGui.QIcon):
+                self.thumbCache.insert(photo.fileId, photo.thumb)
+            photo.thumb = None
+            self.tokenIndex.add(photo)
+
+        kind = DatabaseChange.FilesInserted
+        if tmps:
+            kind |= DatabaseChange.TagsMapped
+        self._notify(kind, [k.fileId for k in photos],
+                     set(k[1] for k in tmps))
 
     def insertTags(self, fieldIds, tagValues=None):
         """ Insert a new tag. Return the id of the new tag. Return a list of
@@ -351,7 +594,8 @@ class PhotoDatabase(QtCore.QObject):
                     # Probably failed unique constraint, ignore because tag
                     # already exists for cat
                     pass
-        self.databaseChanged.emit()
+        if ids:
+            self._notify(DatabaseChange.TagsInserted, tagIds=ids)
         return ids
 
     def load(self, dbfile):
@@ -362,9 +606,11 @@ class PhotoDatabase(QtCore.QObject):
             geometry (read-write buffer): The main window geomerty as saved in
                 the database
         """
-        # Create the query strings
-        qry = 'SELECT directory, filename, filedate, hash, thumbnail, FilId, '+\
-              'tagged, datetime(importTimeUTC, "localtime") FROM File'
+        # Create the query strings. Both the files and the tag mappings are
+        # ordered by FilId so they can be merged in a single pass
+        qry = 'SELECT directory, filename, filedate, hash, FilId, tagged, '+\
+              'datetime(importTimeUTC, "localtime") FROM File ORDER BY FilId'
+        tqry = 'SELECT FilId, Field, Value FROM AllTags'
 
         # Check the file
         st, convert, ver = convertCheck(dbfile)
@@ -392,7 +638,7 @@ class PhotoDatabase(QtCore.QObject):
             else:
                 return False, None
 
-        with self.connect(dbfile) as con:
+        with closing(self.connect(dbfile)) as con:
             # Get the fields and create the new Album instance
             cur = con.execute('SELECT Name, Required, Editor, Editable, '+
                               'Name_Editable, Hidden, Filt , Tags FROM Fields')
@@ -403,56 +649,45 @@ class PhotoDatabase(QtCore.QObject):
             album = Album(FieldObjectContainer(**param_dicts))
             fields = album.fields
 
-            # Define the tag query string
-            tqry = 'SELECT Value FROM AllTags '+\
-                   'WHERE FilId == ? and Field == ?'
-
             # Get the tag field names and their fields
             tfq = 'SELECT Name from TagFields'
             tagFields = [k[0] for k in con.execute(tfq)]
 
-            # Get the Photos and populate the Album
-            cur2 = con.cursor()
+            # Look up the column of each value once rather than per photo
+            fileCols = [fields.index(name) for name in
+                        ('Directory', 'File Name', 'Date', 'Hash', 'FileId',
+                         'Tagged', 'Import Date')]
+            tagCols = {name: fields.index(name) for name in tagFields}
+
+            # Get the Photos and populate the Album. The tag cursor is advanced
+            # alongside the file cursor, collecting the tags of each file.
+            tagCur = con.execute(tqry)
+            tagRow = next(tagCur, None)
             fileCur = con.execute(qry)
-            k = 0
             for row in fileCur:
-                k += 1
-                directory = row[0]
-                fname = row[1]
-                date = row[2]
-                hsh = row[3]
-                data = row[4]
-                fileId = row[5]
-                tagged = bool(row[6])
-                insertDate = row[7]
-                fp = BytesIO(data)
-
-                # Create the QPixmap from the byte array
-                pix = QtGui.QPixmap()
-                pix.loadFromData(fp.getvalue())
-                thumb = QtGui.QIcon(pix)
-
-                # Create the values list based on the order of fields
-                def updateValues(values, name, val):
-                    values[fields.index(name)] = val
+                fileId = row[4]
 
+                # Create the values list based on the order of fields.
+                # Thumbnails are not loaded here; they are fetched by file id
+                # when they are shown (see thumbnail()).
                 values = ['' for _ in fields]
-                updateValues(values, 'Directory', directory)
-                updateValues(values, 'File Name', fname)
-                updateValues(values, 'Date', date)
-                updateValues(values, 'Hash', str(hsh))
-                updateValues(values, 'FileId', fileId)
-                updateValues(values, 'Tagged', tagged)
-                updateValues(values, 'Import Date', insertDate)
-
-                for fieldName in tagFields:
-                    # Get the tags and group with their fields
-                    cur2.execute(tqry, [fileId, fieldName])
-                    tagList = cur2.fetchall()
-                    tags = '; '.join([t[0] for t in tagList])
-                    updateValues(values, fieldName, tags)
-
-                album.append(Photo(fields, values, thumb))
+                fileValues = (row[0], row[1], row[2], str(row[3]), fileId,
+                              bool(row[5]), row[6])
+                for col, val in zip(fileCols, fileValues):
+                    values[col] = val
+
+                # Skip mappings to files that no longer exist, then gather the
+                # tags of this file grouped by field
+                while tagRow is not None and tagRow[0] < fileId:
+                    tagRow = next(tagCur, None)
+                tags = {}
+                while tagRow is not None and tagRow[0] == fileId:
+                    tags.setdefault(tagRow[1], []).append(tagRow[2])
+                    tagRow = next(tagCur, None)
+                for fieldName, tagList in tags.iteritems():
+                    values[tagCols[fieldName]] = '; '.join(tagList)
+
+                album.append(Photo(fields, values))
 
         return True, album
 
@@ -469,14 +704,15 @@ class PhotoDatabase(QtCore.QObject):
         with self.connect() as con:
             con.executemany(q, vals)
             tag, field = con.execute(fq, (tagId,)).fetchone()
+        self.tagIndex.add(tagId, fileIds)
 
         # Update the table view
-        for photo in self.album:
-            if (photo.fileId in fileIds and
-                    tag.lower() not in photo[field].lower()):
-                photo[field] = photo[field] + '; ' + tag
+        for fileId in fileIds:
+            photo = self.album[self.album.rowByFileId(fileId)]
+            if photo.addTag(field, tag):
+                self.tokenIndex.update(photo)
 
-        self.databaseChanged.emit()
+        self._notify(DatabaseChange.TagsMapped, fileIds, [tagId])
 
     def nextDefaultField(self):
         """ Return the next numbered default field name """
@@ -492,10 +728,15 @@ class PhotoDatabase(QtCore.QObject):
         if not st:
             return st, album
         self.album = album
-        self._dbfile = dbfile
-        self.sigNewDatabase.emit()
+        self.setDatabaseFile(dbfile)
         return True, ''
 
+    def pendingOrientationChecks(self):
+        """ Return the number of photos waiting for checkOrientations """
+        with self.connect() as con:
+            q = 'SELECT count(*) FROM OrientationCheck'
+            return con.execute(q).fetchone()[0]
+
     def pop(self, idx):
         filId = self.album[idx].fileId
         self.deleteFile(filId)
@@ -512,18 +753,15 @@ class PhotoDatabase(QtCore.QObject):
         # Update the database
         with self.connect() as con:
             con.executemany(q, params)
-        self.databaseChanged.emit()
 
         # Update the photo objects
-        updateDict = {Id: os.path.split(path)[0] for path, Id in paths}
-        rowrange = None
-        for k, photo in enumerate(self.album):
-            if photo.fileId in updateDict:
-                photo.directory = updateDict[photo.fileId]
-                if rowrange is None:
-                    rowrange = [k, k]
-                else:
-                    rowrange[1] = k
+        rows = []
+        for path, Id in paths:
+            row = self.album.rowByFileId(Id)
+            self.album[row].directory = os.path.split(path)[0]
+            rows.append(row)
+        self._notify(DatabaseChange.FilesChanged, [k[1] for k in paths])
+        rowrange = [min(rows), max(rows)] if rows else None
         col = self.album.field_names.index(self.album.directoryField)
         return col, rowrange
 
@@ -533,6 +771,9 @@ class PhotoDatabase(QtCore.QObject):
         Arguments:
             tagId (int): The db id of the tag to rename
             newName (str): The new tag name
+
+        Returns:
+            fileIds ([int]): The ids of the files that have the tag
         """
         # Rename the tag in the database
         q = 'SELECT Value, FieldId FROM Tags WHERE TagId == ?'
@@ -542,11 +783,87 @@ class PhotoDatabase(QtCore.QObject):
             oldName, fieldname = con.execute(q, (tagId,)).fetchone()
             field = con.execute(qf, (fieldname,)).fetchone()[0]
             con.execute(qu, (newName, tagId))
-        self.databaseChanged.emit()
 
-        # Update the photo objects
-        for photo in self.album:
-            photo[field] = photo[field].replace(oldName, newName)
+        # Update the photo objects that have the tag
+        album = self.album
+        fileIds = sorted(self.tagIndex.match([tagId]))
+        for fileId in fileIds:
+            photo = album[album.rowByFileId(fileId)]
+            if photo.replaceTag(field, oldName, newName):
+                self.tokenIndex.update(photo)
+        self._notify(DatabaseChange.TagsRenamed, fileIds, [tagId])
+        return fileIds
+
+    def reencodeThumbnails(self, fmt=None, quality=None, progress=None,
+                           con=None):
+        """ Re-encode the stored thumbnails and compact the database file
+
+        Each thumbnail is decoded and encoded again in the given format, and
+        replaced only if the new encoding is smaller. The work is committed in
+        chunks, so stopping part way leaves a valid database. If it is stopped,
+        the file is not compacted.
+
+        The work is done on a connection of its own, not the shared writer,
+        so it may be run in a thread (see ThumbnailReencoder). Compacting can
+        be stopped with the connection's interrupt method.
+
+        Arguments:
+            fmt (str): (None) The new format. Defaults to thumbnailFormat
+            quality (int): (None) The new quality. Defaults to
+                thumbnailQuality
+            progress (callable): (None) Called with (done, total) after each
+                chunk. If it returns False, re-encoding stops.
+            con (sqlite3.Connection): (None) The connection to use. Defaults
+                to a new connection to the open database.
+
+        Returns:
+            thumbBytes (tuple): The total size of the thumbnails before and
+                after
+            fileBytes (tuple): The size of the database file before and after
+        """
+        if con is None:
+            with closing(self.connect(self.dbfile)) as con:
+                return self.reencodeThumbnails(fmt, quality, progress, con)
+
+        chunkSize = 500
+        q = ('SELECT FilId, thumbnail FROM File WHERE FilId > ? '
+             'ORDER BY FilId LIMIT ?')
+        u = 'UPDATE File SET thumbnail = ? WHERE FilId == ?'
+        dbfile = con.execute('PRAGMA database_list').fetchone()[2]
+        oldFile = os.path.getsize(dbfile)
+        total = con.execute('SELECT count(*) FROM File').fetchone()[0]
+        oldThumbs = newThumbs = done = 0
+        lastId = -1
+        while True:
+            with con:
+                rows = con.execute(q, (lastId, chunkSize)).fetchall()
+                if not rows:
+                    break
+                updates = []
+                for fileId, blob in rows:
+                    if blob is None:
+                        continue
+                    data = BytesIO(blob).getvalue()
+                    oldThumbs += len(data)
+                    image = QtGui.QImage()
+                    if image.loadFromData(data):
+                        new = self.encodeImage(image, fmt, quality)
+                        if len(new) < len(data):
+                            updates.append((sqlite3.Binary(new), fileId))
+                            data = new
+                    newThumbs += len(data)
+                con.executemany(u, updates)
+            lastId = rows[-1][0]
+            done += len(rows)
+            if progress is not None and progress(done, total) is False:
+                return ((oldThumbs, newThumbs),
+                        (oldFile, os.path.getsize(dbfile)))
+
+        # Give the freed pages back to the file system
+        con.execute('VACUUM')
+        con.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        newFile = os.path.getsize(dbfile)
+        return (oldThumbs, newThumbs), (oldFile, newFile)
 
     def setFields(self, fields):
         """ Set the fields table to the given FieldContainerObjects
@@ -587,7 +904,7 @@ class PhotoDatabase(QtCore.QObject):
                 dcommands.append((f,))
             if dcommands:
                 con.executemany('DELETE FROM Fields WHERE Name = ?', dcommands)
-        self.databaseChanged.emit()
+        self._notify(DatabaseChange.FieldsChanged)
 
     def tagsByField(self, fieldId):
         """ Return a list of tag names for the given field ID
@@ -611,6 +928,16 @@ class PhotoDatabase(QtCore.QObject):
             res = con.execute(q, (fileId,))
             return [k[0] for k in res]
 
+    def fieldNameById(self, fieldId):
+        """ Return the name of the field with the given ID
+
+        Arguments:
+            fieldId (int): The db id of the field
+        """
+        q = 'SELECT Name FROM Fields WHERE FieldId == ?'
+        with self.connect() as con:
+            return con.execute(q, (fieldId,)).fetchone()[0]
+
     def tagById(self, tagId):
         """ Return the tag name and field ID for the given tag ID
 
@@ -626,12 +953,36 @@ class PhotoDatabase(QtCore.QObject):
 
         Arguments:
             fileId (int): The file id to set the thumbnail
-            thumb (QIcon): The thumbnail saved in the Photo object
+            thumb (QIcon): The new thumbnail
         """
         blob = self.icon2Blob(thumb)
         q = 'UPDATE File SET thumbnail = ? WHERE FilId == ?'
         with self.connect() as con:
             con.execute(q, (blob, fileId))
+        self.thumbCache.insert(fileId, thumb)
+
+    def thumbnail(self, fileId):
+        """ Return the thumbnail icon for the given file id
+
+        The thumbnail is read from the database and decoded the first time it
+        is requested, then kept in the thumbnail cache.
+
+        Arguments:
+            fileId (int): The database file id
+        """
+        icon = self.thumbCache.get(fileId)
+        if icon is not None or self.dbfile is None:
+            return icon
+        q = 'SELECT thumbnail FROM File WHERE FilId == ?'
+        with self.connect() as con:
+            row = con.execute(q, (fileId,)).fetchone()
+        if row is None or row[0] is None:
+            return
+        pix = QtGui.QPixmap()
+        pix.loadFromData(BytesIO(row[0]).getvalue())
+        icon = QtGui.QIcon(pix)
+        self.thumbCache.insert(fileId, icon)
+        return icon
 
     def updateAppData(self, **kwargs):
         """ Save database-specific settings
@@ -658,96 +1009,133 @@ class PhotoDatabase(QtCore.QObject):
         """
         # Setup variables
         album = self.album
-        allFiles = [k.fileId for k in album]
-
-        # Set up batch queries
-        taggedUpdate = {'ids': [], 'vals': []}
-        tags2insert = []
-        mapParams1 = []
-
-        delMapQ = "DELETE From TagMap WHERE FilId == ? AND "+\
-                  "(SELECT FieldId FROM Tags as t "+\
-                  "WHERE t.TagId == TagMap.TagId) == ? AND "+\
-                  "(SELECT lower(Value) FROM Tags as t WHERE "+\
-                  "t.TagId == TagMap.TagId) "+\
-                  "NOT IN ({})"
-        delMaps = []
-
-        # Current fields and tags
-        with self.connect() as con:
-            # Get the tag fields to update as dict by Name and ID
-            fieldstr = ','.join([str('\''+k+'\'') for k in fieldnames])
-            catQ = 'SELECT Name, FieldId from TagFields WHERE Name in (%s)' % fieldstr
+        fileIds = list(fileIds)
+
+        # The photos have already been changed. Update the search index.
+        if any(getattr(self.fields[k], 'filter', False) for k in fieldnames):
+            fields = self.tokenIndex.filterFields()
+            for fileId in fileIds:
+                photo = album[album.rowByFileId(fileId)]
+                self.tokenIndex.update(photo, fields)
+
+        # The tagged status, new tags and mappings are reported as one change
+        with self.batch():
+            if album.taggedField in fieldnames:
+                # Handle the "tagged" checkboxes
+                field = album.taggedField
+                tagged = [1 if album[album.rowByFileId(k)][field] else 0
+                          for k in fileIds]
+                self.updateTagged(fileIds, tagged)
+            self._updateTagMaps(fileIds, fieldnames)
+
+    def _updateTagMaps(self, fileIds, fieldnames):
+        """ Make the tag mappings of the given files match their photos
+
+        Helper for updateDatabase. The mappings the photos should have are
+        compared with those in the database as sets, and only the differences
+        are written, in one transaction.
 
-            res = con.execute(catQ).fetchall()
-            allCatDict = dict(res)
-            catIds = allCatDict.values()
-
-            # Get all tags for each FileId and category to update
-            catstr = ','.join([str(k) for k in catIds])
-            tagQ = 'SELECT FieldId, TagId, Value FROM Tags WHERE FieldId IN (%s)' % catstr
-            alltags_before = con.execute(tagQ).fetchall()
-
-        # Loop over each file and field and prepare for parameters for db query
-        for fileId in fileIds:
-            for field in fieldnames:
-                # Get the current Photo object
-                row = allFiles.index(fileId)
-                photo = album[row]
-                # Tag or checkbox?
-                if field == album.taggedField:
-                    # Handle the "tagged" checkboxes
-                    taggedUpdate['vals'].append(1 if photo[field] else 0)
-                    taggedUpdate['ids'].append(fileId)
-                else:
-                    # Handle the tag categories
-                    # Skip any field that isn't a tag category
-                    if field not in allCatDict:
-                        # Not a "category" field
-                        continue
-                    catId = allCatDict[field]
-
-                    # Get the current tags, including changes, from the dataset
-                    cur_tags = photo.tags(field)
-                    existing = {k[2].lower(): k[1] for k in alltags_before
-                                if k[0] == catId}
-                    # For each tag determine if it exists altogether and insert
-                    # the tag-to-file mapping
-                    for tag in cur_tags:
-                        if tag.strip() == '':
-                            continue
-                        cat_tag = (catId, tag)
-                        if (tag.lower() not in existing and
-                                cat_tag not in tags2insert):
-                            # INSERT new tag
-                            tags2insert.append(cat_tag)
-                        # Store the mapping. We don't care if the mapping
-                        # exists, the query will ignore duplicates.
-                        mapParams1.append((fileId, (catId, tag.lower())))
-
-                    # Set up to remove deleted tags in this category and file
-                    params = ','.join(['?'] * len(cur_tags))
-                    q = delMapQ.format(params)
-                    delMaps.append((q, [fileId, catId] +
-                                    [k.lower() for k in cur_tags]))
-
-        # Update the tagged status and insert the new tags
-        self.updateTagged(taggedUpdate['ids'], taggedUpdate['vals'])
-        self.insertTags(tags2insert)
-        # Map the tags to files and delete removed mappings
+        Arguments:
+            fileIds ([int]): The database file ids of the changed files
+            fieldnames ([str]): The names of the changed fields
+        """
+        album = self.album
+        newIds = []
+        added = set()
+        removed = set()
         with self.connect() as con:
-            # Get the TagIds for the tag mappings
-            alltags_added = con.execute(tagQ).fetchall()
-            tagIds = {(k[0], k[2].lower()): k[1] for k in alltags_added}
-            mapParams = [(k[0], tagIds[k[1]]) for k in mapParams1]
-
-            # Insert Tag mapping (ON CONFLICT IGNORE)
-            tagMapQ = 'INSERT OR IGNORE INTO TagMap (FilId, TagId) VALUES (?,?)'
-            con.executemany(tagMapQ, mapParams)
-
-            # Delete removed tags
-            for q, params in delMaps:
-                con.execute(q, params)
+            # Get the tag fields to update by Name
+            params = ','.join(['?']*len(fieldnames))
+            catQ = 'SELECT Name, FieldId FROM TagFields WHERE Name IN ({})'
+            catIds = dict(con.execute(catQ.format(params), list(fieldnames)))
+            if not catIds:
+                self._notify(DatabaseChange.FilesChanged, fileIds)
+                return
+            catParams = ','.join(['?']*len(catIds))
+
+            # Get the existing tags by field and lower case value. Tags are
+            # unique without regard to case within a field.
+            tagQ = 'SELECT FieldId, Value, TagId FROM Tags WHERE FieldId IN ({})'
+            tagQ = tagQ.format(catParams)
+            tagIds = {(k[0], k[1].lower()): k[2]
+                      for k in con.execute(tagQ, catIds.values())}
+
+            # The (file, field, lower case tag) mappings the photos should
+            # have, and the first spelling of each tag that is new
+            wanted = set()
+            newTags = {}
+            for fileId in fileIds:
+                photo = album[album.rowByFileId(fileId)]
+                for name, catId in catIds.iteritems():
+                    for tag in photo.tags(name):
+                        tag = tag.strip()
+                        if not tag:
+                            continue
+                        key = (catId, tag.lower())
+                        wanted.add((fileId, key))
+                        if key not in tagIds and key not in newTags:
+                            newTags[key] = tag
+
+            # Insert the new tags and look up their ids
+            if newTags:
+                seqQ = 'SELECT seq FROM sqlite_sequence WHERE name == "Tags"'
+                seq = con.execute(seqQ).fetchone()
+                seq = seq[0] if seq else 0
+                q = 'INSERT INTO Tags (FieldId, Value) VALUES (?,?)'
+                con.executemany(q, [(k[0], v) for k, v in newTags.iteritems()])
+                q = 'SELECT FieldId, Value, TagId FROM Tags WHERE TagId > ?'
+                for catId, value, tagId in con.execute(q, (seq,)):
+                    tagIds[(catId, value.lower())] = tagId
+                    newIds.append(tagId)
+            wanted = set((fileId, tagIds[key]) for fileId, key in wanted)
+
+            # Get the current mappings of the files in the changed fields by
+            # joining with a temporary table of the file ids. The table is
+            # created with the connection (see ConnectionManager.writerSetup).
+            con.execute('DELETE FROM temp.UpdateFiles')
+            con.executemany('INSERT OR IGNORE INTO temp.UpdateFiles '
+                            'VALUES (?)', [(k,) for k in fileIds])
+            curQ = ('SELECT m.FilId, m.TagId FROM temp.UpdateFiles AS u '
+                    'JOIN TagMap AS m ON m.FilId == u.FilId '
+                    'JOIN Tags AS t ON t.TagId == m.TagId '
+                    'WHERE t.FieldId IN ({})'.format(catParams))
+            current = set(con.execute(curQ, catIds.values()))
+            con.execute('DELETE FROM temp.UpdateFiles')
+
+            # Apply the differences
+            added = wanted - current
+            removed = current - wanted
+            if added:
+                q = 'INSERT INTO TagMap (FilId, TagId) VALUES (?,?)'
+                con.executemany(q, added)
+            if removed:
+                q = 'DELETE FROM TagMap WHERE FilId == ? AND TagId == ?'
+                con.executemany(q, removed)
+
+        # Update the tag index with the differences
+        for mappings, method in [(added, self.tagIndex.add),
+                                 (removed, self.tagIndex.remove)]:
+            files = {}
+            for fileId, tagId in mappings:
+                files.setdefault(tagId, []).append(fileId)
+            for tagId, fileList in files.iteritems():
+                method(tagId, fileList)
+
+        changed = set(k[1] for k in added | removed)
+        kind = DatabaseChange.FilesChanged
+        if newIds:
+            kind |= DatabaseChange.TagsInserted
+        if changed:
+            kind |= DatabaseChange.TagsMapped
+        self._notify(kind, fileIds, changed | set(newIds))
+
+    def buildTagIndex(self):
+        """ Rebuild the tag index from the tag mappings in the database """
+        con = self.connect()
+        if con is None:
+            self.tagIndex.clear()
+            return
+        self.tagIndex.build(con.execute('SELECT FilId, TagId FROM TagMap'))
 
     def updateTagged(self, FileIds, tagged):
         """ Update the tagged status for the given files. Return the rowcount
@@ -786,6 +1174,15 @@ class PhotoDatabase(QtCore.QObject):
     def __len__(self):
         return len(self.album._entries)
 
+    @property
+    def album(self):
+        return self._album
+
+    @album.setter
+    def album(self, album):
+        self._album = album
+        self.tokenIndex.build(album)
+
     @property
     def dbfile(self):
         return self._dbfile
@@ -807,4 +1204,55 @@ class PhotoDatabase(QtCore.QObject):
 
 
 class DatabaseError(BaseException):
-    pass
+    pass
+
+
+if __name__ == "__main__":
+    import shutil
+    import tempfile
+    import unittest
+
+    class InsertTests(unittest.TestCase):
+
+        def setUp(self):
+            self.dir = tempfile.mkdtemp()
+            self.db = PhotoDatabase(os.path.join(self.dir, 'test.pdb'))
+            self.db.insertField(name=FieldObject('People', tags=True))
+
+        def tearDown(self):
+            self.db.closeDatabase()
+            shutil.rmtree(self.dir)
+
+        def photo(self, name):
+            photo = Photo(self.db.fields)
+            photo['Directory'] = self.dir
+            photo['File Name'] = name
+            return photo
+
+        def test_insertFiles(self):
+            photos = [self.photo('a.jpg'), self.photo('b.jpg')]
+            self.db.insertFiles(photos)
+            self.assertEqual(len(self.db.album), 2)
+            self.assertEqual(len(set(k.fileId for k in photos)), 2)
+            self.assertEqual(self.db.album.rowByFileId(photos[1].fileId), 1)
+
+        def test_reinsertTagged(self):
+            # Undo of a delete re-inserts the photo with its tags, which
+            # must be found whatever their case
+            photo = self.photo('a.jpg')
+            self.db.insertFiles([photo])
+            fileId = photo.fileId
+            photo['People'] = u'\xc9cole; Ann'
+            self.db.updateDatabase([fileId], ['People'])
+            tagIds = sorted(self.db.tagsByFileId(fileId))
+            self.assertEqual(len(tagIds), 2)
+
+            self.db.deleteFile(fileId)
+            self.assertEqual(self.db.tagsByFileId(fileId), [])
+            self.db.insertFiles([photo])
+            self.assertEqual(photo.fileId, fileId)
+            self.assertEqual(sorted(self.db.tagsByFileId(fileId)), tagIds)
+            self.assertEqual(self.db.tagIndex.tags(fileId), set(tagIds))
+
+    app = QtGui.QApplication([])
+    unittest.main()
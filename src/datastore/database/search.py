@@ -0,0 +1,363 @@
+""" Indexes for searching the photos of the album """
+import binascii
+import re
+
+
+class TokenIndex(object):
+    """ An inverted index from the words in the searchable fields to file ids
+
+    The values of the album's filter fields (eg. file name and tags) are
+    split into words of letters, digits and underscores. Each word maps to the
+    set of file ids of the photos that contain it. A search for a plain word
+    is then a scan of the distinct words rather than of every photo.
+
+    Since any occurrence of a plain word lies within a single word of the
+    value, search returns exactly the photos whose value contains the word,
+    as a case-insensitive regular expression search would.
+
+    The index must be told when photos are added, removed or changed. Each
+    change increments version so that users can tell when their results are
+    stale.
+    """
+
+    WORD = re.compile(r'\w+', re.UNICODE)
+
+    def __init__(self):
+        self._postings = {}
+        self._tokens = {}
+        self._fields = None
+        self.version = 0
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def add(self, photo, fields=None):
+        """ Add the words of a photo to the index
+
+        Arguments:
+            photo (Photo)
+            fields ([FieldObject]): (None) The filter fields. Defaults to
+                those of the indexed album.
+        """
+        fileId = photo.fileId
+        tokens = self.tokenize(photo, fields)
+        self._tokens[fileId] = tokens
+        postings = self._postings
+        for token in tokens:
+            ids = postings.get(token)
+            if ids is None:
+                postings[token] = set([fileId])
+            else:
+                ids.add(fileId)
+        self.version += 1
+
+    def build(self, album):
+        """ Rebuild the index from all of the photos of the album
+
+        Arguments:
+            album (Album)
+        """
+        self.clear()
+        self._fields = album.fields
+        fields = self.filterFields()
+        for photo in album:
+            self.add(photo, fields)
+
+    def clear(self):
+        """ Remove all photos from the index """
+        self._postings = {}
+        self._tokens = {}
+        self.version += 1
+
+    def filterFields(self):
+        """ Return the fields of the indexed album that are searched """
+        return [k for k in self._fields or () if k.filter]
+
+    def isPlain(self, word):
+        """ Return whether word can be searched for in the index
+
+        Arguments:
+            word (str)
+        """
+        match = self.WORD.match(word)
+        return match is not None and match.end() == len(word)
+
+    def remove(self, fileId):
+        """ Remove a photo from the index
+
+        Arguments:
+            fileId (int): The database file id of the photo
+        """
+        for token in self._tokens.pop(fileId, ()):
+            ids = self._postings[token]
+            ids.discard(fileId)
+            if not ids:
+                del self._postings[token]
+        self.version += 1
+
+    def search(self, word):
+        """ Return the set of file ids of photos that contain word
+
+        Arguments:
+            word (str): A plain word (see isPlain)
+        """
+        word = word.lower()
+        ids = self._postings.get(word)
+        out = set(ids) if ids else set()
+        for token, ids in self._postings.iteritems():
+            if word in token and token != word:
+                out |= ids
+        return out
+
+    def tokenize(self, photo, fields=None):
+        """ Return the words in the filter fields of the photo
+
+        Arguments:
+            photo (Photo)
+            fields ([FieldObject]): (None) The filter fields. Defaults to
+                those of the indexed album.
+        """
+        if fields is None:
+            fields = self.filterFields()
+        tokens = set()
+        findall = self.WORD.findall
+        for field in fields:
+            value = photo.get(field)
+            if isinstance(value, basestring):
+                tokens.update(findall(value.lower()))
+        return tuple(tokens)
+
+    def update(self, photo, fields=None):
+        """ Re-index a photo whose values have changed
+
+        Arguments:
+            photo (Photo)
+            fields ([FieldObject]): (None) The filter fields. Defaults to
+                those of the indexed album.
+        """
+        self.remove(photo.fileId)
+        self.add(photo, fields)
+
+
+class TagIndex(object):
+    """ Bitsets of the photos mapped to each tag
+
+    Each tag has a python int in which bit n is set if the photo with file id
+    n has the tag. The photos that have all of several tags are found by
+    and-ing their bitsets. Tags are matched exactly, by database id, rather
+    than by searching the photos' tag strings.
+
+    The index must be told when mappings are added or removed. Each change
+    increments version so that users can tell when their results are stale.
+    """
+
+    def __init__(self):
+        self._bits = {}
+        self._fileTags = {}
+        self.version = 0
+
+    def add(self, tagId, fileIds):
+        """ Map a tag to photos
+
+        Arguments:
+            tagId (int): The database tag id
+            fileIds ([int]): The file ids of the photos
+        """
+        bits = self._bits.get(tagId, 0)
+        for fileId in fileIds:
+            bits |= 1 << fileId
+            self._fileTags.setdefault(fileId, set()).add(tagId)
+        self._bits[tagId] = bits
+        self.version += 1
+
+    def build(self, mappings):
+        """ Rebuild the index from (file id, tag id) pairs
+
+        Arguments:
+            mappings (iterable): (FilId, TagId) rows of the TagMap table
+        """
+        self.clear()
+        tagFiles = {}
+        for fileId, tagId in mappings:
+            tagFiles.setdefault(tagId, []).append(fileId)
+            self._fileTags.setdefault(fileId, set()).add(tagId)
+        for tagId, fileIds in tagFiles.iteritems():
+            self._bits[tagId] = self.toBits(fileIds)
+
+    def clear(self):
+        """ Remove all mappings from the index """
+        self._bits = {}
+        self._fileTags = {}
+        self.version += 1
+
+    def match(self, tagIds):
+        """ Return the set of file ids of the photos that have all the tags
+
+        Arguments:
+            tagIds ([int]): The database tag ids
+        """
+        bits = None
+        for tagId in tagIds:
+            tagBits = self._bits.get(tagId, 0)
+            bits = tagBits if bits is None else bits & tagBits
+            if not bits:
+                return set()
+        return self.fromBits(bits or 0)
+
+    def remove(self, tagId, fileIds):
+        """ Remove a tag from photos
+
+        Arguments:
+            tagId (int): The database tag id
+            fileIds ([int]): The file ids of the photos
+        """
+        bits = self._bits.get(tagId, 0)
+        for fileId in fileIds:
+            bits &= ~(1 << fileId)
+            self._fileTags.get(fileId, set()).discard(tagId)
+        if bits:
+            self._bits[tagId] = bits
+        else:
+            self._bits.pop(tagId, None)
+        self.version += 1
+
+    def removeFile(self, fileId):
+        """ Remove all of a photo's tags
+
+        Arguments:
+            fileId (int): The database file id
+        """
+        self.setFileTags(fileId, ())
+
+    def removeTag(self, tagId):
+        """ Remove a tag from all photos
+
+        Arguments:
+            tagId (int): The database tag id
+        """
+        fileIds = self.fromBits(self._bits.get(tagId, 0))
+        self.remove(tagId, fileIds)
+
+    def setFileTags(self, fileId, tagIds):
+        """ Set the tags of a photo, replacing any it had
+
+        Arguments:
+            fileId (int): The database file id
+            tagIds ([int]): The database tag ids
+        """
+        old = self._fileTags.get(fileId, set())
+        new = set(tagIds)
+        for tagId in old - new:
+            self.remove(tagId, [fileId])
+        for tagId in new - old:
+            self.add(tagId, [fileId])
+        if not new:
+            self._fileTags.pop(fileId, None)
+
+    def tags(self, fileId):
+        """ Return the set of tag ids of a photo
+
+        Arguments:
+            fileId (int): The database file id
+        """
+        return set(self._fileTags.get(fileId, ()))
+
+    @staticmethod
+    def fromBits(bits):
+        """ Return the set of the positions of the set bits of an int """
+        # Least significant bit first
+        digits = bin(bits)[:1:-1]
+        out = set()
+        dex = digits.find('1')
+        while dex != -1:
+            out.add(dex)
+            dex = digits.find('1', dex + 1)
+        return out
+
+    @staticmethod
+    def toBits(positions):
+        """ Return an int with the bits at the given positions set """
+        if not positions:
+            return 0
+        buff = bytearray(max(positions) // 8 + 1)
+        for k in positions:
+            buff[k >> 3] |= 1 << (k & 7)
+        buff.reverse()
+        return int(binascii.hexlify(buff), 16)
+
+
+if __name__ == "__main__":
+    import unittest
+
+    class TagIndexTests(unittest.TestCase):
+
+        def setUp(self):
+            self.index = TagIndex()
+            self.index.build([(1, 10), (2, 10), (2, 11), (300, 11), (3, 12)])
+
+        def test_bits(self):
+            ids = [0, 5, 8, 1000]
+            self.assertEqual(TagIndex.fromBits(TagIndex.toBits(ids)), set(ids))
+            self.assertEqual(TagIndex.fromBits(0), set())
+
+        def test_match(self):
+            self.assertEqual(self.index.match([10]), set([1, 2]))
+            self.assertEqual(self.index.match([10, 11]), set([2]))
+            self.assertEqual(self.index.match([10, 12]), set())
+            self.assertEqual(self.index.match([99]), set())
+
+        def test_changes(self):
+            self.index.add(12, [300])
+            self.assertEqual(self.index.match([11, 12]), set([300]))
+            self.index.removeTag(11)
+            self.assertEqual(self.index.match([11]), set())
+            self.assertEqual(self.index.tags(2), set([10]))
+            self.index.setFileTags(2, [12])
+            self.assertEqual(self.index.match([12]), set([2, 3, 300]))
+            self.index.removeFile(3)
+            self.assertEqual(self.index.match([12]), set([2, 300]))
+
+    class TokenIndexTests(unittest.TestCase):
+
+        class Field(object):
+            def __init__(self, name, filt):
+                self.name = name
+                self.filter = filt
+
+        class Photo(dict):
+            @property
+            def fileId(self):
+                return self['id']
+
+        def setUp(self):
+            name = self.Field('File Name', True)
+            directory = self.Field('Directory', False)
+            self.photos = [self.Photo({'id': 1, name: u'IMG_001.jpg',
+                                       directory: u'C:\\cats'}),
+                           self.Photo({'id': 2, name: u'Cat-Nap.png',
+                                       directory: u'C:\\dogs'})]
+            self.album = type('Album', (list,), {})(self.photos)
+            self.album.fields = [name, directory]
+            self.index = TokenIndex()
+            self.index.build(self.album)
+
+        def test_search(self):
+            self.assertEqual(self.index.search('img'), set([1]))
+            self.assertEqual(self.index.search('G_0'), set([1]))
+            self.assertEqual(self.index.search('cat'), set([2]))
+            self.assertEqual(self.index.search('dogs'), set())
+
+        def test_isPlain(self):
+            self.assertTrue(self.index.isPlain('img_001'))
+            self.assertFalse(self.index.isPlain('img.*'))
+            self.assertFalse(self.index.isPlain('new york'))
+
+        def test_update(self):
+            self.photos[0][self.album.fields[0]] = u'dog.jpg'
+            self.index.update(self.photos[0])
+            self.assertEqual(self.index.search('img'), set())
+            self.assertEqual(self.index.search('dog'), set([1]))
+            self.index.remove(2)
+            self.assertEqual(self.index.search('cat'), set())
+
+    unittest.main()
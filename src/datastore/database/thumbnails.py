@@ -0,0 +1,261 @@
+""" Caching and remaking the thumbnails of the photo database """
+from collections import OrderedDict
+from contextlib import closing
+import sqlite3
+from threading import Event as thread_Event
+
+
+class ThumbnailCache(object):
+    """ A least-recently-used cache of thumbnail icons keyed by file id
+
+    Thumbnails are stored in the database as encoded images and decoded only
+    when they are needed for display. The cache holds the decoded icons until
+    the total size of their pixmaps exceeds the byte budget, at which point the
+    least recently used are discarded.
+
+    Arguments:
+        maxBytes (int): (64 MB) The byte budget for decoded pixmaps
+    """
+
+    def __init__(self, maxBytes=64*2**20):
+        self._entries = OrderedDict()
+        self._maxBytes = maxBytes
+        self._bytes = 0
+
+    def __contains__(self, fileId):
+        return fileId in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """ Remove all thumbnails from the cache """
+        self._entries.clear()
+        self._bytes = 0
+
+    def get(self, fileId):
+        """ Return the cached icon for the given file id or None
+
+        Arguments:
+            fileId (int): The database file id
+        """
+        entry = self._entries.pop(fileId, None)
+        if entry is None:
+            return
+        # Re-insert to mark as most recently used
+        self._entries[fileId] = entry
+        return entry[0]
+
+    def insert(self, fileId, icon):
+        """ Store a decoded icon in the cache
+
+        Arguments:
+            fileId (int): The database file id
+            icon (QIcon): The decoded thumbnail
+        """
+        self.remove(fileId)
+        if icon is None:
+            return
+        nbytes = self.iconBytes(icon)
+        self._entries[fileId] = (icon, nbytes)
+        self._bytes += nbytes
+        self._trim()
+
+    def remove(self, fileId):
+        """ Remove the icon for the given file id from the cache
+
+        Arguments:
+            fileId (int): The database file id
+        """
+        entry = self._entries.pop(fileId, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+    def retain(self, fileIds):
+        """ Evict all icons except those for the given file ids
+
+        Arguments:
+            fileIds (iterable): The file ids whose icons should be kept
+        """
+        keep = set(fileIds)
+        for fileId in [k for k in self._entries if k not in keep]:
+            self.remove(fileId)
+
+    def setMaxBytes(self, maxBytes):
+        """ Set the byte budget of the cache, evicting icons as needed
+
+        Arguments:
+            maxBytes (int)
+        """
+        self._maxBytes = maxBytes
+        self._trim()
+
+    def _trim(self):
+        """ Evict the least recently used icons until within budget """
+        while self._bytes > self._maxBytes and len(self._entries) > 1:
+            fileId, entry = self._entries.popitem(last=False)
+            self._bytes -= entry[1]
+
+    @staticmethod
+    def iconBytes(icon):
+        """ Return the approximate size, in bytes, of the icon's pixmaps
+
+        Arguments:
+            icon (QIcon)
+        """
+        nbytes = 0
+        for size in icon.availableSizes():
+            pix = icon.pixmap(size)
+            nbytes += pix.width() * pix.height() * pix.depth() / 8
+        return nbytes
+
+    @property
+    def maxBytes(self):
+        return self._maxBytes
+
+    @property
+    def nbytes(self):
+        return self._bytes
+
+
+class ThumbnailReencoder(object):
+    """ Re-encodes the stored thumbnails and compacts the database file
+
+    The work method is intended to be run in a thread by a ProgressDialog.
+    It runs PhotoDatabase.reencodeThumbnails on a connection of its own, so
+    the GUI stays responsive. Canceling stops the re-encoding after the
+    current chunk, and the file is then not compacted. Canceling while the
+    file is being compacted interrupts it, which leaves the file as it was.
+
+    Arguments:
+        db (PhotoDatabase): The open database
+        fmt (str): (None) The new format. Defaults to the database's
+            thumbnailFormat
+        quality (int): (None) The new quality. Defaults to the database's
+            thumbnailQuality
+    """
+
+    def __init__(self, db, fmt=None, quality=None):
+        self.db = db
+        self.dbfile = db.dbfile
+        self.fmt = fmt
+        self.quality = quality
+
+        # Initialize Status
+        self.active = thread_Event()
+        self.cancelEvent = thread_Event()
+        self.status = ''
+        self.progress = 0
+        # (thumbBytes, fileBytes) as returned by reencodeThumbnails, once
+        # finished
+        self.results = None
+        self._con = None
+        self._compacting = False
+
+    def work(self):
+        """ Re-encode the thumbnails
+
+        Sets the status and progress properties, and results when finished
+        """
+        self.active.set()
+        self.status = 'Re-encoding thumbnails'
+        stopped = 'Stopped. The file was not compacted.'
+        try:
+            with closing(self.db.connect(self.dbfile)) as con:
+                self._con = con
+                self.results = self.db.reencodeThumbnails(
+                    self.fmt, self.quality, self.update, con)
+            if self.cancelEvent.isSet() and not self._compacting:
+                self.status = stopped
+            else:
+                self.status = 'Finished'
+        except sqlite3.OperationalError:
+            # Compacting was interrupted
+            if not self.cancelEvent.isSet():
+                raise
+            self.status = stopped
+        finally:
+            self._con = None
+            self.progress = 100
+            self.active.clear()
+
+    def update(self, done, total):
+        """ Record the progress. Return False to stop the re-encoding.
+
+        Arguments:
+            done (int): The number of thumbnails processed
+            total (int): The number of thumbnails
+        """
+        self.progress = done * 100 / max(total, 1)
+        if done >= total:
+            self._compacting = True
+            self.status = 'Compacting the database file'
+        else:
+            self.status = 'Re-encoding thumbnails: {} of {}'.format(done,
+                                                                    total)
+        return not self.cancelEvent.isSet()
+
+    def cancel(self):
+        """ Cancel the process """
+        self.cancelEvent.set()
+        con = self._con
+        if self._compacting and con is not None:
+            con.interrupt()
+
+
+class OrientationChecker(object):
+    """ Makes the photos imported before 0.6 agree with the EXIF orientation
+
+    The work method is intended to be run in a thread by a ProgressDialog.
+    It runs PhotoDatabase.checkOrientations on a connection of its own.
+    Canceling stops it after the current photo. The photos not yet checked
+    stay listed for another time.
+
+    Arguments:
+        db (PhotoDatabase): The open database
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.dbfile = db.dbfile
+
+        # Initialize Status
+        self.active = thread_Event()
+        self.cancelEvent = thread_Event()
+        self.status = ''
+        self.progress = 0
+        # (reset, remade) as returned by checkOrientations, once finished
+        self.results = None
+
+    def work(self):
+        """ Check the orientations
+
+        Sets the status and progress properties, and results when finished
+        """
+        self.active.set()
+        self.status = 'Checking orientations'
+        try:
+            with closing(self.db.connect(self.dbfile)) as con:
+                self.results = self.db.checkOrientations(self.update, con)
+            if self.cancelEvent.isSet():
+                self.status = 'Stopped'
+            else:
+                self.status = 'Finished'
+        finally:
+            self.progress = 100
+            self.active.clear()
+
+    def update(self, done, total):
+        """ Record the progress. Return False to stop checking.
+
+        Arguments:
+            done (int): The number of photos checked
+            total (int): The number of photos to check
+        """
+        self.progress = done * 100 / max(total, 1)
+        self.status = 'Checking orientations: {} of {}'.format(done, total)
+        return not self.cancelEvent.isSet()
+
+    def cancel(self):
+        """ Cancel the process """
+        self.cancelEvent.set()
@@ -1,7 +1,6 @@
 import sqlite3
-from utl import compareRelease, compareMinor
-from shared import __release__
-from converters import _convert03to05
+from utl import compareMinor
+from converters import _convert03to05, _convert05to06
 
 
 def convertCheck(dbfile):
@@ -24,7 +23,7 @@ def convertCheck(dbfile):
 
     if compareMinor(fileVersion, '0.3') < 0:
         return False, None, fileVersion
-    if compareMinor(fileVersion, '0.5') < 0:
+    if compareMinor(fileVersion, '0.6') < 0:
         return True, True, fileVersion
     return True, False, fileVersion
 
@@ -33,14 +32,66 @@ def convertVersion(dbfile):
     """ Sort out which converter to use and call it
 
     Returns a tuple with the respective indexes corresponding to "success" and
-    a message.
+    a message. Converters are applied in order, starting with the first one
+    newer than the file.
     """
     ver = convertCheck(dbfile)[2]
-    if (compareRelease(ver, '0.3') >= 0 and
-            compareRelease(__release__, '0.5') >= 0):
-        return _convert03to05(dbfile)
+    converters = [('0.5', _convert03to05), ('0.6', _convert05to06)]
+    msgs = []
+    for minor, converter in converters:
+        if compareMinor(ver, minor) < 0:
+            st, msg = converter(dbfile)
+            if not st:
+                return st, msg
+            msgs.append(msg)
+    return True, '\n'.join(msgs)
 
 
 if __name__ == "__main__":
-    dbfile = r'C:\Users\Luke\Files\Python\workspace\PicOrganizer\ConvertMe.pdb'
-    convertVersion(dbfile)
+    import os
+    import shutil
+    import tempfile
+    import unittest
+    from create_database import create_database, INDEXES
+
+    class ConvertTests(unittest.TestCase):
+
+        def setUp(self):
+            self.dir = tempfile.mkdtemp()
+            self.dbfile = os.path.join(self.dir, 'old.pdb')
+            create_database(self.dbfile)
+            # Make it look like a 0.5 file, which didn't have the indexes
+            # or the orientation check list
+            with sqlite3.connect(self.dbfile) as con:
+                for q in INDEXES:
+                    name = q.split(' ON ')[0].split()[-1]
+                    con.execute('DROP INDEX {}'.format(name))
+                con.execute('DROP TABLE sqlite_stat1')
+                con.execute('DROP TABLE OrientationCheck')
+                con.execute('INSERT INTO File (directory, filename) '
+                            'VALUES (?, ?)', (self.dir, 'missing.jpg'))
+                con.execute('UPDATE AppData SET AppFileVersion = "0.5.2"')
+
+        def tearDown(self):
+            shutil.rmtree(self.dir)
+
+        def test_check(self):
+            self.assertEqual(convertCheck(self.dbfile), (True, True, '0.5.2'))
+
+        def test_convert05to06(self):
+            st, msg = convertVersion(self.dbfile)
+            self.assertTrue(st, msg)
+            self.assertEqual(convertCheck(self.dbfile)[:2], (True, False))
+            with sqlite3.connect(self.dbfile) as con:
+                q = 'SELECT name FROM sqlite_master WHERE type == "index"'
+                names = [k[0] for k in con.execute(q)]
+                q = 'SELECT count(*) FROM sqlite_stat1'
+                self.assertTrue(con.execute(q).fetchone()[0] > 0)
+            for name in ['TagMapTagIndex', 'FilePathIndex', 'FileHashIndex']:
+                self.assertIn(name, names)
+            # The photos are listed to be checked, without touching the files
+            with sqlite3.connect(self.dbfile) as con:
+                q = 'SELECT FilId FROM OrientationCheck'
+                self.assertEqual(con.execute(q).fetchall(), [(1,)])
+
+    unittest.main()
@@ -36,7 +36,9 @@ class AlbumModel(QtCore.QAbstractTableModel):
         elif role == QtCore.Qt.DecorationRole:
             if index.column() == 0:
                 photo = self.dataset[index.row()]
-                return photo.thumb
+                if photo.thumb is not None:
+                    return photo.thumb
+                return self.dataset.thumbnail(photo.fileId)
         elif role == QtCore.Qt.TextAlignmentRole:
             return (QtCore.Qt.AlignCenter)
         else:
@@ -79,10 +81,25 @@ class AlbumModel(QtCore.QAbstractTableModel):
 
     def insertRows(self, entry, position=None, rows=0):
         """ Model required function for inserting rows """
+        return self.insertFiles([entry], position)
+
+    def insertFiles(self, photos, position=None):
+        """ Insert several photos with a single database transaction
+
+        Views are notified once for the whole range of new rows.
+
+        Arguments:
+            photos ([Photo]): The photos to insert
+            position (int): (None) The row of the first photo. Defaults to the
+                end.
+        """
+        if not photos:
+            return False
         if position is None:
             position = self.rowCount()
-        self.beginInsertRows(QtCore.QModelIndex(), position, position + rows)
-        self.dataset.insertFile(entry, position)
+        self.beginInsertRows(QtCore.QModelIndex(), position,
+                             position + len(photos) - 1)
+        self.dataset.insertFiles(photos, position)
         self.endInsertRows()
         return True
 
@@ -155,7 +172,6 @@ class AlbumModel(QtCore.QAbstractTableModel):
                 return True
             elif (role == QtCore.Qt.DecorationRole and
                   field.name == self.dataset.album.thumbField):
-                self.dataset[row].thumb = value
                 self.dataset.setThumb(self.dataset[row].fileId, value)
             self.dataChanged.emit(index, index)
         else:
@@ -242,6 +258,34 @@ class AlbumModel(QtCore.QAbstractTableModel):
 
         return old
 
+    def emitFilesChanged(self, fileIds, column):
+        """ Emit dataChanged for one column of the rows of the given files
+
+        Each run of adjacent rows is emitted as a single range so that views
+        and proxies only update the affected cells.
+
+        Arguments:
+            fileIds ([int]): The database file ids of the changed photos
+            column (int): The changed column
+        """
+        rowByFileId = self.dataset.album.rowByFileId
+        rows = sorted(rowByFileId(k) for k in fileIds)
+        start = 0
+        for k in range(1, len(rows) + 1):
+            if k == len(rows) or rows[k] != rows[k-1] + 1:
+                self.dataChanged.emit(self.index(rows[start], column),
+                                      self.index(rows[k-1], column))
+                start = k
+
+    def tagColumn(self, fieldId):
+        """ Return the column of a tag field
+
+        Arguments:
+            fieldId (int): The db id of the field
+        """
+        name = self.dataset.fieldNameById(fieldId)
+        return self.dataset.field_names.index(name)
+
     def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
         """ Model required function that returns header data information """
         if orientation == QtCore.Qt.Horizontal:
@@ -357,8 +401,151 @@ class AlbumModel(QtCore.QAbstractTableModel):
         return QtCore.QDate(date) if date else None
 
 
+class FilterPlan(object):
+    """ The compiled state of the album filter
+
+    Everything the filter needs that doesn't depend on the row is worked out
+    once, when the plan is created, so that accepts only compares the photo's
+    values. Plans aren't changed after they are created; a new plan is built
+    when the filter changes.
+
+    Patterns that are plain words are looked up in the token index, if one is
+    given, and the photos with all of tagIds are looked up in the tag index.
+    The plan keeps the file ids that match all of them, and is only valid
+    while the indexes are unchanged (see isCurrent).
+
+    Arguments:
+        patterns ([str]): Regular expressions that must each match one of the
+            filterable fields
+        filterFields ([FieldObject]): The fields searched by patterns
+        tagIds ([int]): The database ids of tags the photo must have
+        taggedField (str): The name of the tagged field
+        hideTagged (bool): (False) Whether to reject tagged photos
+        dateField (str): (None) The name of the date field. If None, dates are
+            not filtered.
+        fromDate (QDate): (None) The first (or only) date to accept
+        toDate (QDate): (None) The last date to accept, or None to accept only
+            fromDate
+        dateFilterType (int): (DayFilter) The resolution of the date filter.
+            One of AlbumSortFilterModel.YearFilter, MonthFilter or DayFilter
+        index (TokenIndex): (None) The search index of the filter fields
+        tagIndex (TagIndex): (None) The tag index. Required if tagIds are
+            given.
+    """
+
+    __slots__ = ('patterns', 'fileIds', 'versions', 'filterFields',
+                 'taggedField', 'hideTagged', 'dateField', 'dateLength',
+                 'fromDate', 'toDate')
+
+    # Splits the filter text on spaces that aren't quoted
+    TOKENS = re.compile(r'''((?:[^\s"]|"[^"]*")+)''')
+    # A stored date that can be compared by its string prefix
+    DATE = re.compile(r'\d{4}-\d\d-\d\d')
+
+    def __init__(self, patterns, filterFields, tagIds, taggedField,
+                 hideTagged=False, dateField=None, fromDate=None, toDate=None,
+                 dateFilterType=2, index=None, tagIndex=None):
+        compiled = []
+        self.fileIds = tagIndex.match(tagIds) if tagIds else None
+        self.versions = self.indexVersions(index, tagIndex)
+        for pat in patterns:
+            if index is not None and index.isPlain(pat):
+                ids = index.search(pat)
+                if self.fileIds is None:
+                    self.fileIds = ids
+                else:
+                    self.fileIds &= ids
+                continue
+            try:
+                compiled.append(re.compile(pat, re.IGNORECASE | re.UNICODE))
+            except re.error:
+                # An invalid expression doesn't match anything
+                compiled.append(None)
+        self.patterns = tuple(compiled)
+        self.filterFields = tuple(filterFields)
+        self.taggedField = taggedField
+        self.hideTagged = hideTagged
+
+        # Dates are stored as YYYY-MM-DD HH:MM:SS strings, so rounding to
+        # the year, month or day is comparing the first 4, 7 or 10 characters
+        self.dateField = dateField
+        self.dateLength = (4, 7, 10)[dateFilterType]
+        n = self.dateLength
+        self.fromDate = (str(fromDate.toString('yyyy-MM-dd'))[:n]
+                         if dateField else None)
+        self.toDate = (str(toDate.toString('yyyy-MM-dd'))[:n]
+                       if dateField and toDate is not None else None)
+
+    @classmethod
+    def splitPattern(cls, text):
+        """ Return the separate patterns in the filter text
+
+        Words are separated by spaces unless they are quoted. Quotes are
+        removed.
+
+        Arguments:
+            text (str): The filter text
+        """
+        return [k.replace('"', '') for k in cls.TOKENS.split(text)[1::2]]
+
+    @staticmethod
+    def indexVersions(index, tagIndex):
+        """ Return the versions of the given indexes (or None) """
+        return (index.version if index is not None else None,
+                tagIndex.version if tagIndex is not None else None)
+
+    def isCurrent(self, index, tagIndex):
+        """ Return whether the plan is still valid for the given indexes
+
+        Arguments:
+            index (TokenIndex)
+            tagIndex (TagIndex)
+        """
+        return self.versions == self.indexVersions(index, tagIndex)
+
+    def accepts(self, photo):
+        """ Return whether the photo passes the filter
+
+        Arguments:
+            photo (Photo)
+        """
+        # Check date range first
+        if self.dateField is not None:
+            date = photo[self.dateField]
+            if date and self.DATE.match(date):
+                date = date[:self.dateLength]
+                if self.toDate is None:
+                    if date != self.fromDate:
+                        return False
+                elif date < self.fromDate or date > self.toDate:
+                    return False
+
+        # Check the tagged field
+        if self.hideTagged and photo[self.taggedField]:
+            return False
+
+        # Check the tag list and plain words. Each pattern must match in any
+        # "filter" field
+        if self.fileIds is not None and photo.fileId not in self.fileIds:
+            return False
+        for pat in self.patterns:
+            if pat is None:
+                return False
+            for field in self.filterFields:
+                if pat.search(photo[field]):
+                    break
+            else:
+                return False
+        return True
+
+
 class AlbumSortFilterModel(QtGui.QSortFilterProxyModel):
-    """ A proxy model subclass for filtering on any column """
+    """ A proxy model subclass for filtering on any column
+
+    The filter settings are compiled into a FilterPlan when they are first
+    needed after a change. Setting the filter or invalidating the model
+    discards the plan, as does any change to the dataset's token index.
+    """
 
     YearFilter = 0
     MonthFilter = 1
@@ -372,6 +559,7 @@ class AlbumSortFilterModel(QtGui.QSortFilterProxyModel):
         self._dateBetween = True
         self._dateFilterType = self.DayFilter
         self._hideTagged = False
+        self._plan = None
 
         self.filterList = None
 
@@ -385,65 +573,59 @@ class AlbumSortFilterModel(QtGui.QSortFilterProxyModel):
             sourceRow (int): The row in question
             sourceParent (QModelIndex): The index of the row's parent.
         """
-        sourceModel = self.sourceModel()
-        # Check date range first
-        date = sourceModel.date(sourceRow)
-        if date and self._dateFilter:
-            # Round the dates to the desired resolution
-            checkDate = self.roundDate(date)
-            fromDate = self.roundDate(self.fromDate)
-            toDate = self.roundDate(self.toDate)
-
-            if self.dateBetween:
-                if checkDate < fromDate or checkDate > toDate:
-                    return False
-            else:
-                if checkDate != fromDate:
-                    return False
-
-        # Check the tagged field
-        tagged = sourceModel.dataset[sourceRow, self.taggedField]
-        if self._hideTagged and tagged:
-            return False
-
-        # Check the tag list
-        if self.filterList is not None:
-            listFilter = self.filterList.getCheckedTagDict(lower=True)
-            for fieldName, tags in listFilter.iteritems():
-                for t in tags:
-                    tagStr = sourceModel.dataset[sourceRow, fieldName]
-                    if t.lower() not in tagStr.lower():
-                        return False
+        photo = self.sourceModel().dataset[sourceRow]
+        return self.filterPlan().accepts(photo)
+
+    def filterPlan(self):
+        """ Return the FilterPlan for the current settings, creating it if
+        needed """
+        dataset = self.sourceModel().dataset
+        index = dataset.tokenIndex
+        tagIndex = dataset.tagIndex
+        if self._plan is not None and self._plan.isCurrent(index, tagIndex):
+            return self._plan
 
         # Here we want to match each word in the pattern individually. If all
         # sub-patterns match in any "filter" column, we'll accept
-
-        # Find separate pattern strings
-        pat = str(self.filterRegExp().pattern())
-
-        PATTERN = re.compile(r'''((?:[^\s"]|"[^"]*")+)''')
-        patterns = PATTERN.split(pat)[1::2]
-        if self.filterList:
-            patterns += self.filterList.getCheckedTagNames()
-        pats = [QtCore.QRegExp(k.replace('"', ''), QtCore.Qt.CaseInsensitive,
-                               QtCore.QRegExp.RegExp)
-                for k in patterns]
-
-        # Check each column for the regular expression
-        out = [False]*len(pats)
-        for k, pat in enumerate(pats):
-            for c in range(sourceModel.columnCount()):
-                # Don't filter non-filtered fields
-                if not sourceModel.dataset.fields[c].filter:
-                    continue
-
-                # Apply regex
-                index = sourceModel.index(sourceRow, c, sourceParent)
-                if index.data().toString().contains(pat):
-                    out[k] = True
-                    break
-
-        return all(out)
+        patterns = FilterPlan.splitPattern(
+            unicode(self.filterRegExp().pattern()))
+        tagIds = []
+        if self.filterList is not None:
+            tagIds = self.filterList.getCheckedTagIds()
+
+        filterFields = [k for k in dataset.fields if k.filter]
+        dateField = dataset.album.dateField if self._dateFilter else None
+        toDate = self.toDate if self.dateBetween else None
+        self._plan = FilterPlan(patterns, filterFields, tagIds,
+                                self.taggedField, self._hideTagged, dateField,
+                                self.fromDate, toDate, self.dateFilterType,
+                                index, tagIndex)
+        return self._plan
+
+    def invalidate(self):
+        """ Re-implemented to discard the filter plan """
+        self._plan = None
+        super(AlbumSortFilterModel, self).invalidate()
+
+    def invalidateFilter(self):
+        """ Re-implemented to discard the filter plan """
+        self._plan = None
+        super(AlbumSortFilterModel, self).invalidateFilter()
+
+    def setFilterRegExp(self, *args):
+        """ Re-implemented to discard the filter plan """
+        self._plan = None
+        super(AlbumSortFilterModel, self).setFilterRegExp(*args)
+
+    def setSourceModel(self, model):
+        """ Re-implemented to discard the filter plan when fields change """
+        super(AlbumSortFilterModel, self).setSourceModel(model)
+        model.columnsInserted.connect(self._discardPlan)
+        model.columnsRemoved.connect(self._discardPlan)
+        model.modelReset.connect(self._discardPlan)
+
+    def _discardPlan(self, *args):
+        self._plan = None
 
     def roundDate(self, date):
         """ Truncate the date to the year/month/day per dateFilterType
@@ -602,14 +784,18 @@ class deleteTagCmd(QtGui.QUndoCommand):
         files = self.model.dataset.deleteTag(self.tagId)
         if self.files is None:
             self.files = files
-        self.model.dataChanged.emit(model_idx(), model_idx())
+        # Look up the column now. Fields may have moved since the command
+        # was created.
+        column = self.model.tagColumn(self.fieldId)
+        self.model.emitFilesChanged(self.files, column)
 
     def undo(self):
         # Re-insert the tag
         self.tagId = self.model.dataset.insertTags(self.fieldId, self.name)[0]
         # Re-map
         self.model.dataset.mapTags(self.tagId, self.files)
-        self.model.dataChanged.emit(model_idx(), model_idx())
+        column = self.model.tagColumn(self.fieldId)
+        self.model.emitFilesChanged(self.files, column)
 
 
 class renameTagCmd(QtGui.QUndoCommand):
@@ -627,18 +813,20 @@ class renameTagCmd(QtGui.QUndoCommand):
         self.model = model
         self.tagId = tagId
         self.newName = newName
-        self.oldName = model.dataset.tagById(tagId)[0]
+        self.oldName, self.fieldId = model.dataset.tagById(tagId)
 
         desc = '{}: "{}" -> "{}"'.format(self.description, self.oldName, newName)
         super(renameTagCmd, self).__init__(desc, parent)
 
     def redo(self):
-        self.model.dataset.renameTag(self.tagId, self.newName)
-        self.model.dataChanged.emit(model_idx(), model_idx())
+        files = self.model.dataset.renameTag(self.tagId, self.newName)
+        column = self.model.tagColumn(self.fieldId)
+        self.model.emitFilesChanged(files, column)
 
     def undo(self):
-        self.model.dataset.renameTag(self.tagId, self.oldName)
-        self.model.dataChanged.emit(model_idx(), model_idx())
+        files = self.model.dataset.renameTag(self.tagId, self.oldName)
+        column = self.model.tagColumn(self.fieldId)
+        self.model.emitFilesChanged(files, column)
 
 
 class setDataCmd(QtGui.QUndoCommand):
@@ -663,12 +851,11 @@ class setDataCmd(QtGui.QUndoCommand):
         super(setDataCmd, self).__init__(description, parent)
 
     def redo(self):
+        # _setData emits dataChanged for the cell
         self.model._setData(self.index, self.newvalue)
-        self.model.dataChanged.emit(model_idx(), model_idx())
 
     def undo(self):
         self.model._setData(self.index, self.oldvalue)
-        self.model.dataChanged.emit(model_idx(), model_idx())
 
 
 if __name__ == "__main__":
@@ -121,6 +121,9 @@ class FieldObjectContainer(MutableSequence):
     def __init__(self, name=None, required=None, editor=None,
                  editable=None, name_editable=None, hidden=None,
                  filt=None, tags=None):
+        # Cached positions of the fields by object and by name
+        self._positions = None
+
         def makeBool(lst):
             if lst is not None:
                 return [bool(k) for k in lst]
@@ -160,19 +163,21 @@ class FieldObjectContainer(MutableSequence):
         if issubclass(key.__class__, FieldObject):
             key = key.name
         if isinstance(key, strobj):
-            for k in self._fieldobjs:
-                if k.name == key:
-                    return k
+            dex = self.position(key)
+            if dex is not None:
+                return self._fieldobjs[dex]
         else:
             return self._fieldobjs[key]
 
     def __setitem__(self, key, value):
+        self._positions = None
         if isinstance(value, FieldObject):
             self._fieldobjs[key] = value
         else:
             self._fieldobjs[key] = FieldObject(str(value))
 
     def __delitem__(self, key):
+        self._positions = None
         del self._fieldobjs[key]
 
     def __len__(self):
@@ -192,6 +197,7 @@ class FieldObjectContainer(MutableSequence):
                 is given, its str is used as the field name and all other
                 properties are let default.
         """
+        self._positions = None
         if issubclass(value.__class__, FieldObject):
             self._fieldobjs.insert(index, value)
         else:
@@ -205,12 +211,14 @@ class FieldObjectContainer(MutableSequence):
                 other than a FieldObject is given, its str is used as the field
                 name and all other properties are left default.
         """
+        self._positions = None
         if issubclass(value.__class__, FieldObject):
             self._fieldobjs.append(value)
         else:
             self._fieldobjs.append(FieldObject(str(value), **kwargs)) #Need to document
 
     def extend(self, values):
+        self._positions = None
         MutableSequence.extend(self._fieldobjs, values)
 
     def index(self, value):
@@ -219,10 +227,41 @@ class FieldObjectContainer(MutableSequence):
          Argument:
              index (str, FieldObject)
          """
-        if isinstance(value, basestring):
-            return self.names.index(value)
-        else:
-            return self._fieldobjs.index(value)
+        dex = self.position(value)
+        if dex is None:
+            raise ValueError('{} is not in the fields'.format(value))
+        return dex
+
+    def position(self, key):
+        """ Return the index of the given field or None if it isn't found
+
+        Positions are cached so that looking up the same fields repeatedly,
+        as each photo does, doesn't search the list of fields. If a field has
+        been renamed or moved since the cache was built, it is rebuilt.
+
+        Arguments:
+            key (str, FieldObject): The field or field name
+        """
+        try:
+            dex = self._positions[key]
+            field = self._fieldobjs[dex]
+            if field is key or field.name == key:
+                return dex
+        except (TypeError, KeyError, IndexError):
+            # Not cached yet, or not found
+            pass
+        self._buildPositions()
+        return self._positions.get(key)
+
+    def _buildPositions(self):
+        """ Cache the index of each field by object and by name """
+        positions = {}
+        # Reversed so that the first of any duplicate names is kept
+        for dex in reversed(range(len(self._fieldobjs))):
+            field = self._fieldobjs[dex]
+            positions[field] = dex
+            positions[field.name] = dex
+        self._positions = positions
 
     def remove(self, value):
         if isinstance(value, basestring):
@@ -14,17 +14,28 @@ else:
     strobj = str
 
 
-class Photo(dict):
+class Photo(object):
     """ Base class for Photo Enties
 
+    A photo holds a list of values and a reference to the fields they belong
+    to. Photos in an album share the album's FieldObjectContainer, which
+    caches the position of each field, so a photo costs little more than its
+    list of values and looking up a value doesn't search the fields. Values
+    can be read and set by field object or field name as with a dictionary.
+
     Arguments:
         fields (list[FieldObject]): (Optional) The fields (column headings)
         values (list[<>]):  (Optional) The values for each field. If provided,
             it should be the same length as values
-        thumb (PIL.Image):  (Optional) The thumbnail image
+        thumb (QIcon, str):  (Optional) The thumbnail image, or the encoded
+            thumbnail. This is only held until the photo is inserted into the
+            database, after which the thumbnail is fetched by file id when
+            needed.
         tagged (bool): Whether or not tagging has been completed
     """
 
+    __slots__ = ('_fields', '_values', 'thumb')
+
     def __init__(self, fields=None, values=None, thumb=None):
         fields = fields or []
         assert isinstance(fields, (list, FieldObjectContainer))
@@ -33,35 +44,131 @@ class Photo(dict):
         self.thumb = thumb
         assert len(fields) == len(values)
 
-        super(Photo, self).__init__(zip(fields, values))
+        if isinstance(fields, list):
+            fields = FieldObjectContainer(fields)
+        self._fields = fields
+        self._values = list(values)
+
+    def __contains__(self, key):
+        return self._fields.position(key) is not None
 
     def __getitem__(self, key):
-        if isinstance(key, FieldObject):
-            return super(Photo, self).__getitem__(key)
-        else:
-            return super(Photo, self).__getitem__(self.field_by_name(key))
+        dex = self._fields.position(key)
+        if dex is None:
+            dex = self._position(key)
+        return self._values[dex]
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._values)
 
     def __setitem__(self, key, value):
-        if isinstance(key, FieldObject):
-            return super(Photo, self).__setitem__(key, value)
-        else:
-            return super(Photo, self).__setitem__(self.field_by_name(key), value)
+        dex = self._fields.position(key)
+        if dex is None:
+            dex = self._position(key)
+        self._values[dex] = value
 
     def __repr__(self):
-        return '<Photo: %s>' % dict.__repr__(self)
+        return '<Photo: %r>' % dict(self.items())
+
+    def _position(self, key):
+        """ Return the index of the value for the given field or field name """
+        dex = self._fields.position(key)
+        if dex is None:
+            if isinstance(key, FieldObject):
+                raise KeyError(key)
+            raise ValueError('%s is not a valid field name' % key)
+        return dex
 
     def field_by_name(self, name):
-        field_names = [k.name for k in self.keys()]
-        if name not in field_names:
-            raise ValueError('%s is not a valid field name' % name)
-        dex = [i for i, x in enumerate(field_names) if x == name]
-        if len(dex) != 1:
-            raise ValueError('%s is the name of more than one field' % name)
+        return self._fields[self._position(name)]
+
+    def get(self, key, default=None):
+        dex = self._fields.position(key)
+        return default if dex is None else self._values[dex]
+
+    def items(self):
+        return zip(self._fields, self._values)
 
-        return self.keys()[dex[0]]
+    def keys(self):
+        return list(self._fields)
+
+    def values(self):
+        return list(self._values)
 
     def removeField(self, field):
-        del self[field]
+        # Don't remove the field from fields shared with other photos
+        self._detach()
+        dex = self._fields.index(field)
+        del self._fields[dex]
+        del self._values[dex]
+
+    def _attach(self, fields):
+        """ Share the given fields, reordering the values to match them
+
+        Values are matched by field object, or by name for fields that aren't
+        the same object. Values of missing fields are left empty.
+
+        Arguments:
+            fields (FieldObjectContainer): The album's fields
+        """
+        if fields is self._fields:
+            return
+        values = []
+        for field in fields:
+            dex = self._fields.position(field)
+            if dex is None:
+                dex = self._fields.position(field.name)
+            values.append('' if dex is None else self._values[dex])
+        self._fields = fields
+        self._values = values
+
+    def _detach(self):
+        """ Stop sharing fields so that the album's changes don't apply """
+        self._fields = FieldObjectContainer(list(self._fields))
+
+    def addTag(self, field, tag):
+        """ Add a tag to the given field. Return False if the photo already
+        had the tag.
+
+        Tags are compared whole and without regard to case.
+
+        Arguments:
+            field (FieldObject, str): The field object or name
+            tag (str): The tag to add
+        """
+        tags = self.tags(field)
+        if tag.lower() in [k.lower() for k in tags]:
+            return False
+        tags.append(tag)
+        self[field] = '; '.join(tags)
+        return True
+
+    def replaceTag(self, field, old, new=None):
+        """ Replace or remove a tag of the given field. Return True if the
+        photo had the tag.
+
+        Tags are compared whole and without regard to case, so a tag that
+        contains the old one is left alone.
+
+        Arguments:
+            field (FieldObject, str): The field object or name
+            old (str): The tag to replace
+            new (str): (None) The replacement. If None, the tag is removed.
+        """
+        tags = self.tags(field)
+        ltags = [k.lower() for k in tags]
+        if old.lower() not in ltags:
+            return False
+        dex = ltags.index(old.lower())
+        if new is None:
+            tags.pop(dex)
+        else:
+            tags[dex] = new
+        self[field] = '; '.join(tags)
+        return True
 
     def splitTags(self, tagStr):
         """ Return a list of strings from the given delimited string
@@ -81,9 +188,7 @@ class Photo(dict):
 
     @property
     def datetime(self):
-        fieldnames = [k.name for k in self.keys()]
-        dateField = Album.dateField
-        date = self[dateField] if dateField in fieldnames else None
+        date = self.get(Album.dateField)
         if date:
             try:
                 return datetime.strptime(date, '%Y-%m-%d %H:%M:%S')
@@ -104,8 +209,7 @@ class Photo(dict):
 
     @property
     def fileId(self):
-        if Album.fileIdField in [k.name for k in self]:
-            return self[Album.fileIdField]
+        return self.get(Album.fileIdField)
 
     @property
     def fileName(self):
@@ -131,6 +235,14 @@ class Photo(dict):
 class Album(MutableSequence):
     """A Photo container
 
+    The album keeps an index of the row of each photo by its file id so that
+    photos can be found without scanning. The index is updated when photos are
+    appended and rebuilt on the next lookup after any other change in order.
+
+    Photos in the album share its fields. Fields must be inserted and removed
+    with insertField and removeField so that each photo's values are kept in
+    step. Photos removed from the album keep a copy of the fields.
+
     Arguments:
         fields (list[str], FieldObjectContainer):  (Optional) A list of
             field names or FieldObjectContainer.
@@ -172,6 +284,7 @@ class Album(MutableSequence):
 
         # Initialize entries
         self._entries = []
+        self._rows = None
 
         # Create and store the entries
         values = values or []
@@ -179,7 +292,11 @@ class Album(MutableSequence):
             self._entries.append(Photo(self._fields, v))
 
     def __delitem__(self, key):
+        self._removeRow(key)
+        removed = self._entries[key]
         del self._entries[key]
+        for photo in removed if isinstance(key, slice) else [removed]:
+            photo._detach()
 
     def __getitem__(self, key):
         if isinstance(key, tuple):
@@ -201,16 +318,59 @@ class Album(MutableSequence):
         self[entry][field] = value
 
     def insert(self, key, value):
-        self._entries.insert(key, value)
+        if key >= len(self._entries):
+            self.append(value)
+        else:
+            value._attach(self._fields)
+            self._entries.insert(key, value)
+            self._rows = None
 
     def append(self, value):
+        value._attach(self._fields)
         self._entries.append(value)
+        if self._rows is not None:
+            self._rows[value.fileId] = len(self._entries) - 1
 
     def index(self, value):
+        row = self._rowIndex().get(getattr(value, 'fileId', None))
+        if row is not None and self._entries[row] is value:
+            return row
         return self._entries.index(value)
 
     def pop(self, index):
-        return self._entries.pop(index)
+        self._removeRow(index)
+        photo = self._entries.pop(index)
+        photo._detach()
+        return photo
+
+    def rowByFileId(self, fileId):
+        """ Return the row of the photo with the given file id
+
+        Arguments:
+            fileId (int): The database file id
+
+        Raises ValueError if no photo has the file id
+        """
+        try:
+            return self._rowIndex()[fileId]
+        except KeyError:
+            raise ValueError('{} is not a file id in the album'.format(fileId))
+
+    def _rowIndex(self):
+        """ Return the file id to row dictionary, building it if needed """
+        if self._rows is None:
+            self._rows = {p.fileId: k for k, p in enumerate(self._entries)}
+        return self._rows
+
+    def _removeRow(self, key):
+        """ Update the row index before the entry at key is removed """
+        if self._rows is None:
+            return
+        if isinstance(key, int) and key in (-1, len(self._entries) - 1):
+            # Removing the last row doesn't change the others
+            self._rows.pop(self._entries[key].fileId, None)
+        else:
+            self._rows = None
 
     def initializeFields(self):
         """ Initialize the default fields """
@@ -236,14 +396,26 @@ class Album(MutableSequence):
         self._defaultFields = fields
         self._fields = fields
 
+    def insertField(self, idx, field, value=''):
+        """ Insert a field, giving each photo the same value for it
+
+        Arguments:
+            idx (int): The index of the new field
+            field (FieldObject): The field to insert
+            value (object): ('') The value of the field for each photo
+        """
+        self._fields.insert(idx, field)
+        for entry in self._entries:
+            entry._values.insert(idx, value)
+
     def removeField(self, idx, force=False):
         name = self._fields[idx]
         if name.required and (not force):
             raise AlbumError('Cannot remove required field')
         else:
             self._fields.pop(idx)
-            for entry in self:
-                entry.removeField(name)
+            for entry in self._entries:
+                del entry._values[idx]
 
     @property
     def defaultFields(self):
@@ -295,6 +467,23 @@ if __name__ == "__main__":
         def test_date(self):
             self.assertEqual(self.photo.datetime, datetime(2017, 1, 1, 0, 0, 1))
 
+        def test_replaceTag(self):
+            self.photo[self.field] = 'cat; Cats, dog'
+            self.assertTrue(self.photo.replaceTag(self.field, 'CAT', 'kitten'))
+            self.assertEqual(self.photo[self.field], 'kitten; Cats; dog')
+            self.assertTrue(self.photo.replaceTag('Field1', 'dog'))
+            self.assertEqual(self.photo[self.field], 'kitten; Cats')
+            self.assertFalse(self.photo.replaceTag(self.field, 'at', 'x'))
+
+        def test_addTag(self):
+            self.photo[self.field] = 'party'
+            self.assertTrue(self.photo.addTag(self.field, 'art'))
+            self.assertEqual(self.photo[self.field], 'party; art')
+            self.assertFalse(self.photo.addTag('Field1', 'ART'))
+            self.photo[self.field] = ''
+            self.assertTrue(self.photo.addTag(self.field, 'dog'))
+            self.assertEqual(self.photo[self.field], 'dog')
+
     class AlbumTest(unittest.TestCase):
 
         def setUp(self):
@@ -325,6 +514,53 @@ if __name__ == "__main__":
             self.Album.insert(1, photo)
             self.assertEqual(self.Album[1, strField], 'c')
 
+        def test_rowByFileId(self):
+            emptyvalues = [None]*len(self.emptyAlbum.fields)
+            fileIdCol = self.Album.field_names.index(Album.fileIdField)
+
+            def photo(fileId):
+                values = emptyvalues + [fileId, str(fileId), False]
+                values[fileIdCol] = fileId
+                return Photo(self.Album.fields, values)
+
+            album = Album(self.fields)
+            for k in range(5):
+                album.append(photo(k))
+
+            def check():
+                for row, p in enumerate(album):
+                    self.assertEqual(album.rowByFileId(p.fileId), row)
+                    self.assertEqual(album.index(p), row)
+
+            check()
+            album.insert(2, photo(10))
+            check()
+            album.append(photo(11))
+            check()
+            self.assertEqual(album.pop(0).fileId, 0)
+            check()
+            del album[-1]
+            check()
+            del album[1]
+            check()
+            self.assertRaises(ValueError, album.rowByFileId, 11)
+            self.assertRaises(ValueError, album.rowByFileId, 10)
+
+        def test_insertRemoveField(self):
+            newField = FieldObject('new')
+            self.Album.insertField(1, newField, 'n')
+            self.assertEqual(self.Album[0][newField], 'n')
+            self.assertEqual(self.Album[1]['str'], 'b')
+            photo = self.Album.pop(0)
+            self.Album.removeField(self.Album.fields.index('new'))
+            self.assertEqual(self.Album[0]['str'], 'b')
+            self.assertNotIn('new', self.Album[0])
+            # Removed photos are not affected
+            self.assertEqual(photo['new'], 'n')
+            self.Album.insert(0, photo)
+            self.assertEqual(self.Album[0]['str'], 'a')
+            self.assertEqual(len(self.Album[0]), len(self.Album.fields))
+
         def test_duplicateField(self):
             dupfield = [FieldObject('Tagged', editor=3),
                         FieldObject('Hash', hidden=False),
@@ -35,6 +35,9 @@ class ProgressDialog(QtGui.QDialog):
                     it from the other processes. If None or omitted, this part
                     of the status is left out.
         -cancel     A method that cancels the process
+        -pause      (Optional) A method that pauses the process. If any process
+                    has pause and resume methods, a Pause button is shown.
+        -resume     (Optional) A method that resumes a paused process
     """
 
     def __init__(self, processes, title=None, closeDelay=-1, updateDelay=50,
@@ -73,11 +76,18 @@ class ProgressDialog(QtGui.QDialog):
         vspace = QtGui.QSpacerItem(10, 10, QtGui.QSizePolicy.Minimum,
                                    QtGui.QSizePolicy.Expanding)
         self.verticalLayout.addItem(vspace)
+        self.buttonPause = QtGui.QPushButton('Pause')
+        self.buttonPause.setCheckable(True)
+        self.buttonPause.setVisible(any(hasattr(p, 'pause') and
+                                        hasattr(p, 'resume')
+                                        for p in self.processes))
+        self.verticalLayout.addWidget(self.buttonPause)
         self.buttonCancel = QtGui.QPushButton('Cancel')
         self.verticalLayout.addWidget(self.buttonCancel)
 
         # Connect signals
         self.buttonCancel.clicked.connect(self.cancel)
+        self.buttonPause.toggled.connect(self.pause)
 
     def showEvent(self, event):
         """Re-implemented to start the processes and update timer on show()"""
@@ -124,6 +134,19 @@ class ProgressDialog(QtGui.QDialog):
                 p.cancel()
         self.close()
 
+    def pause(self, paused):
+        """Pause or resume the processes
+
+        Slot for the Pause button's toggled signal
+        """
+        for p in self.processes:
+            if hasattr(p, 'pause') and hasattr(p, 'resume'):
+                if paused:
+                    p.pause()
+                else:
+                    p.resume()
+        self.buttonPause.setText('Resume' if paused else 'Pause')
+
     def update(self):
         """Update the progress display
 
@@ -137,6 +160,7 @@ class ProgressDialog(QtGui.QDialog):
         if not self.anyactive():
             self._updateProgressWidgets()
             self.timer.stop()
+            self.buttonPause.setEnabled(False)
             self.buttonCancel.setText('Close')
             if self.closeDelay >= 0:
                 QtCore.QTimer.singleShot(self.closeDelay, self.close)
@@ -0,0 +1,238 @@
+""" A cache of decoded images for the image viewer """
+from PyQt4 import QtCore, QtGui
+from collections import OrderedDict, deque
+from orientation import MATRICES, readOrientation, swapsAxes
+import threading
+
+
+class ImageCache(QtCore.QObject):
+    """ A least-recently-used cache of decoded images keyed by file path
+
+    Images are decoded no larger than maxSize, typically the screen size,
+    which for JPEG files is much faster than a full decode. The cache holds
+    the images until their total size exceeds the byte budget, at which point
+    the least recently used are discarded.
+
+    Images that are likely to be shown next can be decoded ahead of time on a
+    background thread with prefetch. QImage, unlike QPixmap, may be created
+    off the GUI thread. sigLoaded is emitted with the path of each image that
+    is prefetched.
+
+    When a file changes, call invalidate. Decodes of the file that are in
+    progress at the time are discarded rather than cached.
+
+    Arguments:
+        maxSize (QSize): (None) The largest size at which to decode images.
+            Defaults to the size of the screen.
+        maxBytes (int): (256 MB) The byte budget for decoded images
+        maxPixels (int): (None) If given, files with more pixels than this
+            are not decoded. A null image is returned for them instead.
+    """
+
+    sigLoaded = QtCore.pyqtSignal(str)
+
+    def __init__(self, maxSize=None, maxBytes=256*2**20, maxPixels=None,
+                 parent=None):
+        super(ImageCache, self).__init__(parent)
+        if maxSize is None:
+            maxSize = QtGui.qApp.desktop().screenGeometry().size()
+        self.maxSize = maxSize
+        self.maxPixels = maxPixels
+        self._entries = OrderedDict()
+        self._maxBytes = maxBytes
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._generations = {}
+
+        # Prefetching
+        self._pending = deque()
+        self._wake = threading.Condition(self._lock)
+        self._thread = None
+
+    def __contains__(self, path):
+        with self._lock:
+            return path in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """ Remove all images from the cache and cancel pending prefetches """
+        with self._lock:
+            self._pending.clear()
+            self._entries.clear()
+            self._bytes = 0
+
+    def get(self, path):
+        """ Return the cached image for the given path or None
+
+        Arguments:
+            path (str): The full path to the image file
+        """
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is None:
+                return
+            # Re-insert to mark as most recently used
+            self._entries[path] = entry
+            return entry[0]
+
+    def load(self, path):
+        """ Return the image for the given path, decoding it now if it isn't
+        cached
+
+        Arguments:
+            path (str): The full path to the image file
+        """
+        image = self.get(path)
+        if image is None:
+            generation = self._generations.get(path)
+            image = self.decode(path, self.maxSize, self.maxPixels)
+            self._insertDecoded(path, image, generation)
+        return image
+
+    def insert(self, path, image):
+        """ Store a decoded image in the cache
+
+        Arguments:
+            path (str): The full path to the image file
+            image (QImage): The decoded image
+        """
+        with self._lock:
+            self._store(path, image)
+
+    def invalidate(self, path):
+        """ Remove the image for a file that has changed, and discard any
+        decode of it that is in progress
+
+        Arguments:
+            path (str): The full path to the image file
+        """
+        with self._lock:
+            self._generations[path] = self._generations.get(path, 0) + 1
+            self._store(path, None)
+
+    def prefetch(self, paths):
+        """ Decode the given images in the background, in order
+
+        Any prefetches still pending from an earlier call are cancelled. An
+        image already being decoded is finished and cached.
+
+        Arguments:
+            paths ([str]): The full paths to the image files
+        """
+        with self._lock:
+            self._pending.clear()
+            self._pending.extend(k for k in paths if k not in self._entries)
+            if self._pending:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._work)
+                    self._thread.daemon = True
+                    self._thread.start()
+                self._wake.notify()
+
+    def remove(self, path):
+        """ Remove the image for the given path from the cache
+
+        Arguments:
+            path (str): The full path to the image file
+        """
+        with self._lock:
+            self._store(path, None)
+
+    def _insertDecoded(self, path, image, generation):
+        """ Store an image decoded from a file unless the file has been
+        invalidated since the decode started
+
+        Arguments:
+            path (str): The full path to the image file
+            image (QImage): The decoded image
+            generation (int): The file's generation when the decode started
+        """
+        with self._lock:
+            if self._generations.get(path) != generation:
+                return False
+            self._store(path, image)
+            return True
+
+    def _store(self, path, image):
+        """ Replace the image for the given path. A null image removes it.
+        The lock must be held. """
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+        if image is None or image.isNull():
+            return
+        nbytes = image.byteCount()
+        self._entries[path] = (image, nbytes)
+        self._bytes += nbytes
+        self._trim()
+
+    def _trim(self):
+        """ Evict the least recently used images until within budget. The
+        lock must be held. """
+        while self._bytes > self._maxBytes and len(self._entries) > 1:
+            path, entry = self._entries.popitem(last=False)
+            self._bytes -= entry[1]
+
+    def _work(self):
+        """ Decode pending prefetches. Run in the prefetch thread. """
+        while True:
+            with self._lock:
+                while not self._pending:
+                    self._wake.wait()
+                path = self._pending.popleft()
+                if path in self._entries:
+                    continue
+                generation = self._generations.get(path)
+            try:
+                image = self.decode(path, self.maxSize, self.maxPixels)
+                inserted = self._insertDecoded(path, image, generation)
+            except Exception as err:
+                # Keep prefetching the others
+                print('Could not prefetch {}: {}'.format(path, err))
+                continue
+            if inserted and not image.isNull():
+                self.sigLoaded.emit(path)
+
+    @staticmethod
+    def decode(path, maxSize, maxPixels=None):
+        """ Decode an image file, scaled down to fit within maxSize
+
+        The image is transformed as its EXIF orientation says it should be
+        shown, which Qt doesn't do itself.
+
+        Arguments:
+            path (str): The full path to the image file
+            maxSize (QSize): The largest size of the decoded image
+            maxPixels (int): (None) If given, a null image is returned for
+                files with more pixels than this
+        """
+        try:
+            orientation = readOrientation(path)
+        except (IOError, OSError):
+            orientation = 1
+        if swapsAxes(orientation):
+            # Scale the stored image to fit maxSize once it is turned
+            maxSize = QtCore.QSize(maxSize.height(), maxSize.width())
+        reader = QtGui.QImageReader(path)
+        size = reader.size()
+        if maxPixels and size.width() * size.height() > maxPixels:
+            return QtGui.QImage()
+        if (size.isValid() and (size.width() > maxSize.width() or
+                                size.height() > maxSize.height())):
+            reader.setScaledSize(size.scaled(maxSize,
+                                             QtCore.Qt.KeepAspectRatio))
+        image = reader.read()
+        if orientation != 1 and not image.isNull():
+            a, b, c, d = MATRICES[orientation]
+            image = image.transformed(QtGui.QTransform(a, c, b, d, 0, 0))
+        return image
+
+    @property
+    def maxBytes(self):
+        return self._maxBytes
+
+    @property
+    def nbytes(self):
+        return self._bytes
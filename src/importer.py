@@ -0,0 +1,277 @@
+from ImageMan import loadImageData
+from PyQt4 import QtCore
+import multiprocessing
+import os
+import Queue
+from threading import Event as thread_Event
+import threading
+import time
+
+
+def normalizePath(path):
+    """ Return a path in a canonical form for comparison
+
+    Arguments:
+        path (str): A full path to a file
+    """
+    return os.path.normcase(os.path.normpath(path))
+
+
+class ImportIndex(object):
+    """ An index of the photos already in an album, used to sort the files
+    to import into new, unchanged and moved files
+
+    A file whose path is already in the album is unchanged and is never
+    opened. Paths are compared normalised, so differences in case (on
+    case-insensitive systems) and separators don't matter. A decoded file
+    whose name and hash match a photo in the album has probably been moved.
+
+    Arguments:
+        album (Album)
+    """
+
+    def __init__(self, album):
+        self.paths = set()
+        self.hashes = {}
+        for photo in album:
+            path = os.path.join(photo.directory, photo.fileName)
+            self.paths.add(normalizePath(path))
+            key = (os.path.normcase(photo.fileName), photo.hash)
+            self.hashes[key] = photo.fileId
+
+    def __contains__(self, path):
+        return normalizePath(path) in self.paths
+
+    def __len__(self):
+        return len(self.paths)
+
+    def match(self, fileName, hsh):
+        """ Return the file id of the photo in the album with the same file
+        name and hash, or None
+
+        Arguments:
+            fileName (str): The name of the file, without the directory
+            hsh (str): The image hash
+        """
+        return self.hashes.get((os.path.normcase(fileName), hsh))
+
+
+class Importer(QtCore.QObject):
+    """Photo import class
+
+    Imports run as a pipeline. The work method, intended to be run in a thread
+    by a ProgressDialog, discovers the files to import and hands them to a
+    pool of worker processes that decode each image and compute its hash and
+    thumbnail. The work thread collects the results and posts them in chunks
+    with the sigResults signal. Connect it with a queued connection so that
+    the receiver, usually on the GUI thread, inserts each chunk in one go.
+    The receiver must call release with the number of results it handled.
+
+    Only maxPending images can be in the workers or waiting to be released at
+    once. If the receiver falls behind, the workers are not given new files
+    until results are released.
+
+    The import can be paused, which stops new files from being handed to the
+    workers, and canceled.
+
+    A file whose worker raises, or doesn't finish within taskTimeout seconds,
+    is posted as an error so that the import always completes.
+
+    Arguments:
+        files ([str]): A list of full paths to image files
+        exclude (set, ImportIndex): (None) Paths that should not be imported,
+            typically those that are already in the database
+        processes (int): (None) The number of worker processes. Defaults to
+            one less than the number of CPUs.
+        maxPending (int): (None) The maximum number of images being decoded or
+            waiting to be released. Defaults to 4 per worker process, but at
+            least two chunks.
+        thumbFormat (str): ('JPEG') The format the thumbnails are encoded in
+        thumbQuality (int): (85) The quality of the encoded thumbnails
+    """
+
+    sigResults = QtCore.pyqtSignal(list)
+
+    # Results are posted when a chunk is full or chunkDelay seconds after the
+    # first result of the chunk arrived
+    chunkSize = 50
+    chunkDelay = 0.1
+
+    # Seconds a worker may spend on one image before it is given up on, and
+    # how often the workers' tasks are checked
+    taskTimeout = 120
+    checkInterval = 1.
+
+    def __init__(self, files, exclude=None, processes=None, maxPending=None,
+                 thumbFormat='JPEG', thumbQuality=85, parent=None):
+        super(Importer, self).__init__(parent)
+        self.files = files
+        self.thumbFormat = thumbFormat
+        self.thumbQuality = thumbQuality
+        self.exclude = exclude or set()
+        self.processes = (processes or
+                          max(1, multiprocessing.cpu_count() - 1))
+        self.maxPending = maxPending or max(4 * self.processes,
+                                            2 * self.chunkSize)
+
+        # Initialize Status
+        self.active = thread_Event()
+        self.cancelEvent = thread_Event()
+        self.pauseEvent = thread_Event()
+        self.status = ''
+        self.progress = 0
+        self.total = 0
+        self.taken = 0
+        self.excluded = 0
+        self.results = Queue.Queue()
+        self._slots = threading.Semaphore(self.maxPending)
+        self._lock = threading.Lock()
+        self._abandoned = set()
+
+    def discover(self):
+        """ Return the files that should be imported
+
+        Excluded paths are counted in excluded. They are not checked on disk.
+        A file given more than once is returned once.
+        """
+        out = []
+        seen = set()
+        for path in self.files:
+            if path in self.exclude:
+                self.excluded += 1
+                continue
+            key = normalizePath(path)
+            if key in seen or not os.path.isfile(path):
+                continue
+            seen.add(key)
+            out.append(path)
+        return out
+
+    def work(self):
+        """ Does the work of decoding the files
+
+        Intended to be run in a thread by a progress dialog. Sets status and
+        progress properties
+        """
+        self.active.set()
+        self.status = 'Finding photos'
+        files = self.discover()
+        self.total = len(files)
+        self.status = 'Importing %d photo(s)' % self.total
+
+        pool = multiprocessing.Pool(self.processes)
+        kwargs = {'fmt': self.thumbFormat, 'quality': self.thumbQuality}
+        chunk = []
+        chunkTime = None
+        dispatched = 0
+        tasks = {}
+        checkTime = time.time()
+        try:
+            while self.taken < self.total and not self.cancelEvent.isSet():
+                # Hand out files while there is room in the pipeline
+                while (dispatched < self.total and
+                       not self.pauseEvent.isSet() and
+                       self._slots.acquire(False)):
+                    path = files[dispatched]
+                    result = pool.apply_async(loadImageData, (path,), kwargs,
+                                              callback=self._collect)
+                    tasks[path] = (result, time.time())
+                    dispatched += 1
+
+                # Look for workers that failed or hung
+                if time.time() - checkTime >= self.checkInterval:
+                    self._checkTasks(tasks)
+                    checkTime = time.time()
+
+                # Collect the finished images and post them in chunks
+                try:
+                    chunk.append(self.results.get(timeout=0.01))
+                except Queue.Empty:
+                    pass
+                else:
+                    if chunkTime is None:
+                        chunkTime = time.time()
+                if chunk and (len(chunk) >= self.chunkSize or
+                              time.time() - chunkTime >= self.chunkDelay):
+                    self.sigResults.emit(chunk)
+                    chunk = []
+                    chunkTime = None
+        finally:
+            if self.cancelEvent.isSet() or self._abandoned:
+                # Don't wait for hung workers
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+
+        if self.cancelEvent.isSet():
+            self.status = 'Canceled after %d of %d photo(s)' % (self.taken,
+                                                               self.total)
+        else:
+            self.status = 'Finished importing %d photo(s)' % self.total
+            self.progress = 100
+        self.active.clear()
+
+    def _checkTasks(self, tasks):
+        """ Post an error for each task that failed or timed out
+
+        Arguments:
+            tasks (dict): {path: (AsyncResult, start time)} of the tasks that
+                were running at the last check. Finished tasks are removed.
+        """
+        now = time.time()
+        for path, (result, started) in tasks.items():
+            if result.ready():
+                del tasks[path]
+                if not result.successful():
+                    try:
+                        result.get()
+                    except Exception as err:
+                        self._abandon(path, str(err))
+            elif now - started > self.taskTimeout:
+                del tasks[path]
+                self._abandon(path, 'Timed out after %d s' % self.taskTimeout)
+
+    def _abandon(self, path, error):
+        """ Post an error result for a file and ignore any result its
+        worker posts later """
+        with self._lock:
+            self._abandoned.add(path)
+        self.results.put({'path': path, 'error': error})
+
+    def _collect(self, result):
+        """ Queue a worker's result. Called by the pool's result thread. """
+        with self._lock:
+            if result['path'] in self._abandoned:
+                return
+        self.results.put(result)
+
+    def release(self, count):
+        """ Mark posted results as handled, making room for more files
+
+        Arguments:
+            count (int): The number of results handled
+        """
+        with self._lock:
+            self.taken += count
+            taken = self.taken
+        for _ in range(count):
+            self._slots.release()
+        if not self.pauseEvent.isSet():
+            self.status = 'Importing Photo %d of %d' % (taken, self.total)
+        self.progress = taken * 100 / max(self.total, 1)
+
+    def cancel(self):
+        """ Cancel the process """
+        self.cancelEvent.set()
+
+    def pause(self):
+        """ Stop handing out files. Images already being decoded are still
+        posted. """
+        self.pauseEvent.set()
+        self.status = 'Paused after %d of %d photo(s)' % (self.taken,
+                                                         self.total)
+
+    def resume(self):
+        """ Resume a paused import """
+        self.pauseEvent.clear()
@@ -0,0 +1,351 @@
+""" Reading and losslessly changing the EXIF orientation of JPEG files """
+import os
+import shutil
+import struct
+import tempfile
+
+# The EXIF orientation tag
+ORIENTATION_TAG = 0x0112
+
+# The transform from the stored image to the displayed image for each
+# orientation, as the matrix (a, b, c, d) that maps the pixel (x, y) to
+# (a*x + b*y, c*x + d*y), with y pointing down
+MATRICES = {1: (1, 0, 0, 1),      # As stored
+            2: (-1, 0, 0, 1),     # Mirrored left to right
+            3: (-1, 0, 0, -1),    # Rotated 180
+            4: (1, 0, 0, -1),     # Mirrored top to bottom
+            5: (0, 1, 1, 0),      # Transposed
+            6: (0, -1, 1, 0),     # Rotated 90 clockwise
+            7: (0, -1, -1, 0),    # Transversed
+            8: (0, 1, -1, 0)}     # Rotated 90 counter-clockwise
+ORIENTATIONS = {v: k for k, v in MATRICES.items()}
+
+
+def findOrientation(fid):
+    """ Return the file offset and byte order of a JPEG file's orientation
+    value, or None if the file has no EXIF orientation tag
+
+    Arguments:
+        fid (file): The JPEG file, opened in binary mode
+    """
+    fid.seek(0)
+    if bytearray(fid.read(2)) != bytearray(b'\xff\xd8'):
+        return
+    while True:
+        marker = bytearray(fid.read(2))
+        if len(marker) < 2 or marker[0] != 0xff:
+            return
+        if marker[1] == 0xff:
+            # Fill byte
+            fid.seek(-1, 1)
+            continue
+        if marker[1] in (0xd9, 0xda):
+            # End of image or start of scan. There is no more metadata.
+            return
+        if 0xd0 <= marker[1] <= 0xd7 or marker[1] == 0x01:
+            # Markers without a segment
+            continue
+        length = struct.unpack('>H', fid.read(2))[0]
+        start = fid.tell()
+        if marker[1] == 0xe1:
+            data = fid.read(length - 2)
+            if data[:6] == b'Exif\x00\x00':
+                return _findInTiff(data, start)
+        fid.seek(start + length - 2)
+
+
+def _findInTiff(data, start):
+    """ Return the file offset and byte order of the orientation value in
+    the first IFD of an Exif segment, or None
+
+    Arguments:
+        data (str): The Exif segment, starting with the Exif header
+        start (int): The file offset of data
+    """
+    order = {b'II': '<', b'MM': '>'}.get(data[6:8])
+    if order is None:
+        return
+    try:
+        ifd = 6 + struct.unpack(order + 'I', data[10:14])[0]
+        count = struct.unpack(order + 'H', data[ifd:ifd+2])[0]
+        for k in range(count):
+            entry = ifd + 2 + 12*k
+            tag, typ, n = struct.unpack(order + 'HHI', data[entry:entry+8])
+            if tag == ORIENTATION_TAG:
+                if typ == 3 and n == 1:  # One SHORT
+                    return start + entry + 8, order
+                return
+    except struct.error:
+        # Truncated
+        return
+
+
+def readOrientation(path):
+    """ Return the EXIF orientation of an image file. Return 1 (as stored)
+    if the file has no valid orientation.
+
+    Arguments:
+        path (str): The full path to the image file
+    """
+    with open(path, 'rb') as fid:
+        found = findOrientation(fid)
+        if found is None:
+            return 1
+        offset, order = found
+        fid.seek(offset)
+        value = struct.unpack(order + 'H', fid.read(2))[0]
+    return value if value in MATRICES else 1
+
+
+def writeOrientation(path, orientation):
+    """ Set the EXIF orientation of a JPEG file in place. Return False if the
+    file has no orientation tag to change.
+
+    Only the two bytes of the value are written. The image data is untouched.
+
+    Arguments:
+        path (str): The full path to the image file
+        orientation (int): The new orientation (1-8)
+    """
+    with open(path, 'r+b') as fid:
+        found = findOrientation(fid)
+        if found is None:
+            return False
+        offset, order = found
+        fid.seek(offset)
+        fid.write(struct.pack(order + 'H', orientation))
+    return True
+
+
+def insertOrientation(path, orientation):
+    """ Add an EXIF orientation tag to a JPEG file that has none. Return
+    False if the file isn't a JPEG or the tag can't be added.
+
+    If the file has an Exif segment, its first IFD is copied with the new
+    entry to the end of the segment. Otherwise a new Exif segment is added.
+    The image data is copied unchanged. The file is written to a temporary
+    file that then replaces it.
+
+    Arguments:
+        path (str): The full path to the image file
+        orientation (int): The orientation (1-8)
+    """
+    with open(path, 'rb') as fid:
+        data = fid.read()
+    if data[:2] != b'\xff\xd8':
+        return False
+    # The Exif segment goes after SOI and any JFIF segment
+    start = end = 2
+    pos = 2
+    while data[pos:pos+1] == b'\xff' and pos + 4 <= len(data):
+        marker = bytearray(data[pos+1:pos+2])[0]
+        if marker in (0xd9, 0xda):
+            break
+        if marker == 0xff:
+            pos += 1
+            continue
+        if 0xd0 <= marker <= 0xd7 or marker == 0x01:
+            pos += 2
+            continue
+        segEnd = pos + 2 + struct.unpack('>H', data[pos+2:pos+4])[0]
+        if marker == 0xe1 and data[pos+4:pos+10] == b'Exif\x00\x00':
+            start, end = pos, segEnd
+            break
+        if marker == 0xe0 and start == pos:
+            start = end = segEnd
+        pos = segEnd
+    if start == end:
+        tiff = (b'MM' + struct.pack('>HIH', 42, 8, 1) +
+                _orientationEntry('>', orientation) + struct.pack('>I', 0))
+    else:
+        tiff = _addToFirstIfd(data[start+10:end], orientation)
+        if tiff is None:
+            return False
+    segment = b'Exif\x00\x00' + tiff
+    if len(segment) + 2 > 0xffff:
+        return False
+    _replaceFile(path, data[:start] + b'\xff\xe1' +
+                 struct.pack('>H', len(segment) + 2) + segment + data[end:])
+    return True
+
+
+def _orientationEntry(order, orientation):
+    """ Return the IFD entry of an orientation: one SHORT, left justified in
+    the value field """
+    return struct.pack(order + 'HHIHH', ORIENTATION_TAG, 3, 1, orientation, 0)
+
+
+def _addToFirstIfd(tiff, orientation):
+    """ Return TIFF data with its first IFD moved to the end and an
+    orientation entry added, or None if the IFD can't be read or already has
+    an orientation entry
+
+    The old IFD is left in place, unused. Other offsets are from the start of
+    the TIFF data, so they stay valid.
+
+    Arguments:
+        tiff (str): The TIFF data of an Exif segment
+        orientation (int): The orientation (1-8)
+    """
+    order = {b'II': '<', b'MM': '>'}.get(tiff[:2])
+    if order is None:
+        return
+    try:
+        ifd = struct.unpack(order + 'I', tiff[4:8])[0]
+        count = struct.unpack(order + 'H', tiff[ifd:ifd+2])[0]
+    except struct.error:
+        return
+    end = ifd + 2 + 12*count
+    if end + 4 > len(tiff):
+        # Truncated
+        return
+    entries = [tiff[k:k+12] for k in range(ifd + 2, end, 12)]
+    def tagOf(entry):
+        return struct.unpack(order + 'H', entry[:2])[0]
+    if ORIENTATION_TAG in [tagOf(k) for k in entries]:
+        return
+    entries.append(_orientationEntry(order, orientation))
+    entries.sort(key=tagOf)
+    # IFDs start on a word boundary
+    tiff += b'\x00' * (len(tiff) % 2)
+    return (tiff[:4] + struct.pack(order + 'I', len(tiff)) + tiff[8:] +
+            struct.pack(order + 'H', len(entries)) + b''.join(entries) +
+            tiff[end:end+4])
+
+
+def _replaceFile(path, data):
+    """ Write data to a temporary file beside path, then move it over path
+
+    Arguments:
+        path (str): The full path to the file
+        data (str): The new contents
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or None)
+    try:
+        with os.fdopen(fd, 'wb') as fid:
+            fid.write(data)
+        shutil.copymode(path, tmp)
+        if os.name == 'nt':
+            # rename doesn't replace files on Windows
+            os.remove(path)
+        os.rename(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def rotateOrientation(orientation, angle):
+    """ Return the orientation that shows an image rotated by angle
+
+    Arguments:
+        orientation (int): The current orientation (1-8)
+        angle (int): The counter-clockwise rotation, in degrees. A multiple
+            of 90.
+    """
+    a, b, c, d = MATRICES.get(orientation, MATRICES[1])
+    for _ in range((angle // 90) % 4):
+        # Rotate 90 counter-clockwise: (x, y) -> (y, -x)
+        a, b, c, d = c, d, -a, -b
+    return ORIENTATIONS[(a, b, c, d)]
+
+
+def swapsAxes(orientation):
+    """ Return whether the displayed width is the stored height
+
+    Arguments:
+        orientation (int): The orientation (1-8)
+    """
+    return orientation in (5, 6, 7, 8)
+
+
+if __name__ == "__main__":
+    import unittest
+
+    class OrientationTests(unittest.TestCase):
+
+        def setUp(self):
+            self.dir = tempfile.mkdtemp()
+
+        def tearDown(self):
+            shutil.rmtree(self.dir)
+
+        def jpeg(self, order='<', orientation=6, exif=True):
+            """ Write a minimal JPEG header with an Exif orientation """
+            o = order
+            entries = [struct.pack(o + 'HHI', 0x010f, 2, 4) + b'Cam\x00']
+            if orientation is not None:
+                entries.append(struct.pack(o + 'HHIH', ORIENTATION_TAG, 3, 1,
+                                           orientation) + b'\x00\x00')
+            ifd = (struct.pack(o + 'H', len(entries)) + b''.join(entries) +
+                   struct.pack(o + 'I', 0))
+            tiff = ((b'II' if o == '<' else b'MM') + struct.pack(o + 'HI', 42, 8)
+                    + ifd)
+            app1 = b'Exif\x00\x00' + tiff
+            data = (b'\xff\xd8' + b'\xff\xe0' + struct.pack('>H', 4) + b'JF' +
+                    (b'\xff\xe1' + struct.pack('>H', len(app1) + 2) + app1
+                     if exif else b'') +
+                    b'\xff\xda' + b'\x00\x02' + b'\x12\x34' * 100 + b'\xff\xd9')
+            path = os.path.join(self.dir, 'test.jpg')
+            with open(path, 'wb') as fid:
+                fid.write(data)
+            return path
+
+        def test_read(self):
+            self.assertEqual(readOrientation(self.jpeg('<', 6)), 6)
+            self.assertEqual(readOrientation(self.jpeg('>', 8)), 8)
+            self.assertEqual(readOrientation(self.jpeg('<', None)), 1)
+
+        def test_write(self):
+            for order in '<>':
+                path = self.jpeg(order, 1)
+                with open(path, 'rb') as fid:
+                    before = fid.read()
+                self.assertTrue(writeOrientation(path, 3))
+                self.assertEqual(readOrientation(path), 3)
+                with open(path, 'rb') as fid:
+                    after = fid.read()
+                self.assertEqual(len(before), len(after))
+                self.assertEqual(sum(j != k for j, k in zip(before, after)), 1)
+            self.assertFalse(writeOrientation(self.jpeg('<', None), 3))
+
+        def test_insert(self):
+            for order in '<>':
+                for exif in (True, False):
+                    path = self.jpeg(order, None, exif)
+                    with open(path, 'rb') as fid:
+                        before = fid.read()
+                    self.assertTrue(insertOrientation(path, 6))
+                    self.assertEqual(readOrientation(path), 6)
+                    self.assertTrue(writeOrientation(path, 3))
+                    self.assertEqual(readOrientation(path), 3)
+                    with open(path, 'rb') as fid:
+                        after = fid.read()
+                    # The image data is unchanged
+                    scan = before.index(b'\xff\xda')
+                    self.assertTrue(after.endswith(before[scan:]))
+                    if exif:
+                        # The other entry is kept
+                        self.assertIn(b'Cam\x00', after[:-len(before[scan:])])
+            # Files that already have the tag
+            self.assertFalse(insertOrientation(self.jpeg('<', 6), 3))
+            path = os.path.join(self.dir, 'test.png')
+            with open(path, 'wb') as fid:
+                fid.write(b'\x89PNG\r\n\x1a\n')
+            self.assertFalse(insertOrientation(path, 3))
+
+        def test_rotate(self):
+            # Rotating right steps 1 -> 6 -> 3 -> 8 -> 1
+            self.assertEqual(rotateOrientation(1, -90), 6)
+            self.assertEqual(rotateOrientation(6, -90), 3)
+            self.assertEqual(rotateOrientation(3, -90), 8)
+            self.assertEqual(rotateOrientation(8, -90), 1)
+            self.assertEqual(rotateOrientation(1, 90), 8)
+            for k in MATRICES:
+                for angle in (90, 180, 270, -90):
+                    rotated = rotateOrientation(k, angle)
+                    self.assertEqual(rotateOrientation(rotated, -angle), k)
+                    self.assertEqual(swapsAxes(rotated) != swapsAxes(k),
+                                     angle % 180 != 0)
+
+    unittest.main()
@@ -24,6 +24,14 @@ class PhotoTable(QtGui.QTableView):
         self.actionBatchTag = QtGui.QAction('&Group Tag Selection', self)
         self.actionBatchTag.setShortcut('Ctrl+G')
 
+        # Evict the thumbnails of rows scrolled out of view once scrolling
+        # settles
+        self._evictTimer = QtCore.QTimer(self)
+        self._evictTimer.setSingleShot(True)
+        self._evictTimer.setInterval(250)
+        self._evictTimer.timeout.connect(self.evictHiddenThumbnails)
+        self.verticalScrollBar().valueChanged.connect(self.on_scrolled)
+
     def contextMenuEvent(self, event):
         """ Reimplemented context menu event handler
 
@@ -67,6 +75,32 @@ class PhotoTable(QtGui.QTableView):
 
         menu.exec_(self.mapToGlobal(event.pos()))
 
+    def evictHiddenThumbnails(self):
+        """ Remove the thumbnails of rows far from the viewport from the
+        database's thumbnail cache
+
+        Rows within one page of the visible rows are kept so that small
+        scrolls don't cause the thumbnails to be decoded again.
+        """
+        proxy = self.model()
+        nrows = proxy.rowCount() if proxy else 0
+        if nrows == 0:
+            return
+        first = max(self.rowAt(0), 0)
+        last = self.rowAt(self.viewport().height() - 1)
+        if last < 0:
+            last = nrows - 1
+        page = last - first + 1
+        first = max(first - page, 0)
+        last = min(last + page, nrows - 1)
+
+        dataset = proxy.sourceModel().dataset
+        fileIds = []
+        for r in range(first, last + 1):
+            row = proxy.mapToSource(proxy.index(r, 0)).row()
+            fileIds.append(dataset[row].fileId)
+        dataset.thumbCache.retain(fileIds)
+
     def rehideColumns(self):
         """ Hide/Unhide columns based on field's hidden property """
         # Get the hidden property for each field
@@ -152,6 +186,14 @@ class PhotoTable(QtGui.QTableView):
         self.horizontalHeader().setSectionHidden(self.logicalIndex, True)
         self.model().dataset.fields[self.logicalIndex].hidden = True
 
+    @QtCore.pyqtSlot(int)
+    def on_scrolled(self, value):
+        """ Restart the thumbnail eviction timer
+
+        Slot for the vertical scroll bar's valueChanged signal
+        """
+        self._evictTimer.start()
+
     @QtCore.pyqtSlot()
     def on_sort_triggered(self):
         """Sort by the clicked column"""
@@ -3,7 +3,7 @@ import sys
 import re
 
 
-__release__ = '0.5.2'
+__release__ = '0.6.0'
 
 # These are used in the settings
 organization = "McNinch Custom"
@@ -14,6 +14,8 @@ installDir = os.path.join(os.path.expanduser("~"), '.PhotoOrganizer')
 trashDir = os.path.join(installDir, '.trash')
 if not os.path.exists(trashDir):
     os.mkdir(trashDir)
+# Tile pyramids of very large images, for the image viewer
+tileDir = os.path.join(installDir, '.tiles')
 
 
 def resource_path(relative):
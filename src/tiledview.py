@@ -0,0 +1,414 @@
+""" Tiled viewing of images that are too large to decode whole """
+from PyQt4 import QtCore, QtGui
+from PIL import Image
+import hashlib
+from imagecache import ImageCache
+import math
+from orientation import MATRICES, readOrientation
+import os
+from shared import tileDir
+import shutil
+import threading
+import time
+
+# The images shown tiled are larger than PIL's default decompression bomb
+# limit. Allow them up to an explicit ceiling rather than turning the check
+# off. (PIL raises an error at twice the limit.)
+MAX_IMAGE_PIXELS = 2**30
+if Image.MAX_IMAGE_PIXELS and Image.MAX_IMAGE_PIXELS < MAX_IMAGE_PIXELS:
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+
+class TilePyramid(object):
+    """ An on-disk pyramid of image tiles
+
+    Level 0 is the full resolution image and each following level is half
+    the size of the one before, down to a level that fits in a single tile.
+    The tiles of each level are stored as JPEG files, as the image is stored
+    in the file. Its EXIF orientation is applied when the tiles are shown, so
+    a lossless rotation keeps the tiles (see moveCache). The pyramid's
+    directory is named for the image's path, size and modification time, so
+    a changed file gets a new pyramid.
+
+    Building the pyramid decodes the image at full resolution once, for
+    level 0, and cuts the tiles from it one at a time. The lower levels are
+    made from a reduced decode. After that, any region at any level can be
+    shown by reading only the tiles that cover it.
+
+    The pyramids in the cache directory are kept to maxCacheBytes in total
+    by deleting the least recently shown (see trimCache).
+
+    Arguments:
+        path (str): The full path to the image file
+        cacheDir (str): (shared.tileDir) The directory of the pyramids
+    """
+
+    tileSize = 512
+    maxCacheBytes = 2 * 2**30
+
+    # Incomplete pyramids this much older than the last build (s) were left
+    # by an interrupted build
+    staleAge = 24 * 3600
+
+    def __init__(self, path, cacheDir=None):
+        self.path = path
+        self.cacheDir = cacheDir or tileDir
+        self.directory = self.directoryFor(path, self.cacheDir)
+        self.orientation = readOrientation(path)
+        # Opening reads only the header
+        self.width, self.height = Image.open(path).size
+        longest = max(self.width, self.height, 1)
+        self.levels = max(0, int(math.ceil(math.log(float(longest) /
+                                                    self.tileSize, 2)))) + 1
+
+    @staticmethod
+    def directoryFor(path, cacheDir=None):
+        """ Return the directory of the pyramid for an image file as it is
+        now
+
+        Arguments:
+            path (str): The full path to the image file
+            cacheDir (str): (shared.tileDir) The directory of the pyramids
+        """
+        stat = os.stat(path)
+        key = u'{}|{}|{}'.format(os.path.abspath(path), stat.st_size,
+                                 int(stat.st_mtime))
+        return os.path.join(cacheDir or tileDir,
+                            hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    @classmethod
+    def moveCache(cls, oldDirectory, path, keep=True):
+        """ Move a pyramid to the directory for its file after the file has
+        changed, or delete it
+
+        Arguments:
+            oldDirectory (str): The pyramid's directory before the change
+            path (str): The full path to the image file
+            keep (bool): (True) Whether the tiles are still valid, eg. when
+                only the file's orientation has changed
+        """
+        if not os.path.exists(oldDirectory):
+            return
+        newDirectory = cls.directoryFor(path, os.path.dirname(oldDirectory))
+        if keep:
+            if newDirectory == oldDirectory:
+                return
+            if not os.path.exists(newDirectory):
+                try:
+                    os.rename(oldDirectory, newDirectory)
+                    return
+                except OSError:
+                    # Eg. still being built
+                    pass
+        shutil.rmtree(oldDirectory, ignore_errors=True)
+
+    @classmethod
+    def trimCache(cls, cacheDir=None, maxBytes=None, keep=()):
+        """ Delete the least recently shown pyramids until the cache is
+        within maxBytes. Incomplete pyramids left by an interrupted build are
+        deleted too.
+
+        Arguments:
+            cacheDir (str): (shared.tileDir) The directory of the pyramids
+            maxBytes (int): (maxCacheBytes) The byte budget for the tiles
+            keep ([str]): (()) Pyramid directories not to delete
+        """
+        cacheDir = cacheDir or tileDir
+        maxBytes = cls.maxCacheBytes if maxBytes is None else maxBytes
+        if not os.path.isdir(cacheDir):
+            return
+        pyramids = []
+        total = 0
+        for name in os.listdir(cacheDir):
+            directory = os.path.join(cacheDir, name)
+            if directory in keep:
+                continue
+            done = os.path.join(directory, 'done')
+            try:
+                if not os.path.exists(done):
+                    age = time.time() - os.path.getmtime(directory)
+                    if age > cls.staleAge:
+                        shutil.rmtree(directory, ignore_errors=True)
+                    continue
+                # The marker holds the size of the tiles and is touched
+                # each time the pyramid is shown
+                with open(done) as fid:
+                    size = int(fid.read() or 0)
+                used = os.path.getmtime(done)
+            except (IOError, OSError, ValueError):
+                continue
+            pyramids.append((used, size, directory))
+            total += size
+        for used, size, directory in sorted(pyramids):
+            if total <= maxBytes:
+                break
+            shutil.rmtree(directory, ignore_errors=True)
+            total -= size
+
+    def build(self):
+        """ Decode the image and write the tiles of every level
+
+        Level 0 needs the one full resolution decode. Its tiles are cut and
+        converted one at a time, so there is no full size copy. For JPEG
+        files, the full image is then released and level 1 is decoded at
+        half scale by the decoder (draft). Other files are halved from the
+        full image, which is converted first only if its mode can't be
+        resized. Each lower level is halved from the one above.
+        """
+        if self.isBuilt():
+            return
+        im = Image.open(self.path)
+        jpeg = im.format == 'JPEG'
+        nbytes = self._writeLevel(im, 0)
+        for level in range(1, self.levels):
+            size = self.levelSize(level)
+            if level == 1 and jpeg:
+                # Release the full image before the reduced decode
+                im = None
+                im = Image.open(self.path)
+                im.draft('RGB', size)
+            elif level == 1 and im.mode not in ('RGB', 'RGBA', 'L', 'P'):
+                im = im.convert('RGB')
+            if im.size != size:
+                im = im.resize(size, Image.BILINEAR)
+            nbytes += self._writeLevel(im, level)
+        im = None
+        # Mark the pyramid as complete, and note its size for trimCache
+        with open(os.path.join(self.directory, 'done'), 'w') as fid:
+            fid.write(str(nbytes))
+
+    def _writeLevel(self, im, level):
+        """ Write the tiles of one level. Return the bytes written.
+
+        Arguments:
+            im (Image): The image at the level
+            level (int)
+        """
+        levelDir = os.path.join(self.directory, str(level))
+        if not os.path.exists(levelDir):
+            os.makedirs(levelDir)
+        ts = self.tileSize
+        w, h = im.size
+        nbytes = 0
+        for row in range(self.tileCount(h)):
+            for col in range(self.tileCount(w)):
+                box = (col*ts, row*ts, min(w, (col+1)*ts), min(h, (row+1)*ts))
+                tile = im.crop(box)
+                if tile.mode not in ('RGB', 'L'):
+                    tile = tile.convert('RGB')
+                path = self.tilePath(level, col, row)
+                tile.save(path, 'JPEG', quality=90)
+                nbytes += os.path.getsize(path)
+        return nbytes
+
+    def isBuilt(self):
+        """ Return whether the tiles have all been written """
+        return os.path.exists(os.path.join(self.directory, 'done'))
+
+    def touch(self):
+        """ Mark the pyramid as recently shown """
+        if self.isBuilt():
+            os.utime(os.path.join(self.directory, 'done'), None)
+
+    def levelSize(self, level):
+        """ Return the (width, height) of the image at the given level
+
+        Arguments:
+            level (int)
+        """
+        f = 2**level
+        return (self.width + f - 1) // f, (self.height + f - 1) // f
+
+    def tileCount(self, length):
+        """ Return the number of tiles needed to cover the given length
+
+        Arguments:
+            length (int): A width or height, in pixels
+        """
+        return max(1, (length + self.tileSize - 1) // self.tileSize)
+
+    def tilePath(self, level, col, row):
+        """ Return the path of a tile file
+
+        Arguments:
+            level (int)
+            col (int)
+            row (int)
+        """
+        return os.path.join(self.directory, str(level),
+                            '{}_{}.jpg'.format(col, row))
+
+
+class TiledImageItem(QtGui.QGraphicsItem):
+    """ A graphics item that paints an image from its tile pyramid
+
+    The item is in full resolution image coordinates, as the image is stored.
+    Its transform turns it as the image's EXIF orientation says. When
+    painted, it picks the pyramid level closest to, but not smaller than, the
+    current zoom and reads only the tiles in the exposed area, through a
+    cache.
+
+    Arguments:
+        pyramid (TilePyramid)
+        cache (ImageCache): The cache of decoded tiles
+    """
+
+    def __init__(self, pyramid, cache, parent=None):
+        super(TiledImageItem, self).__init__(parent)
+        self.pyramid = pyramid
+        self.cache = cache
+        self.setFlag(QtGui.QGraphicsItem.ItemUsesExtendedStyleOption)
+
+        # Map the stored image onto the displayed one, with its top left
+        # corner at the origin
+        a, b, c, d = MATRICES[pyramid.orientation]
+        w, h = pyramid.width, pyramid.height
+        dx = -(min(a*w, 0) + min(b*h, 0))
+        dy = -(min(c*w, 0) + min(d*h, 0))
+        self.setTransform(QtGui.QTransform(a, c, b, d, dx, dy))
+
+    def boundingRect(self):
+        return QtCore.QRectF(0, 0, self.pyramid.width, self.pyramid.height)
+
+    def level(self, scale):
+        """ Return the pyramid level to paint at the given zoom
+
+        Arguments:
+            scale (float): The ratio of screen pixels to image pixels
+        """
+        if scale >= 1:
+            return 0
+        level = int(math.floor(math.log(1. / scale, 2)))
+        return min(level, self.pyramid.levels - 1)
+
+    def paint(self, painter, option, widget=None):
+        pyramid = self.pyramid
+        if not pyramid.isBuilt():
+            painter.fillRect(self.boundingRect(), QtCore.Qt.darkGray)
+            return
+        transform = painter.worldTransform()
+        level = self.level(option.levelOfDetailFromTransform(transform))
+        f = 2**level
+        ts = pyramid.tileSize
+        w, h = pyramid.levelSize(level)
+
+        # The tiles covering the exposed area
+        rect = option.exposedRect
+        col0 = max(0, int(rect.left()) // f // ts)
+        col1 = min(pyramid.tileCount(w) - 1, int(rect.right()) // f // ts)
+        row0 = max(0, int(rect.top()) // f // ts)
+        row1 = min(pyramid.tileCount(h) - 1, int(rect.bottom()) // f // ts)
+        painter.setRenderHint(QtGui.QPainter.SmoothPixmapTransform)
+        for row in range(row0, row1 + 1):
+            for col in range(col0, col1 + 1):
+                tile = self.cache.load(pyramid.tilePath(level, col, row))
+                if tile.isNull():
+                    continue
+                target = QtCore.QRectF(col*ts*f, row*ts*f, tile.width()*f,
+                                       tile.height()*f)
+                painter.drawImage(target, tile)
+
+
+class TiledImageView(QtGui.QGraphicsView):
+    """ A zoomable, pannable view of a very large image
+
+    The image's tile pyramid is built on a background thread the first time
+    it is shown. Only the tiles that are visible at the current zoom are
+    decoded and at most maxBytes of them are kept in memory. Zoom with the
+    mouse wheel and pan by dragging.
+
+    Arguments:
+        maxBytes (int): (64 MB) The byte budget for decoded tiles
+    """
+
+    sigBuilt = QtCore.pyqtSignal(str)
+
+    zoomStep = 1.25
+    maxZoom = 8.
+
+    def __init__(self, maxBytes=64*2**20, parent=None):
+        super(TiledImageView, self).__init__(parent)
+        self.setScene(QtGui.QGraphicsScene(self))
+        self.setDragMode(QtGui.QGraphicsView.ScrollHandDrag)
+        self.setTransformationAnchor(QtGui.QGraphicsView.AnchorUnderMouse)
+        self.setBackgroundBrush(QtCore.Qt.black)
+        size = TilePyramid.tileSize
+        self.tileCache = ImageCache(QtCore.QSize(size, size), maxBytes, self)
+        self.item = None
+        self.fitted = True
+        self._building = set()
+        self.sigBuilt.connect(self.on_built, QtCore.Qt.QueuedConnection)
+
+    def setImage(self, path):
+        """ Show an image, building its tile pyramid if needed
+
+        Arguments:
+            path (str): The full path to the image file
+        """
+        self.clear()
+        self.resetTransform()
+        pyramid = TilePyramid(path)
+        self.item = TiledImageItem(pyramid, self.tileCache)
+        self.scene().addItem(self.item)
+        self.scene().setSceneRect(self.item.sceneBoundingRect())
+        self.fitImage()
+        pyramid.touch()
+        if not pyramid.isBuilt() and pyramid.directory not in self._building:
+            self._building.add(pyramid.directory)
+            thread = threading.Thread(target=self._build, args=(pyramid,))
+            thread.daemon = True
+            thread.start()
+
+    def clear(self):
+        """ Remove the image and free its tiles """
+        self.scene().clear()
+        self.tileCache.clear()
+        self.item = None
+
+    def fitImage(self):
+        """ Zoom to fit the whole image in the view """
+        if self.item is not None:
+            self.fitInView(self.item, QtCore.Qt.KeepAspectRatio)
+            self.fitted = True
+
+    def _build(self, pyramid):
+        """ Build a pyramid. Run in a background thread. """
+        try:
+            pyramid.build()
+            TilePyramid.trimCache(pyramid.cacheDir, keep=[pyramid.directory])
+        finally:
+            self.sigBuilt.emit(pyramid.directory)
+
+    @QtCore.pyqtSlot(str)
+    def on_built(self, directory):
+        """ Repaint the image once its tiles are ready
+
+        Slot for the sigBuilt signal
+        """
+        directory = str(directory)
+        self._building.discard(directory)
+        if self.item is not None and self.item.pyramid.directory == directory:
+            self.item.update()
+
+    def resizeEvent(self, event):
+        """ Re-implemented to keep a fitted image fitted """
+        super(TiledImageView, self).resizeEvent(event)
+        if self.fitted:
+            self.fitImage()
+
+    def wheelEvent(self, event):
+        """ Re-implemented to zoom about the mouse position """
+        if self.item is None:
+            return
+        factor = self.zoomStep ** (event.delta() / 120.)
+        transform = self.transform()
+        scale = math.hypot(transform.m11(), transform.m12()) * factor
+        if factor > 1 and scale > self.maxZoom:
+            return
+        viewRect = self.mapToScene(self.viewport().rect()).boundingRect()
+        if factor < 1 and viewRect.contains(self.item.sceneBoundingRect()):
+            # Zoomed out to the whole image
+            self.fitImage()
+            return
+        self.scale(factor, factor)
+        self.fitted = False
@@ -2,11 +2,54 @@
 from PyQt4 import QtGui, QtCore
 from datastore import FieldObject
 from datetime import datetime
-from ImageMan import getThumbnailIcon
+from ImageMan import getThumbnailIcon, rotateFile, rotateIcon
 import os
-from PIL import Image
+import Queue
 from shared import trashDir
 import shutil
+import threading
+from tiledview import TilePyramid
+
+
+class FileWorker(object):
+    """ Runs file operations one at a time, in order, on a background thread
+
+    Undo commands use this to change files without blocking the GUI. Call
+    wait before doing anything that reads or moves a file that may have
+    operations pending.
+    """
+
+    def __init__(self):
+        self._queue = Queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def put(self, function, *args):
+        """ Queue a call of function(*args) """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work)
+                self._thread.daemon = True
+                self._thread.start()
+        self._queue.put((function, args))
+
+    def wait(self):
+        """ Block until all queued operations are done """
+        self._queue.join()
+
+    def _work(self):
+        """ Run queued operations. Run in the worker thread. """
+        while True:
+            function, args = self._queue.get()
+            try:
+                function(*args)
+            except Exception as err:
+                print('File operation failed: {}'.format(err))
+            finally:
+                self._queue.task_done()
+
+
+fileWorker = FileWorker()
 
 
 class newFieldCmd(QtGui.QUndoCommand):
@@ -63,6 +106,7 @@ class removeRowCmd(QtGui.QUndoCommand):
             self.main.view.setCurrentPhoto(newRow)
 
         # Move the file to the trash
+        fileWorker.wait()
         if os.path.exists(self.photo.filePath):
             trashTime = datetime.now().strftime('.%Y%m%d%H%M%S')
             self.trashFile = os.path.join(trashDir, self.photo.fileName + trashTime)
@@ -102,12 +146,15 @@ class removeRowCmd(QtGui.QUndoCommand):
 class imageRotateCmd(QtGui.QUndoCommand):
     """ Undo command for rotating a photo
 
-    The file is saved to .trash for undo/redo purposes
+    The decoded image and the thumbnail are rotated in memory, so the change
+    shows immediately. The file is rotated on the file worker thread. JPEG
+    files are rotated losslessly by changing their EXIF orientation, which
+    also makes undo exact.
 
     Arguments:
-        main (PhotoOrganizer): The main application instance
-        photo (Photo): The photo object to be deleted
-        angle (int): The angle to rotate the photo
+        viewer (ImageViewer): The image viewer
+        photo (Photo): The photo object to be rotated
+        angle (int): The counter-clockwise angle to rotate the photo
     """
 
     description = "Rotate"
@@ -122,6 +169,17 @@ class imageRotateCmd(QtGui.QUndoCommand):
                                          angle)
         super(imageRotateCmd, self).__init__(description, parent)
 
+    def rotateFile(self, path, angle):
+        """ Rotate the file, then drop any image decoded from it in the
+        meantime, which may show the old rotation. Run on the file worker.
+        """
+        tiles = TilePyramid.directoryFor(path)
+        lossless = rotateFile(path, angle)
+        self.viewer.imageCache.invalidate(path)
+        # The file's tile pyramid is named for its modification time. Its
+        # tiles are still valid if only the orientation changed.
+        TilePyramid.moveCache(tiles, path, keep=lossless)
+
     def redo(self):
         self.do(self.angle)
 
@@ -129,17 +187,18 @@ class imageRotateCmd(QtGui.QUndoCommand):
         self.do(-self.angle)
 
     def do(self, angle):
-        # Do the rotation
-        im = Image.open(self.photo.filePath)
-        exif = im.info['exif']
-        im = im.rotate(angle, expand=True)
-        im.save(self.photo.filePath, exif=exif)
-        im.close()
-        self.viewer.setImage(self.photo)
-
-        # Set the thumbnail
+        # Rotate the file in the background
+        fileWorker.put(self.rotateFile, self.photo.filePath, angle)
+        self.viewer.rotateImage(self.photo, angle)
+
+        # Rotate the thumbnail
         if self.main:
-            thumb = getThumbnailIcon(self.photo.filePath)
+            thumb = self.main.db.thumbnail(self.photo.fileId)
+            if thumb is None:
+                fileWorker.wait()
+                thumb = getThumbnailIcon(self.photo.filePath)
+            else:
+                thumb = rotateIcon(thumb, angle)
             row = self.main.album.index(self.photo)
             index = self.main.model.index(row, 0)
             self.main.model._setData(index, thumb, QtCore.Qt.DecorationRole)